@@ -1,11 +1,14 @@
 import tkinter as tkt
 from tkinterutils import configure_grid, ListBoxPane
 
+# Broadcast messages kept by default, the oldest ones are dropped
+DEFAULT_BROADCAST_HISTORY = 1000
+
 
 class TkinterApplication(tkt.Tk):
     """Entry point of the GUI"""
 
-    def __init__(self, button_send_action):
+    def __init__(self, button_send_action, broadcast_history: int = DEFAULT_BROADCAST_HISTORY):
         super().__init__()
         self.geometry("1000x1000")
         self.title("Chat Network Project")
@@ -19,7 +22,7 @@ class TkinterApplication(tkt.Tk):
         self.__quiz_pane = _QuizPane(self, self.__button_send_action, self.__message_property)
         self.__quiz_pane.grid(column=0, row=1, sticky="nsew")
         # Broadcast pane
-        self.__broadcast_pane = _BroadcastPane(self)
+        self.__broadcast_pane = _BroadcastPane(self, broadcast_history)
         self.__broadcast_pane.grid(column=1, row=1, sticky="nsew")
         # Leaderboard pane
         self.__leaderboard_pane = _LeaderboardPane(self)
@@ -46,15 +49,29 @@ class TkinterApplication(tkt.Tk):
         """
         self.__top_pane.set_role(new_role)
 
-    def set_score(self, new_score: int):
+    def set_score(self, new_score: int, rank: int = None, players: int = None):
         """Set the updated score
 
         Parameters
         ----------
         new_score : int
             Updated score
+        rank : int
+            Position among the players of the whole server, if the server sends it
+        players : int
+            Number of players of the whole server, if the server sends it
+        """
+        self.__top_pane.set_score(new_score, rank, players)
+
+    def set_countdown(self, text: str):
+        """Set the time left
+
+        Parameters
+        ----------
+        text : str
+            Time left before the end of the round and before the deadline of the answer
         """
-        self.__top_pane.set_score(new_score)
+        self.__top_pane.set_countdown(text)
 
     def peek_message(self):
         """Get the current message
@@ -100,6 +117,28 @@ class TkinterApplication(tkt.Tk):
         """
         self.__leaderboard_pane.push_message(msg)
 
+    def insert_leaderboard_message(self, index: int, msg: str):
+        """Insert a message into the leaderboard listbox at a given position
+
+        Parameters
+        ----------
+        index : int
+            Position of the new row
+        msg : str
+            Message to insert
+        """
+        self.__leaderboard_pane.insert_message(index, msg)
+
+    def delete_leaderboard_message(self, index: int):
+        """Delete a row of the leaderboard listbox
+
+        Parameters
+        ----------
+        index : int
+            Position of the row to delete
+        """
+        self.__leaderboard_pane.delete_message(index)
+
     def clear_leaderboard(self):
         """Clear the leaderboard"""
         self.__leaderboard_pane.flush_listbox()
@@ -114,33 +153,42 @@ class TkinterApplication(tkt.Tk):
 
 
 class _TopPane(tkt.Frame):
-    """Top pane that contains a role label and a score label"""
+    """Top pane that contains a role label, a score label and a countdown label"""
 
     def __init__(self, parent):
         super().__init__(parent)
-        configure_grid(self, 2, 1)
+        configure_grid(self, 3, 1)
         self.__role_label = tkt.Label(self)
         self.__role_label.grid(column=0, row=0, sticky="nsew")
         self.__score_label = tkt.Label(self)
         self.__score_label.grid(column=1, row=0, sticky="nsew")
+        self.__countdown_label = tkt.Label(self)
+        self.__countdown_label.grid(column=2, row=0, sticky="nsew")
 
-    def set_score(self, new_score: int):
+    def set_score(self, new_score: int, rank: int = None, players: int = None):
         """Set the updated score"""
-        self.__score_label.config(text=f"Score: {str(new_score)}")
+        text = f"Score: {str(new_score)}"
+        if rank is not None:
+            text += f" (rank {rank} of {players})"
+        self.__score_label.config(text=text)
 
     def set_role(self, new_role: str):
         """Set the role"""
         self.__role_label.config(text=f"Role: {new_role}")
 
+    def set_countdown(self, text: str):
+        """Set the time left"""
+        self.__countdown_label.config(text=text)
+
 
 class _CommonAppPane(tkt.Frame):
     """Pane that contains a label and a listbox"""
 
-    def __init__(self, parent, label_str):
+    def __init__(self, parent, label_str, max_rows: int = None, follow: bool = False):
         super().__init__(parent)
         self._label = tkt.Label(self)
         self._label.config(text=label_str)
-        self._listbox_pane = ListBoxPane(self)
+        self._listbox_pane = ListBoxPane(self, max_rows, follow)
 
     def push_message(self, msg: str):
         """Push a message to the listbox
@@ -150,11 +198,33 @@ class _CommonAppPane(tkt.Frame):
         msg : str
             Message to push
         """
-        self._listbox_pane.listbox.insert(tkt.END, msg)
+        self._listbox_pane.push(msg)
+
+    def insert_message(self, index: int, msg: str):
+        """Insert a message in the listbox at a given position
+
+        Parameters
+        ----------
+        index : int
+            Position of the new row
+        msg : str
+            Message to insert
+        """
+        self._listbox_pane.insert(index, msg)
+
+    def delete_message(self, index: int):
+        """Delete a row of the listbox
+
+        Parameters
+        ----------
+        index : int
+            Position of the row to delete
+        """
+        self._listbox_pane.delete(index)
 
     def flush_listbox(self):
         """Delete all the elements of the listbox"""
-        self._listbox_pane.listbox.delete(0, tkt.END)
+        self._listbox_pane.clear()
 
 
 class _QuizPane(_CommonAppPane):
@@ -177,10 +247,10 @@ class _QuizPane(_CommonAppPane):
 
 
 class _BroadcastPane(_CommonAppPane):
-    """Pane with the broadcast messages"""
+    """Pane with the last broadcast messages, the view follows the new ones"""
 
-    def __init__(self, parent):
-        super().__init__(parent, "Broadcast")
+    def __init__(self, parent, history: int):
+        super().__init__(parent, "Broadcast", history, follow=True)
         configure_grid(self, 1, 2)
         self._label.grid(column=0, row=0, sticky="nsew")
         self._listbox_pane.grid(column=0, row=1, sticky="nsew")
@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from itertools import product
+from socket import socket, create_connection
+from time import monotonic, sleep
+from typing import Any, Dict, List, Optional
+from bot import raise_open_files_limit, summarize
+from codec import COMPRESSIONS, ENCODINGS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    """A TCP port nobody is listening on"""
+    with socket() as probe:
+        probe.bind(("localhost", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_server(port: int, timeout: float = 10):
+    """Wait until the server accepts connections
+
+    Raises
+    ------
+    TimeoutError
+        if the server is not ready within `timeout` seconds
+    """
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        try:
+            create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise TimeoutError(f"The server is not listening on port {port}")
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    """Resident memory in bytes of a process and of its children, None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            rss = next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            child_pids = [int(child) for child in children.read().split()]
+    except (OSError, StopIteration):
+        return None
+    return rss + sum(process_tree_rss(child) or 0 for child in child_pids)
+
+
+def process_tree_cpu(pid: int) -> Optional[float]:
+    """CPU seconds used by a process and by its children, None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # The command name can contain spaces, the fields are counted from its closing parenthesis
+            fields = stat.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            child_pids = [int(child) for child in children.read().split()]
+    except OSError:
+        return None
+    # utime and stime, the 14th and 15th fields of the line
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu + sum(process_tree_cpu(child) or 0 for child in child_pids)
+
+
+def git_revision() -> Optional[str]:
+    """Commit of the benchmarked tree, None outside of a git checkout"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(players: int, mode: str, duration: float, rate: float, ramp: float, bot_processes: int,
+                  server_args: List[str], results_dir: str, encoding: str = "json",
+                  compression: str = "none", pipeline: int = 0) -> Dict[str, Any]:
+    """Start a server, play `players` bots against it and measure them
+
+    Returns
+    -------
+    dict
+        summary of the latencies in milliseconds, the throughput, the bytes received by the bots, the CPU time
+        and the peak memory of the server
+    """
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, "chat_server.py"), "-port", str(port),
+                               "-mode", mode, *server_args], cwd=HERE,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(port)
+        # The bots are split among several processes, so that the load generator is not the bottleneck
+        shares = [players // bot_processes + (1 if i < players % bot_processes else 0)
+                  for i in range(bot_processes)]
+        # Every bot process writes its raw measurements to a file of its own
+        result_paths = [os.path.join(results_dir, f"bot{i}.json") for i in range(len(shares))]
+        bots = [subprocess.Popen([sys.executable, os.path.join(HERE, "bot.py"), "-port", str(port),
+                                  "-players", str(share), "-duration", str(duration), "-rate", str(rate),
+                                  "-ramp", str(ramp), "-name-prefix", f"bot{i}-", "-encoding", encoding,
+                                  "-compression", compression, "-pipeline", str(pipeline),
+                                  "-json", result_paths[i]],
+                                 cwd=HERE)
+                for i, share in enumerate(shares) if share > 0]
+        peak_rss = None
+        while any(bot.poll() is None for bot in bots):
+            rss = process_tree_rss(server.pid)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+            sleep(0.5)
+        results = []
+        for bot, path in zip(bots, result_paths):
+            if bot.returncode != 0:
+                raise RuntimeError(f"A bot process exited with status {bot.returncode}")
+            with open(path) as result_file:
+                results.append(json.load(result_file))
+        server_cpu = process_tree_cpu(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    elapsed = max(result["duration"] for result in results)
+    total = {key: sum(result[key] for result in results)
+             for key in ("joins", "answers", "errors", "messages", "bytes")}
+    return {
+        "players": players,
+        "mode": mode,
+        "encoding": encoding,
+        "compression": compression,
+        "pipeline": pipeline,
+        **total,
+        "join_latency_ms": summarize([v for result in results for v in result["join_latency_ms"]]),
+        "answer_rtt_ms": summarize([v for result in results for v in result["answer_rtt_ms"]]),
+        "round_wait_ms": summarize([v for result in results for v in result["round_wait_ms"]]),
+        "fanout_latency_ms": summarize([v for result in results for v in result["fanout_latency_ms"]]),
+        "messages_per_sec": round(total["messages"] / elapsed, 1),
+        "answers_per_sec": round(total["answers"] / elapsed, 1),
+        "received_kib_per_sec": round(total["bytes"] / elapsed / 1024, 1),
+        "server_cpu_seconds": round(server_cpu, 2) if server_cpu is not None else None,
+        # CPU time of the server for each answer, comparable across runs of different lengths
+        "server_cpu_ms_per_answer": (round(server_cpu * 1000 / total["answers"], 3)
+                                     if server_cpu is not None and total["answers"] else None),
+        "server_peak_rss_mb": round(peak_rss / 2 ** 20, 1) if peak_rss is not None else None
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Measure the server with a growing number of headless players')
+    parser.add_argument('-players', '--players', type=str, default='100,500,1000',
+                        help='Comma separated player counts, one run each')
+    parser.add_argument('-mode', '--mode', choices=['asyncio', 'threaded'], default='threaded',
+                        help='Concurrency model of the server')
+    parser.add_argument('-encodings', '--encodings', type=str, default=','.join(ENCODINGS),
+                        help='Comma separated encodings asked by the bots, every player count is run with each one')
+    parser.add_argument('-compressions', '--compressions', type=str, default=','.join(COMPRESSIONS),
+                        help='Comma separated compressions asked by the bots, crossed with the encodings')
+    parser.add_argument('-pipelines', '--pipelines', type=str, default='0',
+                        help='Comma separated numbers of rounds the bots ask to be sent ahead, crossed with the '
+                             'encodings and the compressions, 0 plays a round trip each step')
+    parser.add_argument('-duration', '--duration', type=float, default=20, help='Seconds of play of every run')
+    parser.add_argument('-rate', '--rate', type=float, default=2, help='Answers per second of each bot')
+    parser.add_argument('-ramp', '--ramp', type=float, default=5, help='Seconds over which the bots are started')
+    parser.add_argument('-bot-processes', '--bot-processes', type=int, default=os.cpu_count() or 1,
+                        help='Processes running the bots')
+    parser.add_argument('-output', '--output', type=str, default='benchmark_results.json',
+                        help='Json file the results are written to')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='Extra arguments of the server, after a --')
+    args = parser.parse_args()
+
+    raise_open_files_limit()
+    extra_args = [arg for arg in args.server_args if arg != '--']
+    runs = []
+    for count in map(int, args.players.split(',')):
+        for encoding, compression, pipeline in product(args.encodings.split(','), args.compressions.split(','),
+                                                       map(int, args.pipelines.split(','))):
+            with tempfile.TemporaryDirectory() as results_dir:
+                run = run_benchmark(count, args.mode, args.duration, args.rate, args.ramp, args.bot_processes,
+                                    extra_args, results_dir, encoding, compression, pipeline)
+            print(f"{count} players, {encoding}, compression {compression}, pipeline {pipeline}: "
+                  f"join p50={run['join_latency_ms']['p50']}ms "
+                  f"answer p50={run['answer_rtt_ms']['p50']}ms p99={run['answer_rtt_ms']['p99']}ms "
+                  f"round wait p50={run['round_wait_ms']['p50']}ms "
+                  f"fan-out p99={run['fanout_latency_ms']['p99']}ms {run['messages_per_sec']} messages/s "
+                  f"{run['received_kib_per_sec']}KiB/s cpu={run['server_cpu_ms_per_answer']}ms/answer "
+                  f"rss={run['server_peak_rss_mb']}MB errors={run['errors']}")
+            runs.append(run)
+
+    with open(args.output, "w") as output:
+        json.dump({
+            "revision": git_revision(),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "config": {"mode": args.mode, "encodings": args.encodings, "compressions": args.compressions,
+                       "pipelines": args.pipelines,
+                       "duration": args.duration, "rate": args.rate, "ramp": args.ramp,
+                       "bot_processes": args.bot_processes, "server_args": extra_args},
+            "runs": runs
+        }, output, indent=2)
+    print(f"Results written to {args.output}")
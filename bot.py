@@ -0,0 +1,445 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+from asyncio import StreamWriter
+from collections import deque
+from time import monotonic, perf_counter
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import client_utils as cu
+from codec import (COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSIONS, ENCODING_JSON, ENCODING_REQUEST, ENCODINGS,
+                   PIPELINE_REQUEST, Payload, PayloadDecoder, compression_request)
+from protocol import CHANNEL_BROADCAST, CHANNEL_CONTROL, CHANNEL_GAME, CHANNEL_LEADERBOARD, SUBSCRIBE_MESSAGE
+from reaper import PING, PONG
+from sessions import RESUME_COMMAND, RESUME_FAILED, SESSION_COMMAND
+
+# Line of the broadcast sent by the server after every batch of answers, one for each answer
+ANSWER_BROADCAST = re.compile(r"^(.*) (?:got|lost) a point, its current score is -?\d+$")
+# Seconds a bot waits for a message of the game before counting an error and joining again
+RESPONSE_TIMEOUT = 30
+# Attempts to resume a session, the server may not have noticed the broken connection yet
+RESUME_ATTEMPTS = 5
+RESUME_RETRY_DELAY = 0.05
+
+
+class BotStats:
+    """Measurements collected by the bots of a process, the latencies are in seconds"""
+
+    def __init__(self):
+        # From the connection to the welcome message
+        self.join_latencies: List[float] = []
+        # From the choice to the new score
+        self.answer_rtts: List[float] = []
+        # Time a bot waits for the server in each round, its think time excluded
+        self.round_waits: List[float] = []
+        # From the choice of a bot to its answer broadcast reaching the other bots of the process
+        self.fanout_latencies: List[float] = []
+        # From a dropped connection to the reply to the resumption of its session
+        self.resume_latencies: List[float] = []
+        self.joins = 0
+        self.resumes = 0
+        self.answers = 0
+        self.errors = 0
+        # Frames and bytes received by the bots
+        self.messages = 0
+        self.bytes_received = 0
+        # Time of the last answer of every bot
+        self.answer_sent: Dict[str, float] = {}
+
+    def to_dict(self, duration: float) -> Dict[str, Any]:
+        """Machine readable result, with the raw latencies in milliseconds"""
+        return {
+            "duration": round(duration, 3),
+            "joins": self.joins,
+            "answers": self.answers,
+            "errors": self.errors,
+            "resumes": self.resumes,
+            "messages": self.messages,
+            "bytes": self.bytes_received,
+            "join_latency_ms": [round(latency * 1000, 3) for latency in self.join_latencies],
+            "answer_rtt_ms": [round(latency * 1000, 3) for latency in self.answer_rtts],
+            "round_wait_ms": [round(latency * 1000, 3) for latency in self.round_waits],
+            "fanout_latency_ms": [round(latency * 1000, 3) for latency in self.fanout_latencies],
+            "resume_latency_ms": [round(latency * 1000, 3) for latency in self.resume_latencies]
+        }
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    """Nearest rank percentile of the samples, None if there are none
+
+    Parameters
+    ----------
+    samples : list[float]
+        sorted samples
+    q : float
+        percentile between 0 and 100
+    """
+    if not samples:
+        return None
+    rank = max(0, min(len(samples) - 1, int(round(q / 100 * len(samples) + 0.5)) - 1))
+    return samples[rank]
+
+
+def summarize(samples: List[float]) -> Dict[str, Optional[float]]:
+    """Count, mean, p50, p99 and max of the samples"""
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3) if ordered else None,
+        "p50": percentile(ordered, 50),
+        "p99": percentile(ordered, 99),
+        "max": ordered[-1] if ordered else None
+    }
+
+
+def raise_open_files_limit():
+    """Raise the limit of open files to its maximum, every bot and every player needs a descriptor"""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def listen_broadcasts(dispatcher: cu.AsyncChannelDispatcher, stats: BotStats):
+    """Consume the broadcasts of a bot, measuring how long the answers of the other bots take to reach it"""
+    while True:
+        message = await dispatcher.read_message(CHANNEL_BROADCAST)
+        received = perf_counter()
+        for line in message.split("\n"):
+            match = ANSWER_BROADCAST.match(line)
+            if match is not None:
+                sent = stats.answer_sent.get(match.group(1))
+                if sent is not None and sent <= received:
+                    stats.fanout_latencies.append(received - sent)
+
+
+async def listen_leaderboard(dispatcher: cu.AsyncChannelDispatcher, decoder: PayloadDecoder):
+    """Decode the leaderboard messages of a bot, like a player would"""
+    while True:
+        decoder.decode(await dispatcher.read_message(CHANNEL_LEADERBOARD))
+
+
+async def listen_control(dispatcher: cu.AsyncChannelDispatcher, connection: "BotConnection"):
+    """Consume the replies of the control channel, keeping the session token given by the server and answering
+    its pings"""
+    while True:
+        message = await dispatcher.read_message(CHANNEL_CONTROL)
+        command, _, argument = message.partition(" ")
+        if command == SESSION_COMMAND:
+            connection.token = argument
+        elif command == PING:
+            cu.write_message(connection.writer, PONG, CHANNEL_CONTROL)
+
+
+async def read_game_message(dispatcher: cu.AsyncChannelDispatcher) -> Payload:
+    """Next message of the game channel, waiting at most `RESPONSE_TIMEOUT` seconds"""
+    return await asyncio.wait_for(dispatcher.read_message(CHANNEL_GAME), RESPONSE_TIMEOUT)
+
+
+async def receive_pipelined(dispatcher: cu.AsyncChannelDispatcher, decoder: PayloadDecoder, rounds: asyncio.Queue,
+                            sent: Deque[float], lost: asyncio.Event, stats: BotStats):
+    """Consume the game channel of a pipelined bot: queue the rounds sent ahead, and match every score with the
+    answer it replies to, the answers being scored in order
+
+    When the bot picked the trick question `lost` is set and a None is queued, an exception is queued if the
+    game channel fails.
+    """
+    known: Dict[int, Tuple[str, List[str]]] = {}
+    try:
+        while True:
+            message = decoder.decode(await dispatcher.read_message(CHANNEL_GAME))
+            if not isinstance(message, dict):
+                raise ValueError("The server does not send the rounds ahead")
+            if "ROUND" in message:
+                rounds.put_nowait(cu.decode_round(message["ROUND"], known))
+            elif message.get("status") == "LOST":
+                # The rounds sent ahead of the trick question will never be scored
+                while not rounds.empty():
+                    rounds.get_nowait()
+                rounds.put_nowait(None)
+                lost.set()
+            else:
+                stats.answer_rtts.append(perf_counter() - sent.popleft())
+                stats.answers += 1
+    except (OSError, ValueError, KeyError, IndexError) as error:
+        rounds.put_nowait(error)
+
+
+class BotConnection:
+    """Connection of a bot to the server, with the tasks consuming its broadcast, leaderboard and control
+    channels"""
+
+    def __init__(self, writer: StreamWriter, dispatcher: cu.AsyncChannelDispatcher):
+        self.writer = writer
+        self.dispatcher = dispatcher
+        self.listeners: List[asyncio.Future] = []
+        # Token of the session, received once the bot has joined
+        self.token: Optional[str] = None
+
+    def close(self, stats: BotStats):
+        """Stop the listeners and close the connection, counting the frames and the bytes it received"""
+        for listener in self.listeners:
+            listener.cancel()
+        self.dispatcher.stop()
+        stats.messages += self.dispatcher.received
+        stats.bytes_received += self.dispatcher.bytes_received
+        self.writer.close()
+
+
+async def open_bot_connection(address: Tuple[str, int], stats: BotStats, decoder: PayloadDecoder, encoding: str,
+                              dictionary: Optional[bytes], first_message: Optional[str] = None,
+                              pipeline: int = 0) -> BotConnection:
+    """Connect to the server, negotiate the encoding, the compression and the rounds sent ahead, then subscribe to
+    the broadcasts and to the leaderboard
+
+    `first_message` is written on the game channel before subscribing, so that the subscriptions of a resumed
+    session are scoped to its room.
+    """
+    writer, dispatcher = await cu.open_multiplexed_connection(address, dictionary)
+    dispatcher.start()
+    connection = BotConnection(writer, dispatcher)
+    connection.listeners = [asyncio.ensure_future(listen_broadcasts(dispatcher, stats)),
+                            asyncio.ensure_future(listen_leaderboard(dispatcher, decoder)),
+                            asyncio.ensure_future(listen_control(dispatcher, connection))]
+    cu.write_message(writer, f"{ENCODING_REQUEST} {encoding}", CHANNEL_CONTROL)
+    if dictionary is not None:
+        cu.write_message(writer, compression_request(dictionary), CHANNEL_CONTROL)
+    if pipeline > 0:
+        cu.write_message(writer, f"{PIPELINE_REQUEST} {pipeline}", CHANNEL_CONTROL)
+    if first_message is not None:
+        cu.write_message(writer, first_message)
+    cu.write_message(writer, SUBSCRIBE_MESSAGE, CHANNEL_BROADCAST)
+    cu.write_message(writer, SUBSCRIBE_MESSAGE, CHANNEL_LEADERBOARD)
+    return connection
+
+
+async def drop_and_resume(connection: BotConnection, address: Tuple[str, int], stats: BotStats,
+                          decoder: PayloadDecoder, encoding: str, dictionary: Optional[bytes]) -> BotConnection:
+    """Drop the connection of a bot like a network failure would, then resume its session on a new one
+
+    Raises
+    ------
+    ValueError
+        if the server cannot resume the session
+    """
+    token = connection.token
+    started = perf_counter()
+    # Reset the connection instead of closing it gracefully
+    connection.writer.transport.abort()
+    connection.close(stats)
+    resumed = await open_bot_connection(address, stats, decoder, encoding, dictionary, f"{RESUME_COMMAND} {token}")
+    try:
+        # Instructions
+        await read_game_message(resumed.dispatcher)
+        for _ in range(RESUME_ATTEMPTS):
+            reply = await read_game_message(resumed.dispatcher)
+            if reply != RESUME_FAILED:
+                break
+            # The server may still be waiting for the old connection to break
+            await asyncio.sleep(RESUME_RETRY_DELAY)
+            cu.write_message(resumed.writer, f"{RESUME_COMMAND} {token}")
+        else:
+            raise ValueError("The session cannot be resumed")
+        if "RESUMED" not in decoder.decode(reply):
+            raise ValueError("Unexpected reply to the resumption")
+    except BaseException:
+        resumed.close(stats)
+        raise
+    stats.resume_latencies.append(perf_counter() - started)
+    stats.resumes += 1
+    resumed.token = token
+    return resumed
+
+
+async def play_pipelined(name: str, connection: BotConnection, decoder: PayloadDecoder, stats: BotStats,
+                         rate: float, deadline: float) -> bool:
+    """Answer the rounds sent ahead by the server without waiting for the scores, until the deadline
+
+    Returns
+    -------
+    bool
+        False if the bot picked the trick question
+    """
+    rounds: asyncio.Queue = asyncio.Queue()
+    # Times of the answers waiting for their score, oldest first
+    sent: Deque[float] = deque()
+    lost = asyncio.Event()
+    connection.listeners.append(asyncio.ensure_future(receive_pipelined(connection.dispatcher, decoder, rounds,
+                                                                        sent, lost, stats)))
+    while monotonic() < deadline:
+        waited = perf_counter()
+        questions = await asyncio.wait_for(rounds.get(), RESPONSE_TIMEOUT)
+        if questions is None:
+            return False
+        if isinstance(questions, Exception):
+            raise questions
+        stats.round_waits.append(perf_counter() - waited)
+        question_id, _, choices = random.choice(questions)
+        sent.append(perf_counter())
+        stats.answer_sent[name] = sent[-1]
+        cu.write_message(connection.writer, f"{question_id} {random.randrange(len(choices))}")
+        if rate > 0:
+            # Like a player, the bot stops thinking about the next round when it learns it has been tricked
+            try:
+                await asyncio.wait_for(lost.wait(), random.expovariate(rate))
+            except asyncio.TimeoutError:
+                pass
+    return True
+
+
+async def play_session(name: str, address: Tuple[str, int], stats: BotStats, rate: float, deadline: float,
+                       encoding: str, dictionary: Optional[bytes], disconnect_rate: float, pipeline: int = 0):
+    """Join the game and answer questions until the deadline or until the bot picks the trick question
+
+    After picking a question the bot drops its connection with probability `disconnect_rate`, then resumes
+    its session and answers the choices the server sends again. With a `pipeline` depth the server sends the
+    rounds ahead with their choices, and the bot answers them without waiting for the scores.
+    """
+    started = perf_counter()
+    decoder = PayloadDecoder()
+    connection = await open_bot_connection(address, stats, decoder, encoding, dictionary, pipeline=pipeline)
+    try:
+        # Instructions
+        await read_game_message(connection.dispatcher)
+        cu.write_message(connection.writer, name)
+        # Welcome message
+        await read_game_message(connection.dispatcher)
+        stats.join_latencies.append(perf_counter() - started)
+        stats.joins += 1
+        # Role and role description
+        decoder.decode(await read_game_message(connection.dispatcher))
+        await read_game_message(connection.dispatcher)
+
+        if pipeline > 0:
+            if not await play_pipelined(name, connection, decoder, stats, rate, deadline):
+                return
+            cu.write_message(connection.writer, "{quit}")
+            return
+
+        question_texts: Dict[int, str] = {}
+        while monotonic() < deadline:
+            waited = perf_counter()
+            questions = cu.decode_questions(decoder.decode(await read_game_message(connection.dispatcher)),
+                                            question_texts)
+            # The questions follow the score of the previous answer, the wait is counted from there
+            wait = perf_counter() - waited
+            question_id, _ = random.choice(questions)
+            cu.write_message(connection.writer, str(question_id))
+            waited = perf_counter()
+            response = decoder.decode(await read_game_message(connection.dispatcher))
+            wait += perf_counter() - waited
+            if response["status"] == "LOST":
+                return
+            if connection.token is not None and random.random() < disconnect_rate:
+                connection = await drop_and_resume(connection, address, stats, decoder, encoding, dictionary)
+                response = decoder.decode(await read_game_message(connection.dispatcher))
+            sent = perf_counter()
+            stats.answer_sent[name] = sent
+            cu.write_message(connection.writer, str(random.randrange(len(response["choices"]))))
+            decoder.decode(await read_game_message(connection.dispatcher))
+            stats.answer_rtts.append(perf_counter() - sent)
+            stats.round_waits.append(wait + perf_counter() - sent)
+            stats.answers += 1
+            if rate > 0:
+                # Exponential think time, so that the answers of the bots do not arrive in lockstep
+                await asyncio.sleep(random.expovariate(rate))
+        cu.write_message(connection.writer, "{quit}")
+    finally:
+        connection.close(stats)
+
+
+async def run_bot(name: str, address: Tuple[str, int], stats: BotStats, rate: float, start_delay: float,
+                  deadline: float, encoding: str, dictionary: Optional[bytes], disconnect_rate: float,
+                  pipeline: int = 0):
+    """Play sessions until the deadline, a bot that lost joins the game again"""
+    await asyncio.sleep(start_delay)
+    while monotonic() < deadline:
+        try:
+            await play_session(name, address, stats, rate, deadline, encoding, dictionary, disconnect_rate,
+                               pipeline)
+        except (OSError, ValueError, KeyError, asyncio.TimeoutError):
+            stats.errors += 1
+            await asyncio.sleep(0.5)
+
+
+async def run_bots(address: Tuple[str, int], players: int, duration: float, rate: float, ramp: float,
+                   name_prefix: str = "bot", encoding: str = ENCODING_JSON,
+                   dictionary: Optional[bytes] = None, disconnect_rate: float = 0,
+                   pipeline: int = 0) -> Tuple[BotStats, float]:
+    """Run `players` bots for `duration` seconds, starting them evenly during the first `ramp` seconds
+
+    The bots ask for the compression of the large frames if a preset `dictionary` is given, and for `pipeline`
+    rounds sent ahead if it is positive.
+
+    Returns
+    -------
+    tuple[BotStats, float]
+        the measurements and the elapsed time
+    """
+    stats = BotStats()
+    started = monotonic()
+    deadline = started + duration
+    await asyncio.gather(*(run_bot(f"{name_prefix}{i}", address, stats, rate, ramp * i / players, deadline,
+                                   encoding, dictionary, disconnect_rate, pipeline)
+                           for i in range(players)))
+    return stats, monotonic() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Headless players for load testing the server')
+    parser.add_argument('-host', '--host', type=str, default='localhost', help='Server host name')
+    parser.add_argument('-port', '--port', type=int, default=53000, help='Port of the server')
+    parser.add_argument('-players', '--players', type=int, default=100, help='Number of bots')
+    parser.add_argument('-duration', '--duration', type=float, default=20, help='Seconds of play')
+    parser.add_argument('-rate', '--rate', type=float, default=2,
+                        help='Answers per second of each bot, 0 answers as fast as possible')
+    parser.add_argument('-ramp', '--ramp', type=float, default=2, help='Seconds over which the bots are started')
+    parser.add_argument('-encoding', '--encoding', choices=ENCODINGS, default=ENCODING_JSON,
+                        help='Encoding of the structured messages asked to the server')
+    parser.add_argument('-compression', '--compression', choices=COMPRESSIONS, default=COMPRESSION_NONE,
+                        help='Ask the server to compress the large messages')
+    parser.add_argument('-questions', '--questions', type=str, default='questions.json',
+                        help='Questions file the compression dictionary is built from, the same one of the server')
+    parser.add_argument('-disconnect-rate', '--disconnect-rate', type=float, default=0,
+                        help='Probability that a bot drops its connection after picking a question, then resumes '
+                             'its session')
+    parser.add_argument('-pipeline', '--pipeline', type=int, default=0,
+                        help='Rounds the server is asked to send ahead with their choices, so that the bots answer '
+                             'without a round trip for each step, 0 plays a round trip each step')
+    parser.add_argument('-name-prefix', '--name-prefix', type=str, default='bot', help='Prefix of the bot names')
+    parser.add_argument('-json', '--json', type=str, default=None,
+                        help='Write the raw measurements as a json object to this file (- for the standard output) '
+                             'instead of printing a summary')
+    args = parser.parse_args()
+
+    if args.pipeline > 0 and args.disconnect_rate > 0:
+        parser.error("The pipelined bots do not resume their sessions, -disconnect-rate needs -pipeline 0")
+    raise_open_files_limit()
+    compression_dictionary = None
+    if args.compression == COMPRESSION_ZLIB:
+        compression_dictionary = cu.load_compression_dictionary(args.questions)
+        if compression_dictionary is None:
+            parser.error(f"Cannot build the compression dictionary from {args.questions}")
+    bot_stats, elapsed = asyncio.run(run_bots((args.host, args.port), args.players, args.duration, args.rate,
+                                              args.ramp, args.name_prefix, args.encoding, compression_dictionary,
+                                              args.disconnect_rate, args.pipeline))
+    result = bot_stats.to_dict(elapsed)
+    if args.json == '-':
+        json.dump(result, sys.stdout)
+        sys.stdout.write("\n")
+    elif args.json is not None:
+        with open(args.json, "w") as output:
+            json.dump(result, output)
+    else:
+        print(f"{result['joins']} joins, {result['answers']} answers, {result['errors']} errors, "
+              f"{result['resumes']} resumes, "
+              f"{result['messages'] / elapsed:.0f} messages/s, {result['bytes'] / elapsed / 1024:.0f} KiB/s")
+        for metric in ("join_latency_ms", "answer_rtt_ms", "round_wait_ms", "fanout_latency_ms", "resume_latency_ms"):
+            print(metric, summarize(result[metric]))
@@ -1,220 +1,365 @@
 import argparse
-from socket import socket, AF_INET, SOCK_STREAM
-from threading import Condition, Thread
 import tkinter as tkt
-import json
-from typing import Any, List
-from GUI import TkinterApplication
+from math import ceil
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+from GUI import DEFAULT_BROADCAST_HISTORY, TkinterApplication
+from tkinterutils import TkChannelReader
 import client_utils as cu
+from codec import (CLOCK_COMMAND, CLOCK_SYNC, COMPRESSION_ZLIB, COMPRESSIONS, DEADLINE_ANSWER, DEADLINE_MATCH,
+                   ENCODING_BINARY, ENCODING_REQUEST, ENCODINGS, Payload, PayloadDecoder, clock_request,
+                   compression_request, parse_clock)
+from protocol import CHANNEL_BROADCAST, CHANNEL_CONTROL, CHANNEL_GAME, CHANNEL_LEADERBOARD, SUBSCRIBE_MESSAGE
+from reaper import PING, PONG, TIMEOUT_COMMAND
+from sessions import RESUME_COMMAND, RESUME_FAILED, SESSION_COMMAND
 from tkinter.messagebox import showinfo, showerror
 
 
-def broadcast_receive():
-    """Handler for the broadcast thread"""
-    # Get the welcome message
-    broadcast_socket.recv(BUFFER_SIZE).decode("utf8")
-    broadcast_socket.send(bytes("BROADCAST", "utf8"))
-    while True:
-        try:
-            msg = cu.read_message(broadcast_socket)[0]
-            if msg == 'TIMER ENDED':
-                window.disable_inputs()
-            window.push_broadcast_message(msg)
-        except ConnectionResetError:
-            print("Closed the broadcast connection")
-            return
-
-
-def leaderboard_receive():
-    """Handler for the leaderboard thread"""
-    # Get the welcome message
-    leaderboard_socket.recv(BUFFER_SIZE).decode("utf8")
-    leaderboard_socket.send(bytes("LEADERBOARD", "utf8"))
-    while True:
-        try:
-            # Show the leaderboard
-            msg = cu.read_message(leaderboard_socket)[0]
-            window.clear_leaderboard()
-            parsed_msg = json.loads(msg)
-
-            # Check if the leaderboard message is the winner message
-            if "DECLARED_WINNER" in parsed_msg:
-                winner = parsed_msg["DECLARED_WINNER"]
-                # If the winner is a list then we have more than one winner
-                if isinstance(winner, list):
-                    # We have more than one winner
-                    winner_message = '\n'.join(
-                        map(lambda w: f"{w['winner_name']} with the score {w['winner_score']}", winner))
-                    message = f"Winners are \n{winner_message}"
-                else:
-                    message = f"The winner is {winner['winner_name']} with the score {winner['winner_score']}"
-                showinfo("We have a winner", message)
+# States of the client, the messages of the game channel and the inputs of the user move it from one to the next
+WAITING_INSTRUCTIONS = "WAITING_INSTRUCTIONS"
+TYPING_NAME = "TYPING_NAME"
+WAITING_WELCOME = "WAITING_WELCOME"
+WAITING_ROLE = "WAITING_ROLE"
+WAITING_ROLE_DESCRIPTION = "WAITING_ROLE_DESCRIPTION"
+WAITING_QUESTIONS = "WAITING_QUESTIONS"
+CHOOSING_QUESTION = "CHOOSING_QUESTION"
+WAITING_CHOICES = "WAITING_CHOICES"
+CHOOSING_CHOICE = "CHOOSING_CHOICE"
+WAITING_SCORE = "WAITING_SCORE"
+# The connection broke: the client connects again and waits for the instructions, then for the resumed session
+RESUMING = "RESUMING"
+WAITING_RESUMED = "WAITING_RESUMED"
+ENDED = "ENDED"
+
+# Milliseconds between two attempts to connect again, and attempts before giving up. The server refuses a
+# resumption until it notices that the previous connection broke, the refused attempts are retried too
+RECONNECT_DELAY = 500
+RECONNECT_ATTEMPTS = 10
+# Milliseconds between two refreshes of the countdown, computed locally from the clock of the server
+COUNTDOWN_REFRESH = 1000
+
+
+def broadcast_receive(msg: str):
+    """Handler of the broadcast channel"""
+    if msg == 'TIMER ENDED':
+        window.disable_inputs()
+    # The answers committed together are broadcast as one message, a line each
+    for line in msg.split("\n"):
+        window.push_broadcast_message(line)
+
+
+def leaderboard_receive(msg: Payload):
+    """Handler of the leaderboard channel"""
+    # Show the leaderboard
+    parsed_msg = decoder.decode(msg)
+
+    # Check if the leaderboard message is a delta of the previous one
+    if "DELTA" in parsed_msg:
+        delta = parsed_msg["DELTA"]
+        for operation in leaderboard_model.apply_delta(delta["updated"], delta["removed"]):
+            if operation[0] == "delete":
+                window.delete_leaderboard_message(operation[1])
             else:
-                for (k, v) in parsed_msg.items():
-                    window.push_leaderboard_message(f"{k}:{v}")
-        except ConnectionResetError:
-            print("Closed the leaderboard connection")
-            return
-
+                window.insert_leaderboard_message(operation[1], operation[2])
+    # Check if the leaderboard message is the snapshot the following deltas are applied to
+    elif "SNAPSHOT" in parsed_msg:
+        window.clear_leaderboard()
+        for row in leaderboard_model.load_snapshot(parsed_msg["SNAPSHOT"]):
+            window.push_leaderboard_message(row)
+    # Check if the leaderboard message is the winner message
+    elif "DECLARED_WINNER" in parsed_msg:
+        winner = parsed_msg["DECLARED_WINNER"]
+        # If the winner is a list then we have more than one winner
+        if isinstance(winner, list):
+            # We have more than one winner
+            winner_message = '\n'.join(
+                map(lambda w: f"{w['winner_name']} with the score {w['winner_score']}", winner))
+            message = f"Winners are \n{winner_message}"
+        else:
+            message = f"The winner is {winner['winner_name']} with the score {winner['winner_score']}"
+        showinfo("We have a winner", message)
+    else:
+        window.clear_leaderboard()
+        for (k, v) in parsed_msg.items():
+            window.push_leaderboard_message(f"{k}:{v}")
 
-def client_receive():
-    global game_loop
-    """Function for handling messages from the server"""
 
-    # Initial communication
-    try:
+def client_receive(msg: Payload):
+    """Handler of the game channel, the message is interpreted according to the state of the client"""
+    global state, answer_deadline
+    if state == WAITING_INSTRUCTIONS:
         # Message telling the instructions
-        instructions_msg = client_socket.recv(BUFFER_SIZE).decode("utf8")
-        window.push_client_message(instructions_msg)
-        # Welcome message
-        welcome_msg = client_socket.recv(BUFFER_SIZE).decode("utf8")
-        window.push_client_message(welcome_msg)
-        received_message = cu.read_message(client_socket)
-        # Get the part of the message describing the role
-        role_msg = received_message[0]
-        window.set_role(json.loads(role_msg)["role"])
+        window.push_client_message(msg)
+        state = TYPING_NAME
+    elif state == WAITING_WELCOME:
+        window.push_client_message(msg)
+        state = WAITING_ROLE
+    elif state == WAITING_ROLE:
+        # Message describing the role
+        window.set_role(decoder.decode(msg)["role"])
         # Set the score to 0
         window.set_score(0)
-        if len(received_message) == 3:
-            window.push_client_message(received_message[1])
-        elif len(received_message) == 2:
-            received_message = received_message[1:]
-            window.push_client_message(received_message[0])
-        else:
-            received_message = cu.read_message(client_socket)
-            window.push_client_message(received_message[0])
-    except OSError:
-        print("Closed the connection")
+        state = WAITING_ROLE_DESCRIPTION
+    elif state == WAITING_ROLE_DESCRIPTION:
+        window.push_client_message(msg)
+        state = WAITING_QUESTIONS
+    elif state == WAITING_QUESTIONS:
+        # The server sends the text of a question only the first time, then just its id
+        show_questions(cu.decode_questions(decoder.decode(msg), question_texts))
+    elif state == WAITING_CHOICES:
+        # The response contains a status and the choices(list of strings)
+        show_choices(decoder.decode(msg))
+    elif state == RESUMING:
+        # The instructions of the new connection, the session is resumed instead
+        state = WAITING_RESUMED
+    elif state == WAITING_RESUMED:
+        show_resumed(msg)
+    elif state == WAITING_SCORE:
+        answer_deadline = None
+        score_response = decoder.decode(msg)
+        new_score = int(score_response['score'])
+        # Write the new score, with the rank among all the players when the server runs several processes
+        window.set_score(new_score, score_response.get('rank'), score_response.get('players'))
+        window.clear_quiz_listbox()
+        state = WAITING_QUESTIONS
+    else:
+        print(f"Unexpected message while {state}: {msg}")
+
+
+def control_receive(msg: str):
+    """Handler of the control channel, the server replies to the negotiations with the encoding and the
+    compression it uses, gives the token of the session once the player has joined, pings the client when it
+    has been silent and tells it why it is disconnected when it does not answer in time"""
+    global session_token
+    command, _, argument = msg.partition(" ")
+    if command == SESSION_COMMAND:
+        session_token = argument
+    elif command == PING:
+        cu.send_message(client_socket, PONG, CHANNEL_CONTROL)
+    elif command == CLOCK_COMMAND:
+        receive_clock(argument)
+    elif command == TIMEOUT_COMMAND:
+        # The player has been removed from the game, there is no session to resume
+        session_token = None
+        window.push_client_message(f"You took too long to pick your {argument}, you have been disconnected")
+    else:
+        print(f"Server: {msg}")
+
+
+def receive_clock(argument: str):
+    """Synchronize the countdown with a clock message of the server
+
+    The reply to a clock request gives the offset of the local clock from the one of the server, assuming the
+    server read its time halfway through the round trip. Every countdown tick of the round asks for a new reply,
+    so the offset follows the drift of the clocks.
+    """
+    global clock_offset, match_deadline, answer_deadline
+    try:
+        server_time, kind, value = parse_clock(argument)
+    except ValueError:
+        print(f"Server: CLOCK {argument}")
+        return
+    now = time()
+    if kind == CLOCK_SYNC:
+        clock_offset = server_time - (value + now) / 2
+    elif kind == DEADLINE_MATCH:
+        if clock_offset is None:
+            # Good enough until the reply to the clock request arrives
+            clock_offset = server_time - now
+        match_deadline = value
+        cu.send_message(client_socket, clock_request(), CHANNEL_CONTROL)
+    elif kind == DEADLINE_ANSWER:
+        answer_deadline = value
+    update_countdown()
+
+
+def update_countdown():
+    """Show the time left before the end of the round, and before the deadline of the answer"""
+    if match_deadline is None or clock_offset is None:
         return
+    server_now = time() + clock_offset
+    left = max(0, int(match_deadline - server_now))
+    text = f"Time left: {left // 60}:{left % 60:02d}"
+    if answer_deadline is not None and state in (CHOOSING_CHOICE, WAITING_SCORE):
+        answer_left = ceil(answer_deadline - server_now)
+        text += f", answer within {answer_left}s" if answer_left > 0 else ", the time to answer is over"
+    window.set_countdown(text)
+
+
+def countdown_ticker():
+    """Refresh the countdown every `COUNTDOWN_REFRESH` milliseconds"""
+    update_countdown()
+    window.after(COUNTDOWN_REFRESH, countdown_ticker)
+
+
+def connection_closed():
+    """Called when the connection breaks, the session of a player that has joined is resumed"""
+    global state
+    if session_token is not None and state != ENDED:
+        print("Lost the connection, resuming the session")
+        client_socket.close()
+        state = RESUMING
+        window.after(RECONNECT_DELAY, reconnect, RECONNECT_ATTEMPTS)
+        return
+    print("Closed the connection")
+    state = ENDED
+    window.disable_inputs()
 
-    with selection_cond_variable:
-        game_loop = True
 
-    first_run = True
+def reconnect(attempts: int):
+    """Connect again and ask the server to resume the session, retrying while the server is unreachable"""
+    global state, resume_attempts
+    if state != RESUMING:
+        return
+    resume_attempts = attempts - 1
+    try:
+        connect(f"{RESUME_COMMAND} {session_token}")
+    except OSError:
+        if attempts > 1:
+            window.after(RECONNECT_DELAY, reconnect, attempts - 1)
+            return
+        print("Cannot reach the server")
+        state = ENDED
+        window.disable_inputs()
 
-    # Game loop
-    while True:
-        try:
-            # Checks for the received message
-            if len(received_message) == 3 and first_run:
-                questions = json.loads(received_message[2])
-                first_run = False
-            elif len(received_message) == 2 and first_run:
-                questions = json.loads(received_message[1])
-                first_run = False
-            else:
-                questions = json.loads(cu.read_message(client_socket)[0])
-
-            question_response, selected_question = manage_questions(questions)
-            if question_response is None:
-                continue
-            if question_response["status"] == "LOST":
-                break
-
-            window.clear_quiz_listbox()
-            window.push_client_message(f"Question: \n{selected_question}")
-            # If a not-trick question has been chosen
-            # Retrieve the choices
-            choices = question_response["choices"]
-            manage_choices(choices)
-        except OSError:
-            print("Closed the connection")
-            break
 
+def show_resumed(msg: Payload):
+    """Restore the role, the score and the round of a resumed session, or join again if it has expired"""
+    global state, session_token, selected_question_text
+    if msg == RESUME_FAILED and resume_attempts > 0:
+        # The server may not have noticed yet that the previous connection broke
+        reader.stop()
+        client_socket.close()
+        state = RESUMING
+        window.after(RECONNECT_DELAY, reconnect, resume_attempts)
+        return
+    restart_game()
+    if msg == RESUME_FAILED:
+        # The server waits for a name, like for a new player
+        session_token = None
+        window.push_client_message("Your session has expired, write your name to join again")
+        state = TYPING_NAME
+        return
+    resumed = decoder.decode(msg)["RESUMED"]
+    window.set_role(resumed["role"])
+    window.set_score(resumed["score"])
+    window.push_broadcast_message("Connection restored")
+    if resumed["question"] is not None:
+        # The player had picked a question, the server sends its choices again
+        selected_question_text = resumed["question"]
+        state = WAITING_CHOICES
+    else:
+        state = WAITING_QUESTIONS
 
-def manage_questions(questions: List[str]):
-    """Manage the loading/selection of the question to answer
+
+def show_questions(questions: List[Tuple[int, str]]):
+    """Show the questions of a round and wait for the user to pick one
 
     Parameters
     ----------
-    questions : list[str]
-        list of strings containing the questions
-
-    Returns
-    -------
-    Any
-        question response that contains a status and the choices(list of strings)
+    questions : list[tuple[int, str]]
+        list of pairs of question id and question text
     """
+    global state, round_questions
+    round_questions = questions
     # Show the questions message
     window.push_client_message("Questions")
     # Show the alternatives
-    show_alternatives(questions)
-    with selection_cond_variable:
-        # Wait for the notification that a new message has been typed
-        selection_cond_variable.wait()
-    # Retrieve the selected question
-    selected_question = window.peek_message()
+    show_alternatives([text for _, text in questions])
+    state = CHOOSING_QUESTION
+
+
+def select_question(selected_question: str):
+    """Send the question typed by the user
+
+    Parameters
+    ----------
+    selected_question : str
+        number of the question in the list shown to the user
+    """
+    global state, selected_question_text
     # Perform a check in order to have a valid question number
-    if selected_question.isnumeric():
-        numeric_selected_question = int(selected_question) - 1
-        if numeric_selected_question < 0 or numeric_selected_question >= len(questions):
-            client_socket.send(bytes("VALIDATION ERROR", "utf8"))
-            showerror("Invalid question number", "You typed an invalid question number")
-            print("Invalid question number")
-            restart_game()
-            return None, None
-    else:
-        client_socket.send(bytes("VALIDATION ERROR", "utf8"))
-        showerror("Invalid answer", "The answer must be a number")
+    if not selected_question.isnumeric():
+        reject_selection("Invalid answer", "The answer must be a number")
         print("Question number must be a number")
-        restart_game()
-        return None, None
+        return
+    numeric_selected_question = int(selected_question) - 1
+    if numeric_selected_question < 0 or numeric_selected_question >= len(round_questions):
+        reject_selection("Invalid question number", "You typed an invalid question number")
+        print("Invalid question number")
+        return
     # Reset the text field
     window.reset_field()
     # Get the selected question
-    selected_question_name = questions[int(selected_question) - 1]
-    # Send the selected question to the server
-    client_socket.send(bytes(selected_question_name, "utf8"))
-    # Wait for a response that contains a status
-    response = cu.read_message(client_socket)
-    # Parse the first argument of the response that is a json that indicates the status
-    question_response = json.loads(response[0])
+    selected_question_id, selected_question_text = round_questions[numeric_selected_question]
+    state = WAITING_CHOICES
+    # Send the id of the selected question to the server
+    cu.send_message(client_socket, str(selected_question_id))
+
+
+def show_choices(question_response: Dict[str, Any]):
+    """Show the choices of the selected question, or end the game if it was a trick question
+
+    Parameters
+    ----------
+    question_response : dict
+        question response that contains a status and the choices(list of strings)
+    """
+    global state, round_choices
     # LOST status means that a TRICK question has been chosen
     if question_response["status"] == "LOST":
+        state = ENDED
         print("You got a trick question")
         showerror("Lost due to a trick question", "You got a trick question, you lost")
         window.close_window()
-        return question_response, selected_question_name
-
-    # If the user didn't pick a trick question, return the question response
-    return question_response, selected_question_name
-
+        return
 
-def manage_choices(choices: List[str]):
+    window.clear_quiz_listbox()
+    window.push_client_message(f"Question: \n{selected_question_text}")
+    # If a not-trick question has been chosen
+    # Retrieve the choices
+    round_choices = question_response["choices"]
     # Show the choices message
     window.push_client_message("Choices")
     # Show the alternatives
-    show_alternatives(choices)
-    with selection_cond_variable:
-        # Wait for the notification that a new message has been typed
-        selection_cond_variable.wait()
-    # Retrieve the selected choice
-    selected_choice = window.peek_message()
+    show_alternatives(round_choices)
+    state = CHOOSING_CHOICE
+
+
+def select_choice(selected_choice: str):
+    """Send the choice typed by the user
+
+    Parameters
+    ----------
+    selected_choice : str
+        number of the choice in the list shown to the user
+    """
+    global state
     # Perform a check in order to have a valid choice number
-    if selected_choice.isnumeric():
-        numeric_selected_choice = int(selected_choice) - 1
-        if numeric_selected_choice < 0 or numeric_selected_choice >= len(choices):
-            client_socket.send(bytes("VALIDATION ERROR", "utf8"))
-            showerror("Invalid choice number", "You typed an invalid choice number")
-            print("Invalid choice number")
-            restart_game()
-            return
-    else:
-        client_socket.send(bytes("VALIDATION ERROR", "utf8"))
-        showerror("Invalid answer", "The answer must be a number")
+    if not selected_choice.isnumeric():
+        reject_selection("Invalid answer", "The answer must be a number")
         print("Choice number must be a number")
-        restart_game()
+        return
+    numeric_selected_choice = int(selected_choice) - 1
+    if numeric_selected_choice < 0 or numeric_selected_choice >= len(round_choices):
+        reject_selection("Invalid choice number", "You typed an invalid choice number")
+        print("Invalid choice number")
         return
     # Reset the text field
     window.reset_field()
-    # Send the selected choice to the server
-    client_socket.send(bytes(choices[int(selected_choice) - 1], "utf8"))
-    # Wait for a response that contains the new score
-    response = cu.read_message(client_socket)
-    new_score = int(json.loads(response[0])['score'])
-    # Write the new score
-    window.set_score(new_score)
-    window.clear_quiz_listbox()
+    state = WAITING_SCORE
+    # Send the index of the selected choice to the server
+    cu.send_message(client_socket, str(numeric_selected_choice))
+
+
+def reject_selection(title: str, message: str):
+    """Tell the server that the user typed an invalid number, it answers with a new round of questions"""
+    global state
+    # The new round can arrive while the error dialog is open, so the client is ready for it first
+    restart_game()
+    state = WAITING_QUESTIONS
+    cu.send_message(client_socket, "VALIDATION ERROR")
+    showerror(title, message)
 
 
 def restart_game():
@@ -231,25 +376,56 @@ def show_alternatives(elems: List[Any]):
 
 def send_to_server(event=None):
     """Function for sending messages to the server"""
-    global game_loop
+    global state
     msg = window.peek_message()
     if msg == "{quit}":
-        client_socket.send(bytes(msg, "utf8"))
+        state = ENDED
+        reader.stop()
+        try:
+            cu.send_message(client_socket, msg)
+        except OSError:
+            # The server already closed the connection
+            pass
         client_socket.close()
         window.quit()
         return
 
-    with selection_cond_variable:
-        if game_loop:
-            # Notify the Condition Variable
-            selection_cond_variable.notify(1)
-        else:
-            # Invalid values for a message
-            if msg != 'BROADCAST' and msg != 'LEADERBOARD':
-                client_socket.send(bytes(msg, "utf8"))
-                window.reset_field()
-            else:
-                showerror("Invalid name", "You typed an invalid name. Invalid names are 'BROADCAST' and 'LEADERBOARD'")
+    if state == TYPING_NAME:
+        cu.send_message(client_socket, msg)
+        window.reset_field()
+        state = WAITING_WELCOME
+    elif state == CHOOSING_QUESTION:
+        select_question(msg)
+    elif state == CHOOSING_CHOICE:
+        select_choice(msg)
+    # In the other states the client waits for the server and the input is kept in the field
+
+
+def connect(first_message: Optional[str] = None):
+    """Open the connection to the server and start reading it from the main loop
+
+    The encoding and the compression are negotiated before subscribing, so the first leaderboard already uses
+    them. `first_message` is written on the game channel before subscribing, the subscriptions of a resumed
+    session are scoped to its room.
+    """
+    global client_socket, reader
+    # A single connection carries every channel, it is read by the main loop
+    client_socket = cu.create_multiplexed_socket(ADDRESS)
+    reader = TkChannelReader(window, client_socket, {
+        CHANNEL_GAME: client_receive,
+        CHANNEL_BROADCAST: broadcast_receive,
+        CHANNEL_LEADERBOARD: leaderboard_receive,
+        CHANNEL_CONTROL: control_receive
+    }, connection_closed, dictionary)
+    cu.send_message(client_socket, f"{ENCODING_REQUEST} {args.encoding}", CHANNEL_CONTROL)
+    cu.send_message(client_socket, clock_request(), CHANNEL_CONTROL)
+    if dictionary is not None:
+        cu.send_message(client_socket, compression_request(dictionary), CHANNEL_CONTROL)
+    if first_message is not None:
+        cu.send_message(client_socket, first_message)
+    cu.send_message(client_socket, SUBSCRIBE_MESSAGE, CHANNEL_BROADCAST)
+    cu.send_message(client_socket, SUBSCRIBE_MESSAGE, CHANNEL_LEADERBOARD)
+    reader.start()
 
 
 DEFAULT_PORT = 53000
@@ -258,24 +434,45 @@ DEFAULT_HOST = 'localhost'
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('-host', '--host', type=str, default=DEFAULT_HOST, help='Server host name')
 parser.add_argument('-port', '--port', type=int, default=DEFAULT_PORT, help='Port of the server')
+parser.add_argument('-history', '--history', type=int, default=DEFAULT_BROADCAST_HISTORY,
+                    help='Broadcast messages kept, the oldest ones are dropped')
+parser.add_argument('-encoding', '--encoding', choices=ENCODINGS, default=ENCODING_BINARY,
+                    help='Encoding of the structured messages sent by the server, json is easier to debug')
+parser.add_argument('-compression', '--compression', choices=COMPRESSIONS, default=COMPRESSION_ZLIB,
+                    help='Ask the server to compress the large messages, with a dictionary built from the questions')
+parser.add_argument('-questions', '--questions', type=str, default='questions.json',
+                    help='Questions file the compression dictionary is built from, the same one of the server')
 args = parser.parse_args()
 
-# Sync objects
-selection_cond_variable = Condition()
+state = WAITING_INSTRUCTIONS
+# Questions of the current round, choices of the selected question and its text
+round_questions: List[Tuple[int, str]] = []
+round_choices: List[str] = []
+selected_question_text = ""
 
-game_loop = False
+window = TkinterApplication(send_to_server, args.history)
+leaderboard_model = cu.LeaderboardModel()
+# Decoder of the structured messages, it keeps the names of the leaderboard players sent by the server
+decoder = PayloadDecoder()
+# Text of the questions received from the server, by id
+question_texts: Dict[int, str] = {}
 
-window = TkinterApplication(send_to_server)
+# Without the questions file the compression cannot be negotiated
+dictionary = cu.load_compression_dictionary(args.questions) if args.compression == COMPRESSION_ZLIB else None
 
-BUFFER_SIZE = 1024
 ADDRESS = (args.host, args.port)
-
-client_socket, client_socket_thread = cu.create_socket_thread(ADDRESS, client_receive)
-client_socket_thread.start()
-broadcast_socket, broadcast_socket_thread = cu.create_socket_thread(ADDRESS, broadcast_receive)
-broadcast_socket_thread.start()
-leaderboard_socket, leaderboard_socket_thread = cu.create_socket_thread(ADDRESS, leaderboard_receive)
-leaderboard_socket_thread.start()
+# Token of the session given by the server once the player has joined, used to resume it
+session_token: Optional[str] = None
+# Attempts left to resume the session after the current one
+resume_attempts = 0
+# Seconds to add to the local clock to read the one of the server, None until the server sends its time
+clock_offset: Optional[float] = None
+# Server times of the end of the round and of the deadline of the current answer
+match_deadline: Optional[float] = None
+answer_deadline: Optional[float] = None
+
+connect()
+countdown_ticker()
 
 # Start the app
 tkt.mainloop()
@@ -1,248 +1,1230 @@
-from collections import OrderedDict, defaultdict
-from socket import AF_INET, socket, SOCK_STREAM
-from threading import Thread, Timer
-import json
-from random import sample, choice
-from typing import Dict, Tuple, List
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from asyncio import StreamReader, StreamWriter
+from concurrent.futures import Future
+from socket import (AF_INET, socket, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT, IPPROTO_TCP, TCP_NODELAY,
+                    SHUT_RD, SHUT_RDWR)
+import threading
+from threading import Thread
+from time import perf_counter, sleep, time
+from random import choice
+from typing import List, Optional, Set, Tuple
 from traceback import print_exc
+from protocol import (AsyncMessageReader, Frame, FrameCompressor, MessageReader, ProtocolError, encode_frame,
+                      CHANNEL_CONTROL, CHANNEL_GAME, DEFAULT_COMPRESSION_THRESHOLD)
+from fanout import AsyncFanoutEngine, FanoutEngine, DEFAULT_MAX_QUEUE, SLOW_CONSUMER_POLICIES
+import codec
+from codec import (CLOCK_COMMAND, CLOCK_SYNC, COMPRESSION_NONE, COMPRESSION_REQUEST, DEADLINE_ANSWER, DEADLINE_MATCH,
+                   ENCODING_JSON, ENCODING_REQUEST, ENCODINGS, PIPELINE_REQUEST, Payload, compression_request)
+import metrics
+from event_log import DEFAULT_COMMIT_INTERVAL, DEFAULT_SNAPSHOT_EVERY, EventLog, LogState, replay
+from question_bank import DEFAULT_RELOAD_INTERVAL, ROLES, BankWatcher, QuestionBank
+from reaper import (DEFAULT_CHOICE_TIMEOUT, DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_IDLE_TIMEOUT, DEFAULT_NAME_TIMEOUT,
+                    DEFAULT_QUESTION_TIMEOUT, IDLE, PHASE_CHOICE, PHASE_NAME, PHASE_QUESTION, PING, PONG,
+                    TIMEOUT_COMMAND, ConnectionReaper)
+from rooms import DEFAULT_ANSWER_BATCH_INTERVAL, DEFAULT_COUNTDOWN_TICK, AsyncWorker, Room, RoomScheduler, TimerWorker
+from pubsub import LOOPBACK, Broker, BrokerBus, Bus, LoopbackBus, parse_bus_address
+from shared_leaderboard import SharedLeaderboard
+from sessions import DEFAULT_SESSION_TTL, RESUME_COMMAND, RESUME_FAILED, SESSION_COMMAND, Session, SessionTable
+from state_store import PlayerRecord, StateStore
 
 
-def accept_incoming_connections():
+def accept_incoming_connections(server: socket):
     """Handle incoming connections to the server"""
     while True:
-        client, client_address = SERVER.accept()
+        client, client_address = server.accept()
         print(f"{client}:{client_address} joined.")
+        # Small frames are written as soon as they are queued, instead of waiting for the acknowledgments
+        client.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        # Every connection is placed in a room as soon as it is accepted, its subscriptions are scoped to it
+        room = scheduler.reserve()
+        players.add(PlayerRecord(client, client_address, room))
+        fanout.register(client)
+        reaper.watch(client, PHASE_NAME)
         socket_send(client, "Write your name, then press Return or click the Send button to join!")
-        addresses[client] = client_address
         # A thread for each client
-        Thread(target=client_handler, args=(client,)).start()
+        Thread(target=client_handler, args=(client, room)).start()
 
 
-def client_handler(client: socket):
+def client_handler(client: socket, room: Room):
     """Handles a single client"""
-    name = client.recv(BUFFER_SIZE).decode("utf8")
-    if name == "BROADCAST":
-        broadcast_clients.append(client)
-        return
+    reader = MessageReader(client)
+    session = None
+    while session is None:
+        try:
+            name = receive_game_message(client, reader, room)
+        except OSError:
+            name = "{quit}"
 
-    if name == "LEADERBOARD":
-        leaderboard_clients.append(client)
-        broadcast_leaderboard()
-        return
+        if name == "{quit}":
+            # Here the client closes the application before writing its name
+            release_connection(client)
+            client.close()
+            return
 
-    if name == "{quit}":
-        # Here the client closes the application before writing its name
-        return
+        if name.startswith(RESUME_COMMAND):
+            session = resume_session(client, name[len(RESUME_COMMAND):].strip())
+            if session is None:
+                # The client writes its name instead
+                reaper.enter_phase(client, PHASE_NAME)
+                socket_send(client, RESUME_FAILED)
+                continue
+            # The subscriptions following the resumption are scoped to the room of the session
+            room = session.room
+            record = players.get(client)
+            socket_send(client, resumed_message(session, client, record.encoding))
+            socket_send(client, codec.clock_message(DEADLINE_MATCH, room.deadline), CHANNEL_CONTROL)
+            break
+
+        # Welcomes the new user
+        welcome_message = f"Welcome {name}! You joined the room {room.room_id}. If you want to quit, write {{quit}}."
+        socket_send(client, welcome_message)
+        # Get a random role
+        role = {"role": choice(ROLES)}
+        record = players.update(client, name=name, role=role["role"])
+        # Send the role
+        socket_send(client, codec.role_message(role["role"], record.encoding))
+        socket_send(client, f"Your role is: {role['role']}")
+        msg = f"{name} joined the chat with the role {role['role']}!"
+        # Broadcast to all the users of the room that a new user just joined the chat
+        room.broadcast(msg)
+        # Updates the players of the room
+        room.join(client, name)
+        room.broadcast_leaderboard()
+        session = sessions.create(name, role["role"], room)
+        session.connection = client
+        if sessions.ttl > 0:
+            socket_send(client, f"{SESSION_COMMAND} {session.token}", CHANNEL_CONTROL)
+        socket_send(client, codec.clock_message(DEADLINE_MATCH, room.deadline), CHANNEL_CONTROL)
 
-    # Welcomes the new user
-    welcome_message = f"Welcome {name}! If you want to quit, write {{quit}}."
-    socket_send(client, welcome_message)
-    # Get a random role
-    role = {"role": choice(roles)}
-    # Send the role
-    socket_send(client, json.dumps(role))
-    socket_send(client, f"Your role is: {role['role']}")
-    msg = f"{name} joined the chat with the role {role['role']}!"
-    # Broadcast to all the users that a new user just joined the chat
-    broadcast(msg)
-    # Updates the client dictionary
-    clients[client] = name
-    score[client] = 0
-    broadcast_leaderboard()
-
-    # Game loop
+    name = session.name
+    # The rounds in flight of a resumed pipelined session are sent again on the new connection
+    resend_rounds = True
+    # Game loop, a resumed session continues the round it was playing
     while True:
-        # Shuffle the questions
-        shuffled_questions = sample(questions_obj["questions"], len(questions_obj["questions"]))
-        # Get 3 of these shuffled questions
-        all_questions = shuffled_questions[:3]
-        # Map each question object to only the question name
-        questions = list(map(lambda q: q["question"], all_questions))
-        # Get the trick question
-        trick_question = choice(all_questions)
         try:
-            socket_send(client, json.dumps(questions))
-            received_question = client.recv(BUFFER_SIZE).decode("utf8")
-            # Check if there was a validation error
-            if received_question == "VALIDATION ERROR":
+            if record.pipeline > 0:
+                for message in pipelined_rounds(session, record, resend_rounds):
+                    socket_send(client, message)
+                resend_rounds = False
+                if answer_time > 0:
+                    socket_send(client, answer_clock(session), CHANNEL_CONTROL)
+                reaper.enter_phase(client, PHASE_CHOICE)
+                answered = pipelined_answer(session, receive_game_message(client, reader, room))
+                if answered is None:
+                    socket_send(client, codec.lost_message(record.encoding))
+                    room.broadcast(f"{name} have been tricked")
+                    drain_connection(reader)
+                    fanout.close(client)
+                    user_quit(room, client, name)
+                    return
+                question_id, won, in_time = answered
+                # A late round has been scored as lost at its deadline
+                new_score = commit_answer(room, client, question_id, won) if in_time else room.leaderboard.score(client)
+                socket_send(client, score_message(room, client, new_score, record.encoding))
                 continue
-            # Check if the client got the trick question
-            if received_question == trick_question["question"]:
-                socket_send(client, json.dumps({"status": "LOST"}))
-                broadcast(f"{name} have been tricked")
-                client.close()
-                user_quit(client, name)
-                return
 
-            question_to_answer = next(q for q in all_questions if q["question"] == received_question)
-            socket_send(client, json.dumps({"status": "NOT_LOST", "choices": question_to_answer["choices"]}))
-            received_choice = client.recv(BUFFER_SIZE).decode("utf8")
+            if session.picked is None:
+                dispatch_started = perf_counter()
+                if session.question_ids is None:
+                    # Get 3 random questions and the trick one
+                    session.new_round(*draw_round())
+                socket_send(client, session.bank.questions_message(session.question_ids,
+                                                                   seen_questions(record, session.bank),
+                                                                   record.encoding))
+                QUESTION_DISPATCH_SECONDS.observe(perf_counter() - dispatch_started)
+                reaper.enter_phase(client, PHASE_QUESTION)
+                received_question = receive_game_message(client, reader, room)
+                # Check if there was a validation error
+                if received_question == "VALIDATION ERROR":
+                    session.end_round()
+                    continue
+                question_id = parse_picked_question(received_question, session.question_ids)
+                # Check if the client got the trick question
+                if question_id == session.trick_question:
+                    socket_send(client, codec.lost_message(record.encoding))
+                    room.broadcast(f"{name} have been tricked")
+                    # Close the socket once the LOST status has been written
+                    fanout.close(client)
+                    user_quit(room, client, name)
+                    return
+                session.picked = question_id
+
+            question_to_answer = session.bank.get(session.picked)
+            # The choices are encoded when the bank is loaded
+            socket_send(client, question_to_answer.choices_message(record.encoding))
+            if answer_time > 0:
+                socket_send(client, answer_clock(session), CHANNEL_CONTROL)
+            reaper.enter_phase(client, PHASE_CHOICE)
+            received_choice = receive_game_message(client, reader, room)
             # Check for UI validation error
             if received_choice == "VALIDATION ERROR":
+                session.end_round()
                 continue
 
-            won = False
-            # Check if the right answer has been chosen
-            if received_choice == question_to_answer["right_answer"]:
-                won = True
-                score[client] = score[client] + 1
-            else:
-                score[client] = score[client] - 1
-
-            broadcast(f"{name} {'got' if won else 'lost'} a point, its current score is {score[client]}")
-            broadcast_leaderboard()
-            socket_send(client, json.dumps({"score": score[client]}))
+            # Check if the right answer has been chosen, the client sends the index of its choice
+            won = int(received_choice) == question_to_answer.right_answer_index
+            question_id = session.picked
+            if not session.end_round():
+                # Too late, the question has been scored as lost at its deadline
+                socket_send(client, score_message(room, client, room.leaderboard.score(client), record.encoding))
+                continue
+            new_score = commit_answer(room, client, question_id, won)
+            socket_send(client, score_message(room, client, new_score, record.encoding))
         except (ConnectionResetError, ConnectionAbortedError):
             # Here the client already closed its socket
             # so this Error is raised because socket.close() cannot be performed
             print("Connection reset")
-            user_quit(client, name)
+            # A connection released by the reaper is closed by the fan-out engine, once its timeout is written
+            if park_session(room, client, session):
+                client.close()
             break
-        except StopIteration:
+        except ValueError:
             print(f"{name} quit the application when answering a question")
-            user_quit(client, name)
+            if user_quit(room, client, name):
+                client.close()
             break
         except Exception:
             print_exc()
-            user_quit(client, name)
+            if user_quit(room, client, name):
+                client.close()
             break
 
 
-def broadcast(message: str, prefix=""):
-    """Broadcast a message to all the clients"""
-    broadcast_to_delete = []
-    for user in broadcast_clients:
-        try:
-            socket_send(user, prefix + message)
-        except ConnectionResetError:
-            broadcast_to_delete.append(user)
-            print("A broadcast disconnected")
-
-    for user in broadcast_to_delete:
-        broadcast_clients.remove(user)
-        del addresses[user]
-
-    if message == "TIMER ENDED":
-        # If the broadcast message says TIMER ENDED then broadcast
-        # To the leaderboard socket the winner
-        ordered_leaderboard = order_leaderboard()
-        # Group the leaderboard by value
-        leaderboard_by_value = defaultdict(list)
-        for key, val in sorted(ordered_leaderboard.items()):
-            leaderboard_by_value[val].append(key)
-        if len(leaderboard_by_value.keys()) == 0:
-            return
-        leaderboard_by_value = OrderedDict((k, v) for k, v in sorted(leaderboard_by_value.items(),
-                                                                     key=lambda item: item[0],
-                                                                     reverse=True))
-        winner_score = next(iter(leaderboard_by_value))
-        winner_list = leaderboard_by_value[winner_score]
-        if len(winner_list) == 1:
-            winner = {
-                "winner_name": winner_list[0],
-                "winner_score": winner_score
-            }
+def parse_picked_question(received_question: str, question_ids: List[int]) -> int:
+    """Id of the question picked by the client
+
+    Raises
+    ------
+    ValueError
+        if the message is not the id of one of the questions of the round
+    """
+    question_id = int(received_question)
+    if question_id not in question_ids:
+        raise ValueError(f"Question {question_id} is not part of the round")
+    return question_id
+
+
+def draw_round() -> Tuple[List[int], int, QuestionBank]:
+    """Questions of a new round and its trick question, with the version of the bank they come from"""
+    # Read once, a reload may swap the bank in the meantime
+    bank = question_bank
+    return (*bank.new_round(), bank)
+
+
+def seen_questions(record: PlayerRecord, bank: QuestionBank) -> Set[int]:
+    """Ids of the questions of `bank` whose text the client already has
+
+    The ids of another version of the bank may denote other questions, so the texts are sent again after a
+    reload.
+    """
+    if record.seen_generation != bank.generation:
+        record.seen_questions = set()
+        record.seen_generation = bank.generation
+    return record.seen_questions
+
+
+def swap_question_bank(bank: QuestionBank):
+    """Invoked by the bank watcher with a new version of the bank, the next rounds are drawn from it
+
+    The rounds in progress keep the previous version, which is released once the last of them ends. The
+    compression dictionary stays the one of the first version, that the clients have built.
+    """
+    global question_bank
+    question_bank = bank
+    print(f"Reloaded the question bank, {len(bank)} questions")
+
+
+def pipelined_rounds(session: Session, record: PlayerRecord, resend: bool = False) -> List[Payload]:
+    """Messages of the rounds to send ahead to a pipelined client, drawing rounds until `record.pipeline` of
+    them wait for an answer
+
+    Parameters
+    ----------
+    session : Session
+        session of the player, its current round is the oldest one sent
+    record : PlayerRecord
+        record of the connection, with the negotiated depth and the questions the client has
+    resend : bool
+        whether the rounds already drawn are sent again, for a new connection
+    """
+    dispatch_started = perf_counter()
+    # (question ids, bank) of the rounds to send
+    rounds = []
+    if resend:
+        if session.question_ids is not None:
+            rounds.append((session.question_ids, session.bank))
+        rounds.extend((question_ids, bank) for question_ids, _, bank in session.rounds_ahead)
+    if session.question_ids is None:
+        session.new_round(*draw_round())
+        rounds.append((session.question_ids, session.bank))
+    while len(session.rounds_ahead) + 1 < record.pipeline:
+        session.rounds_ahead.append(draw_round())
+        rounds.append((session.rounds_ahead[-1][0], session.rounds_ahead[-1][2]))
+    messages = [bank.round_message(question_ids, seen_questions(record, bank), record.encoding)
+                for question_ids, bank in rounds]
+    if messages:
+        QUESTION_DISPATCH_SECONDS.observe(perf_counter() - dispatch_started)
+    return messages
+
+
+def pipelined_answer(session: Session, message: str) -> Optional[Tuple[int, bool, bool]]:
+    """Judge the answer of a pipelined client to its oldest round, then move to the next round
+
+    The client picks the question and its choice locally, the server still decides whether it is the trick
+    question and scores it.
+
+    Parameters
+    ----------
+    message : str
+        "<question id> <choice index>"
+
+    Returns
+    -------
+    tuple[int, bool, bool] | None
+        the question answered, whether the answer is right and whether it came in time, None if the client
+        picked the trick question
+
+    Raises
+    ------
+    ValueError
+        if the message is malformed or the question is not part of the round
+    """
+    picked, _, answer = message.partition(" ")
+    question_id = parse_picked_question(picked, session.question_ids)
+    if question_id == session.trick_question:
+        return None
+    won = int(answer) == session.bank.get(question_id).right_answer_index
+    in_time = session.end_round()
+    session.next_round()
+    return question_id, won, in_time
+
+
+def commit_answer(room: Room, client, question_id: int, won: bool) -> int:
+    """Hand an answer to the answer stage of the room and wait for its batch to be committed
+
+    Returns
+    -------
+    int
+        the updated score
+
+    Raises
+    ------
+    ConnectionResetError
+        if the player has left the room before its answer was committed
+    """
+    scored = Future()
+    room.submit_answer(client, question_id, won, scored.set_result)
+    new_score = scored.result()
+    if new_score is None:
+        raise ConnectionResetError("The player left the room before its answer was committed")
+    return new_score
+
+
+def drain_connection(reader: MessageReader):
+    """Read and drop the frames of a pipelined client that picked the trick question, until it closes the
+    connection
+
+    The client may have streamed answers past the trick question, and closing a socket with unread data resets
+    the connection, which can discard the LOST status before the client reads it. The reaper bounds the wait
+    with the deadline of the current phase.
+    """
+    try:
+        while True:
+            read_frame(reader)
+    except (OSError, ProtocolError):
+        pass
+
+
+def read_frame(reader: MessageReader) -> Frame:
+    """Read the next frame of a client, recording how long it was awaited and the bytes received"""
+    received_before = reader.bytes_received
+    started = perf_counter()
+    frame = reader.read_frame()
+    RECV_SECONDS.observe(perf_counter() - started)
+    BYTES_IN.inc(reader.bytes_received - received_before)
+    return frame
+
+
+def receive_game_message(client: socket, reader: MessageReader, room: Room) -> str:
+    """Wait for the next message of the game channel, handling the subscriptions and the negotiations received
+    in the meantime"""
+    while True:
+        channel, message = read_frame(reader)
+        reaper.touch(client)
+        if channel == CHANNEL_GAME:
+            return message
+        if channel == CHANNEL_CONTROL:
+            reply = negotiate(client, message)
+            if reply is not None:
+                socket_send(client, reply, CHANNEL_CONTROL)
         else:
-            winner = list(map(lambda elem: {"winner_name": elem, "winner_score": winner_score}, winner_list))
+            # A new leaderboard subscriber receives the current leaderboard of the room
+            room.subscribe(channel, client, players.get(client).encoding)
+
+
+def negotiate(client, request: str) -> Optional[str]:
+    """Apply a request of the control channel, the reply tells the client what the server will do
+
+    "ENCODING <encoding>" selects the encoding of the structured messages, it has to be sent before subscribing
+    to the leaderboard. An unknown encoding is answered with the json one.
+    "COMPRESSION zlib <dictionary id>" compresses the large frames if the client built the same preset
+    dictionary as the server, otherwise the reply is "COMPRESSION none".
+    "PING" is answered with "PONG", and the "PONG" answering a ping of the server has no reply.
+    "CLOCK <client time>" is answered with the time of the server and the time of the client, for the client to
+    synchronize its countdowns.
+    "PIPELINE <depth>" asks for `depth` rounds sent ahead, at most `max_pipeline`, 0 for a round trip at each
+    step. It has to be sent before the name, the reply gives the depth applied.
+    """
+    command, _, argument = request.partition(" ")
+    if command == PONG:
+        return None
+    if command == PING:
+        return PONG
+    if command == CLOCK_COMMAND:
+        try:
+            return codec.clock_message(CLOCK_SYNC, float(argument))
+        except ValueError:
+            pass
+    if command == ENCODING_REQUEST:
+        encoding = argument if argument in ENCODINGS else ENCODING_JSON
+        players.update(client, encoding=encoding)
+        return f"{ENCODING_REQUEST} {encoding}"
+    if command == PIPELINE_REQUEST:
+        record = players.get(client)
+        if record.name is None:
+            try:
+                depth = max(0, min(int(argument), max_pipeline))
+            except ValueError:
+                depth = 0
+            record = players.update(client, pipeline=depth)
+        return f"{PIPELINE_REQUEST} {record.pipeline}"
+    if command == COMPRESSION_REQUEST:
+        enabled = compressor is not None and request == compression_request(compressor.dictionary)
+        record = players.update(client, compressor=compressor if enabled else None)
+        record.room.fanout.set_compressor(client, record.compressor)
+        return f"{COMPRESSION_REQUEST} {argument if enabled else COMPRESSION_NONE}"
+    return f"UNKNOWN {command}"
+
+
+def score_message(room: Room, client, new_score: int, encoding: str):
+    """Reply to an answer with the new score, and the rank among the players of every process if they share
+    the leaderboard"""
+    if shared_leaderboard is None:
+        return codec.score_message(new_score, encoding)
+    rank = shared_leaderboard.rank(room.room_id, room.leaderboard.player_id(client), new_score)
+    # The replica may not have received the player yet
+    return codec.score_message(new_score, encoding, rank, max(len(shared_leaderboard), rank))
+
+
+def publish_room_changes(room: Room, updated, removed):
+    """Forward the leaderboard changes of a room to the leaderboard shared by the cluster"""
+    shared_leaderboard.publish(room.room_id, updated, removed)
+
+
+def partial_leaderboard():
+    """Rows of every room hosted by the process, the partial leaderboard it gives to the cluster"""
+    return [(room.room_id, room.leaderboard.rows()) for room in scheduler.rooms()]
+
+
+def announce_winner(room: Room, winner):
+    """Tell the players of the whole cluster who won a room that has just ended"""
+    if winner is None:
+        return
+    winners = winner if isinstance(winner, list) else [winner]
+    names = ", ".join(entry["winner_name"] for entry in winners)
+    cluster_bus.publish(CLUSTER_BROADCAST_TOPIC, f"Room {room.room_id} has ended, {names} won with "
+                                                 f"{winners[0]['winner_score']} points")
+
+
+def relay_cluster_broadcast(message: str):
+    """Invoked by the bus with a broadcast of the cluster, relayed to the players of the open rooms of the
+    process"""
+    for room in scheduler.rooms():
+        if room.is_open:
+            # The fan-out engine of a room is only used on its worker
+            room.worker.call_soon(lambda room=room: room.broadcast(message))
+
+
+def leaderboard_ticker(worker):
+    """Flush the leaderboard deltas of the rooms of a worker, then schedule the next tick"""
+    for room in list(worker.rooms):
+        room.flush_leaderboard_deltas()
+    worker.schedule(leaderboard_tick, lambda: leaderboard_ticker(worker))
 
-        broadcast_leaderboard({"DECLARED_WINNER": winner})
+
+def socket_send(sock: socket, message, channel: int = CHANNEL_GAME):
+    """Send a framed message to the socket on the given channel"""
+    # Every write goes through the fan-out engine, so the frames of different threads never interleave
+    if not fanout.send(sock, message, channel):
+        raise ConnectionResetError("The connection has already been released")
+
+
+def release_connection(client) -> bool:
+    """Remove a connection from its room, unsubscribe it from every channel and forget its record
+
+    Returns
+    -------
+    bool
+        False if the connection had already been released
+    """
+    reaper.forget(client)
+    record = players.pop(client)
+    # Only the first of the concurrent releases of a connection gets its record
+    if record is None:
+        return False
+    record.room.leave(client)
+    record.room.fanout.unregister(client)
+    scheduler.release(record.room)
+    return True
+
+
+def answer_clock(session: Session) -> str:
+    """Start the answer deadline of the question picked by a player, the first time its choices are sent, and
+    return the clock message giving the deadline to the client"""
+    if session.answer_deadline is None:
+        session.answer_deadline = time() + answer_time
+        question_id = session.picked
+        session.answer_timer = session.room.worker.schedule(answer_time,
+                                                            lambda: answer_expired(session, question_id))
+    return codec.clock_message(DEADLINE_ANSWER, session.answer_deadline)
+
+
+def answer_expired(session: Session, question_id: int):
+    """Timer of an answer deadline, run by the worker of the room: the question has not been answered in time,
+    so it is lost even if the player never answers"""
+    room = session.room
+    # The leaderboard key of a parked session is the session itself
+    key = session.connection if session.connection is not None else session
+    # Committed with the next batch, a player that has left the room in the meantime is skipped
+    room.submit_answer(key, question_id, False, expired=True)
+
+
+def resumed_message(session: Session, client, encoding: str):
+    """Reply to a resumed session, with the text of the question picked in the current round if any"""
+    question = session.bank.get(session.picked).text if session.picked is not None else None
+    score = session.room.leaderboard.score(client)
+    return codec.resumed_message(session.name, session.role, score, question, encoding)
+
+
+def resume_session(client, token: str) -> Optional[Session]:
+    """Move a new connection into the parked session with the given token, None if it cannot be resumed
+
+    The session keeps its room, so the seat reserved for the connection is released and its subscriptions
+    are moved to the room of the session. In the asyncio mode a connection can only resume the sessions whose
+    room is served by its own event loop.
+    """
+    record = players.get(client)
+    if record is None:
+        return None
+    session = sessions.resume(token, lambda parked: parked.room.is_open and parked.room.fanout is record.room.fanout)
+    if session is None:
+        return None
+    reserved = record.room
+    players.update(client, room=session.room, name=session.name, role=session.role)
+    session.room.attach(session, client)
+    session.connection = client
+    if not record.pipeline:
+        # The rounds sent ahead to a previous pipelined connection are dropped, new ones are drawn if needed
+        session.rounds_ahead.clear()
+    for channel in reserved.router.unsubscribe(client):
+        session.room.subscribe(channel, client, record.encoding)
+    scheduler.release(reserved)
+    print(f"{session.name} resumed its session in the room {session.room.room_id}")
+    return session
+
+
+def park_session(room: Room, client, session: Session) -> bool:
+    """Release a broken connection, its player keeps its score and its seat until the session expires
+
+    Returns
+    -------
+    bool
+        False if the connection had already been released
+    """
+    if sessions.ttl <= 0:
+        return user_quit(room, client, session.name)
+    reaper.forget(client)
+    record = players.pop(client)
+    if record is None:
+        return False
+    room.detach(client, session)
+    room.fanout.unregister(client)
+    session.connection = None
+    sessions.park(session)
+    print(f"{session.name} lost the connection, its session is kept for {sessions.ttl:g} seconds")
+    return True
+
+
+def expire_session(session: Session):
+    """Remove from its room the player of a session that has not been resumed in time"""
+    room = session.room
+    room.leave(session)
+    scheduler.release(room)
+    room.broadcast(f"{session.name} quit.")
+    print(f'{session.name} did not resume its session')
+    room.broadcast_leaderboard()
+
+
+def session_reaper(interval: float):
+    """Evict the expired sessions every `interval` seconds, each one is removed by the worker of its room"""
+    while True:
+        sleep(interval)
+        for session in sessions.expired():
+            session.room.worker.schedule(0, lambda expired=session: expire_session(expired))
 
 
-def broadcast_leaderboard(winner_pair=None):
-    """Broadcast the leaderboard"""
-    # Broadcasting the winner
-    if winner_pair is not None:
-        message = json.dumps(winner_pair)
+def ping_connection(connection):
+    """Invoked by the reaper when a connection has been silent for a heartbeat interval"""
+    record = players.get(connection)
+    if record is not None:
+        room = record.room
+        room.worker.schedule(0, lambda: room.fanout.send(connection, PING, CHANNEL_CONTROL))
+
+
+def connection_expired(connection, reason: str):
+    """Invoked by the reaper when a connection misses the deadline of its phase or stops answering the pings,
+    it is closed by the worker of its room"""
+    record = players.get(connection)
+    if record is not None:
+        record.room.worker.schedule(0, lambda: reap_connection(connection, reason))
+
+
+def reap_connection(connection, reason: str):
+    """Close a connection that missed a deadline, waking up its handler
+
+    A silent connection may be half-open, it is reset like a broken one so that its player can resume the
+    session. A player that missed the deadline of a phase has walked away: it is told why, then it quits.
+    """
+    record = players.get(connection)
+    if record is None:
+        return
+    if reason == IDLE:
+        print(f"{record.label} stopped answering the heartbeat")
+        abort_connection(connection)
+        return
+    print(f"{record.label} did not write its {reason} in time")
+    room = record.room
+    room.fanout.send(connection, f"{TIMEOUT_COMMAND} {reason}", CHANNEL_CONTROL)
+    # The connection is closed once the timeout has been written
+    room.fanout.close(connection)
+    if record.name is None:
+        release_connection(connection)
     else:
-        # Broadcasting the entire leaderboard
-        message = json.dumps(order_leaderboard())
+        user_quit(room, connection, record.name)
+    if isinstance(connection, socket):
+        # A closed socket does not wake up the thread reading it, shutting down its reading side does
+        try:
+            connection.shutdown(SHUT_RD)
+        except OSError:
+            pass
+
 
-    # Leaderboard sockets to delete
-    leaderboard_to_delete: List[socket] = []
-    for user in leaderboard_clients:
+def abort_connection(connection):
+    """Reset a connection like a network failure would, its handler sees it broken"""
+    if isinstance(connection, socket):
         try:
-            socket_send(user, message)
-        except ConnectionResetError:
-            leaderboard_to_delete.append(user)
-            print("A leaderboard disconnected")
+            connection.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+    else:
+        connection.transport.abort()
 
-    # Delete leaderboard sockets from the clients and from the addresses
-    for user in leaderboard_to_delete:
-        leaderboard_clients.remove(user)
-        del addresses[user]
 
+def subscriber_disconnected(connection):
+    """Invoked by the fan-out engine when it drops a broken or too slow connection"""
+    record = players.get(connection)
+    if record is not None:
+        record.room.router.unsubscribe(connection)
+        print(f"{record.label} has been disconnected by the fan-out engine")
 
-def order_leaderboard():
-    """Order the leaderboard by value descending"""
-    ordered_leaderboard = OrderedDict((clients[k], v) for (k, v) in sorted(score.items(),
-                                                                           key=lambda item: item[1],
-                                                                           reverse=True))
-    return ordered_leaderboard
 
+def fanout_engines():
+    """Fan-out engines of the workers, in the threaded mode they all share the same one"""
+    return list({id(worker.fanout): worker.fanout for worker in workers}.values())
 
-def socket_send(sock: socket, message):
-    """Send a message to the socket with utf8 encoding"""
-    return sock.send(bytes(message + "\r\n\r\n", "utf8"))
 
+def print_fanout_stats():
+    """Print the queue metrics of every subscriber"""
+    engines = fanout_engines()
+    # A consistent view of the players, read once for every subscriber
+    labels = {record.connection: record.label for record in players.snapshot()}
+    for engine in engines:
+        for stats in engine.stats():
+            label = labels.get(stats["connection"], "released connection")
+            print(f"[fanout] {label}: depth={stats['depth']} max_depth={stats['max_depth']} "
+                  f"dropped={stats['dropped']} coalesced={stats['coalesced']}")
+    print(f"[fanout] disconnected slow or broken subscribers: {sum(e.disconnected for e in engines)}")
 
-def delete_client(client):
-    """Delete a client from all the dictionaries"""
-    del clients[client]
-    del addresses[client]
-    del score[client]
 
+def fanout_reporter(interval: float):
+    """Print the fan-out metrics every `interval` seconds"""
+    while True:
+        sleep(interval)
+        print_fanout_stats()
 
-def user_quit(client, name):
-    """Function invoked whenever a user quit from the game"""
-    delete_client(client)
-    broadcast(f"{name} quit.")
+
+def user_quit(room: Room, client, name) -> bool:
+    """Function invoked whenever a user quit from the game
+
+    Returns
+    -------
+    bool
+        False if the connection had already been released
+    """
+    if not release_connection(client):
+        # Already removed, by the reaper or by a concurrent quit
+        return False
+    room.broadcast(f"{name} quit.")
     print(f'{name} disconnected from the chat')
-    broadcast_leaderboard()
-
-
-clients: Dict[socket, str] = {}
-addresses: Dict[socket, Tuple[str, int]] = {}
-score: Dict[socket, int] = {}
-broadcast_clients: List[socket] = []
-leaderboard_clients: List[socket] = []
-
-HOST = 'localhost'
-PORT = 53000
-BUFFER_SIZE = 1024
-ADDRESS = (HOST, PORT)
-
-SERVER = socket(AF_INET, SOCK_STREAM)
-SERVER.bind(ADDRESS)
-
-roles = [
-    'Apprentice',
-    'High',
-    'Sage',
-    'Demonlord',
-    'High',
-    'Magister',
-    'Foreman',
-    'Ranger',
-    'Commander',
-    'Spokesman',
-    'Royal',
-    'Saint',
-    'Royal',
-    'Mentor',
-    'Warmaster'
-]
-
-# 5 Minutes timer
-timer = Timer(2 * 60.0, broadcast, ['TIMER ENDED'])
-timer.start()
-
-with open("questions.json", "r") as questions_file:
-    questions_obj = json.load(questions_file)
+    room.broadcast_leaderboard()
+    return True
 
-if __name__ == "__main__":
-    SERVER.listen(5)
+
+def dispatch_incoming_connections(server: socket):
+    """Accept the incoming connections and hand each one to the event loop of the worker hosting its room"""
+    while True:
+        client, client_address = server.accept()
+        # asyncio only disables Nagle's algorithm on the sockets it accepts itself, not on the ones it is given
+        client.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        room = scheduler.reserve()
+        room.worker.submit(async_accept_incoming_connections(client, client_address, room))
+
+
+async def async_accept_incoming_connections(client_socket: socket, client_address, room: Room):
+    """Handle an incoming connection on the event loop of its worker, the asyncio counterpart of
+    `accept_incoming_connections`"""
+    stream_reader, writer = await asyncio.open_connection(sock=client_socket)
+    print(f"{writer}:{client_address} joined.")
+    players.add(PlayerRecord(writer, client_address, room))
+    room.fanout.register(writer)
+    reaper.watch(writer, PHASE_NAME)
+    await async_socket_send(writer, "Write your name, then press Return or click the Send button to join!")
+    # A coroutine for each client, running on the event loop of the worker
+    await async_client_handler(stream_reader, writer, room)
+
+
+async def async_client_handler(stream_reader: StreamReader, client: StreamWriter, room: Room):
+    """Handles a single client as a coroutine"""
+    reader = AsyncMessageReader(stream_reader)
+    session = None
+    while session is None:
+        try:
+            name = await async_receive_game_message(client, reader, room)
+        except OSError:
+            name = "{quit}"
+
+        if name == "{quit}":
+            # Here the client closes the application before writing its name
+            release_connection(client)
+            client.close()
+            return
+
+        if name.startswith(RESUME_COMMAND):
+            session = resume_session(client, name[len(RESUME_COMMAND):].strip())
+            if session is None:
+                # The client writes its name instead
+                reaper.enter_phase(client, PHASE_NAME)
+                await async_socket_send(client, RESUME_FAILED)
+                continue
+            # The subscriptions following the resumption are scoped to the room of the session
+            room = session.room
+            record = players.get(client)
+            await async_socket_send(client, resumed_message(session, client, record.encoding))
+            await async_socket_send(client, codec.clock_message(DEADLINE_MATCH, room.deadline), CHANNEL_CONTROL)
+            break
+
+        # Welcomes the new user
+        welcome_message = f"Welcome {name}! You joined the room {room.room_id}. If you want to quit, write {{quit}}."
+        await async_socket_send(client, welcome_message)
+        # Get a random role
+        role = {"role": choice(ROLES)}
+        record = players.update(client, name=name, role=role["role"])
+        # Send the role
+        await async_socket_send(client, codec.role_message(role["role"], record.encoding))
+        await async_socket_send(client, f"Your role is: {role['role']}")
+        msg = f"{name} joined the chat with the role {role['role']}!"
+        # Broadcast to all the users of the room that a new user just joined the chat
+        room.broadcast(msg)
+        # Updates the players of the room
+        room.join(client, name)
+        room.broadcast_leaderboard()
+        session = sessions.create(name, role["role"], room)
+        session.connection = client
+        if sessions.ttl > 0:
+            await async_socket_send(client, f"{SESSION_COMMAND} {session.token}", CHANNEL_CONTROL)
+        await async_socket_send(client, codec.clock_message(DEADLINE_MATCH, room.deadline), CHANNEL_CONTROL)
+
+    name = session.name
+    # The rounds in flight of a resumed pipelined session are sent again on the new connection
+    resend_rounds = True
+    # Game loop, a resumed session continues the round it was playing
+    while True:
+        try:
+            if record.pipeline > 0:
+                for message in pipelined_rounds(session, record, resend_rounds):
+                    await async_socket_send(client, message)
+                resend_rounds = False
+                if answer_time > 0:
+                    await async_socket_send(client, answer_clock(session), CHANNEL_CONTROL)
+                reaper.enter_phase(client, PHASE_CHOICE)
+                answered = pipelined_answer(session, await async_receive_game_message(client, reader, room))
+                if answered is None:
+                    await async_socket_send(client, codec.lost_message(record.encoding))
+                    room.broadcast(f"{name} have been tricked")
+                    await async_drain_connection(reader)
+                    room.fanout.close(client)
+                    user_quit(room, client, name)
+                    return
+                question_id, won, in_time = answered
+                # A late round has been scored as lost at its deadline
+                new_score = (await async_commit_answer(room, client, question_id, won) if in_time
+                             else room.leaderboard.score(client))
+                await async_socket_send(client, score_message(room, client, new_score, record.encoding))
+                continue
+
+            if session.picked is None:
+                dispatch_started = perf_counter()
+                if session.question_ids is None:
+                    # Get 3 random questions and the trick one
+                    session.new_round(*draw_round())
+                await async_socket_send(client, session.bank.questions_message(session.question_ids,
+                                                                               seen_questions(record, session.bank),
+                                                                               record.encoding))
+                QUESTION_DISPATCH_SECONDS.observe(perf_counter() - dispatch_started)
+                reaper.enter_phase(client, PHASE_QUESTION)
+                received_question = await async_receive_game_message(client, reader, room)
+                # Check if there was a validation error
+                if received_question == "VALIDATION ERROR":
+                    session.end_round()
+                    continue
+                question_id = parse_picked_question(received_question, session.question_ids)
+                # Check if the client got the trick question
+                if question_id == session.trick_question:
+                    await async_socket_send(client, codec.lost_message(record.encoding))
+                    room.broadcast(f"{name} have been tricked")
+                    # Close the connection once the queued frames have been written
+                    room.fanout.close(client)
+                    user_quit(room, client, name)
+                    return
+                session.picked = question_id
+
+            question_to_answer = session.bank.get(session.picked)
+            # The choices are encoded when the bank is loaded
+            await async_socket_send(client, question_to_answer.choices_message(record.encoding))
+            if answer_time > 0:
+                await async_socket_send(client, answer_clock(session), CHANNEL_CONTROL)
+            reaper.enter_phase(client, PHASE_CHOICE)
+            received_choice = await async_receive_game_message(client, reader, room)
+            # Check for UI validation error
+            if received_choice == "VALIDATION ERROR":
+                session.end_round()
+                continue
+
+            # Check if the right answer has been chosen, the client sends the index of its choice
+            won = int(received_choice) == question_to_answer.right_answer_index
+            question_id = session.picked
+            if not session.end_round():
+                # Too late, the question has been scored as lost at its deadline
+                await async_socket_send(client, score_message(room, client, room.leaderboard.score(client),
+                                                              record.encoding))
+                continue
+            new_score = await async_commit_answer(room, client, question_id, won)
+            await async_socket_send(client, score_message(room, client, new_score, record.encoding))
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            print("Connection reset")
+            client.close()
+            park_session(room, client, session)
+            break
+        except ValueError:
+            print(f"{name} quit the application when answering a question")
+            client.close()
+            user_quit(room, client, name)
+            break
+        except Exception:
+            print_exc()
+            client.close()
+            user_quit(room, client, name)
+            break
+
+
+async def async_commit_answer(room: Room, client: StreamWriter, question_id: int, won: bool) -> int:
+    """Hand an answer to the answer stage of the room and wait for its batch to be committed, the asyncio
+    counterpart of `commit_answer`"""
+    scored = asyncio.get_running_loop().create_future()
+    # The stage runs on the event loop of the room, which is the one of the handler
+    room.submit_answer(client, question_id, won, lambda new_score: scored.done() or scored.set_result(new_score))
+    new_score = await scored
+    if new_score is None:
+        raise ConnectionResetError("The player left the room before its answer was committed")
+    return new_score
+
+
+async def async_drain_connection(reader: AsyncMessageReader):
+    """Read and drop the frames of a pipelined client that picked the trick question, until it closes the
+    connection, the asyncio counterpart of `drain_connection`"""
+    try:
+        while True:
+            await async_read_frame(reader)
+    except (OSError, ProtocolError):
+        pass
+
+
+async def async_read_frame(reader: AsyncMessageReader) -> Frame:
+    """Read the next frame of a client, recording how long it was awaited and the bytes received"""
+    received_before = reader.bytes_received
+    started = perf_counter()
+    frame = await reader.read_frame()
+    RECV_SECONDS.observe(perf_counter() - started)
+    BYTES_IN.inc(reader.bytes_received - received_before)
+    return frame
+
+
+async def async_receive_game_message(client: StreamWriter, reader: AsyncMessageReader, room: Room) -> str:
+    """Wait for the next message of the game channel, handling the subscriptions and the negotiations received
+    in the meantime"""
+    while True:
+        channel, message = await async_read_frame(reader)
+        reaper.touch(client)
+        if channel == CHANNEL_GAME:
+            return message
+        if channel == CHANNEL_CONTROL:
+            reply = negotiate(client, message)
+            if reply is not None:
+                await async_socket_send(client, reply, CHANNEL_CONTROL)
+        else:
+            # A new leaderboard subscriber receives the current leaderboard of the room
+            room.subscribe(channel, client, players.get(client).encoding)
+
+
+async def async_socket_send(writer: StreamWriter, message, channel: int = CHANNEL_GAME):
+    """Send a framed message to the stream on the given channel"""
+    record = players.get(writer)
+    if record is not None and record.compressor is not None:
+        frame = record.compressor.encode_frame(message, channel)
+    else:
+        frame = encode_frame(message, channel)
+    writer.write(frame)
+    GAME_BYTES_OUT.inc(len(frame))
+    await writer.drain()
+
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 53000
+# Length of a game in seconds
+GAME_DURATION = 2 * 60.0
+# Seconds a player has to answer the question it picked, 0 disables the deadline
+DEFAULT_ANSWER_TIME = 20.0
+# Rounds a pipelined client can ask to be sent ahead
+DEFAULT_MAX_PIPELINE = 4
+# Backlog of pending connections, large enough for the bursts of joins of the load tests
+LISTEN_BACKLOG = 4096
+# Players hosted by a room before a new one is created
+DEFAULT_ROOM_CAPACITY = 50
+# How the leaderboard changes are sent: "full" sends the whole leaderboard after every change,
+# "delta" sends only the changed rows, coalesced every `leaderboard_tick` seconds
+leaderboard_updates = "full"
+leaderboard_tick = 0.1
+# Seconds a player has to answer the question it picked before it is scored as lost
+answer_time = DEFAULT_ANSWER_TIME
+# Most rounds sent ahead to a pipelined client, 0 disables the pipelining
+max_pipeline = DEFAULT_MAX_PIPELINE
+# Topic of the bus of a cluster carrying the broadcasts sent to every player of the cluster
+CLUSTER_BROADCAST_TOPIC = "broadcast"
+
+# Record of every connection, a socket in the threaded mode and a stream writer in the asyncio mode
+players = StateStore()
+# Fan-out engine of the threaded mode, in the asyncio mode every worker has its own one
+fanout = FanoutEngine(on_disconnect=subscriber_disconnected)
+workers = [TimerWorker(0, fanout)]
+scheduler = RoomScheduler(workers, DEFAULT_ROOM_CAPACITY, GAME_DURATION)
+# Sessions of the players whose connection broke, kept until they resume them or they expire
+sessions = SessionTable()
+# Deadlines of the phases and heartbeat of every connection
+reaper = ConnectionReaper(ping_connection, connection_expired)
+# Bus shared with the other members of the cluster, and the replica of the leaderboard merged across them, only
+# set in a member of a cluster (the worker processes are members of the cluster of their parent)
+cluster_bus: Optional[Bus] = None
+shared_leaderboard: Optional[SharedLeaderboard] = None
+
+# Instrumentation, cheap enough to be always on. The metrics computed from the server state are read
+# when they are collected
+RECV_SECONDS = metrics.histogram("chat_recv_seconds", "Time a handler waited for the next frame of its client")
+QUESTION_DISPATCH_SECONDS = metrics.histogram("chat_question_dispatch_seconds",
+                                              "Time spent picking, encoding and sending the questions of a round")
+BYTES_IN = metrics.counter("chat_bytes_in_total", "Bytes received from the clients")
+GAME_BYTES_OUT = metrics.counter("chat_game_bytes_out_total",
+                                 "Bytes of the game frames written directly to the asyncio streams")
+metrics.counter("chat_fanout_bytes_out_total",
+                "Bytes written (or handed to the asyncio transports) by the fan-out engines",
+                lambda: sum(engine.bytes_sent for engine in fanout_engines()))
+metrics.counter("chat_frames_dropped_total", "Broadcast frames dropped by the slow consumer policy",
+                lambda: sum(engine.frames_dropped for engine in fanout_engines()))
+metrics.counter("chat_subscribers_disconnected_total", "Slow or broken subscribers disconnected",
+                lambda: sum(engine.disconnected for engine in fanout_engines()))
+metrics.gauge("chat_active_connections", "Open client connections", lambda: len(players))
+metrics.gauge("chat_threads", "Threads of the process", threading.active_count)
+metrics.gauge("chat_parked_sessions", "Sessions of disconnected players waiting to be resumed",
+              lambda: len(sessions))
+metrics.gauge("chat_watched_connections", "Connections with a deadline in the timer wheel of the reaper",
+              lambda: len(reaper))
+metrics.gauge("chat_rooms", "Rooms hosted by the process", lambda: len(scheduler.rooms()))
+
+# Questions of the game, opened from the -questions files when the server starts
+question_bank: Optional[QuestionBank] = None
+# Compressor of the frames of the clients that negotiated the compression, None disables it
+compressor: Optional[FrameCompressor] = None
+
+
+def restore_rooms(state: LogState):
+    """Host again the rooms saved by the event log whose round has not ended yet, with their players"""
+    rooms = [scheduler.restore(room_id, room.deadline, list(room.players.values()))
+             for room_id, room in sorted(state.rooms.items())]
+    restored = [room for room in rooms if room is not None]
+    print(f"Restored {len(restored)} rooms with {sum(len(room.leaderboard) for room in restored)} players "
+          f"from the event log")
+
+
+def create_server_socket(address: Tuple[str, int], backlog: int) -> socket:
+    """Listening socket bound to the address"""
+    server = socket(AF_INET, SOCK_STREAM)
+    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if shared_leaderboard is not None:
+        # Every worker process, or node of the host, listens on the same port, the kernel spreads the
+        # connections among them
+        server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    server.bind(address)
+    server.listen(backlog)
+    return server
+
+
+def start_workers():
+    """Start the workers hosting the rooms and their leaderboard tickers"""
+    for worker in workers:
+        worker.start()
+        if leaderboard_updates == "delta" or shared_leaderboard is not None:
+            worker.schedule(leaderboard_tick, lambda w=worker: leaderboard_ticker(w))
+
+
+def run_threaded(address: Tuple[str, int]):
+    """Run the server with a thread for each connection"""
+    server = create_server_socket(address, LISTEN_BACKLOG)
+    fanout.start()
+    start_workers()
+    print("Waiting for connections...")
+    accept_thread = Thread(target=accept_incoming_connections, args=(server,))
+    accept_thread.start()
+    accept_thread.join()
+    server.close()
+
+
+def run_asyncio(address: Tuple[str, int]):
+    """Run the server with every connection handled as a coroutine on the event loop of its room's worker"""
+    server = create_server_socket(address, LISTEN_BACKLOG)
+    start_workers()
     print("Waiting for connections...")
-    ACCEPT_THREAD = Thread(target=accept_incoming_connections)
-    ACCEPT_THREAD.start()
-    ACCEPT_THREAD.join()
-    SERVER.close()
+    try:
+        dispatch_incoming_connections(server)
+    finally:
+        server.close()
+
+
+def run_processes(processes: int, address: Tuple[str, int], broker_address: Optional[str]):
+    """Run `processes` worker processes accepting on the same port, they share their leaderboards and broadcasts
+    through the broker of the cluster, or through a broker of their own on a Unix socket"""
+    broker = None
+    extra_args = []
+    if broker_address is None:
+        broker_path = os.path.join(tempfile.gettempdir(), f"chat_server_{os.getpid()}.sock")
+        broker = Broker(broker_path)
+        broker.start()
+        extra_args = ['-broker', broker_path]
+    # Stopping the parent stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    # Every worker runs this script again, with the same arguments plus its index and the broker
+    children = [subprocess.Popen([sys.executable, __file__, *sys.argv[1:], *extra_args,
+                                  '--process-index', str(index)])
+                for index in range(processes)]
+    try:
+        for child in children:
+            child.wait()
+    except (KeyboardInterrupt, SystemExit):
+        for child in children:
+            child.terminate()
+    finally:
+        if broker is not None:
+            broker.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-host', '--host', type=str, default=DEFAULT_HOST, help='Server host name')
+    parser.add_argument('-port', '--port', type=int, default=DEFAULT_PORT, help='Port of the server')
+    parser.add_argument('-mode', '--mode', choices=['asyncio', 'threaded'], default='threaded',
+                        help='Concurrency model used to serve the clients')
+    parser.add_argument('-leaderboard', '--leaderboard', choices=['delta', 'full'], default='full',
+                        help='Send the whole leaderboard on every change or only the coalesced deltas')
+    parser.add_argument('-tick', '--tick', type=float, default=leaderboard_tick,
+                        help='Seconds between two leaderboard delta frames')
+    parser.add_argument('-max-queue', '--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help='Frames queued for a subscriber before the slow consumer policy is applied')
+    parser.add_argument('-slow-policy', '--slow-policy', choices=SLOW_CONSUMER_POLICIES, default='drop',
+                        help='What to do with a subscriber whose queue is full')
+    parser.add_argument('-game-duration', '--game-duration', type=float, default=GAME_DURATION,
+                        help='Seconds of the round of a room')
+    parser.add_argument('-answer-time', '--answer-time', type=float, default=DEFAULT_ANSWER_TIME,
+                        help='Seconds a player has to answer the question it picked, after which it is scored as '
+                             'lost, 0 disables the deadline')
+    parser.add_argument('-max-pipeline', '--max-pipeline', type=int, default=DEFAULT_MAX_PIPELINE,
+                        help='Most rounds, with their choices, sent ahead to a client that asks for them so that it '
+                             'answers without waiting for the server, 0 disables it')
+    parser.add_argument('-countdown-tick', '--countdown-tick', type=float, default=DEFAULT_COUNTDOWN_TICK,
+                        help='Seconds between two clock messages giving the players of a room the server time '
+                             'and the end of the round, 0 disables them')
+    parser.add_argument('-answer-batch-interval', '--answer-batch-interval', type=float,
+                        default=DEFAULT_ANSWER_BATCH_INTERVAL,
+                        help='Seconds a room waits for more answers before committing them as a batch with a single '
+                             'broadcast and leaderboard update, 0 commits the answers queued when its worker runs')
+    parser.add_argument('-room-capacity', '--room-capacity', type=int, default=DEFAULT_ROOM_CAPACITY,
+                        help='Players hosted by a room before a new one is created')
+    parser.add_argument('-workers', '--workers', type=int, default=1,
+                        help='Workers the rooms are spread across, each one runs an event loop in the asyncio '
+                             'mode and the room timers in the threaded mode')
+    parser.add_argument('-processes', '--processes', type=int, default=1,
+                        help='Worker processes accepting on the same port with SO_REUSEPORT')
+    parser.add_argument('-broker', '--broker', type=str, default=None,
+                        help='Join a cluster through the pub/sub broker at this address, HOST:PORT or the path of a '
+                             'Unix socket, the nodes share their broadcasts and merge their leaderboards; '
+                             f'"{LOOPBACK}" runs the node alone on an in-process bus')
+    parser.add_argument('-node-id', '--node-id', type=int, default=0,
+                        help='Index of the node in the cluster, from 0, its rooms are numbered apart from the ones '
+                             'of the other nodes')
+    parser.add_argument('-nodes', '--nodes', type=int, default=1, help='Number of nodes of the cluster')
+    # Set by the parent process when it starts the worker processes
+    parser.add_argument('--process-index', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('-metrics-port', '--metrics-port', type=int, default=0,
+                        help='Serve the metrics in the Prometheus format on http://HOST:PORT/metrics, the worker '
+                             'processes use the following ports, 0 disables it')
+    parser.add_argument('-metrics-dump', '--metrics-dump', type=float, default=0,
+                        help='Seconds between two summaries of the metrics, 0 disables them')
+    parser.add_argument('-questions', '--questions', type=str, default='questions.json',
+                        help='Json file of the questions or indexed bank written by question_bank.py, which is '
+                             'opened without being loaded; a comma separated list makes a bank of all of them')
+    parser.add_argument('-reload-interval', '--reload-interval', type=float, default=DEFAULT_RELOAD_INTERVAL,
+                        help='Seconds between two checks of the questions files, a changed bank is loaded in the '
+                             'background and used by the next rounds, 0 disables the reloads')
+    parser.add_argument('-compress-threshold', '--compress-threshold', type=int,
+                        default=DEFAULT_COMPRESSION_THRESHOLD,
+                        help='Payloads of at least this many bytes are compressed for the clients that negotiated '
+                             'the compression, 0 disables the compression')
+    parser.add_argument('-session-ttl', '--session-ttl', type=float, default=DEFAULT_SESSION_TTL,
+                        help='Seconds a player whose connection broke keeps its score, role and seat to resume its '
+                             'session, 0 disables the resumption')
+    parser.add_argument('-heartbeat', '--heartbeat', type=float, default=DEFAULT_HEARTBEAT_INTERVAL,
+                        help='Seconds of silence after which a connection is pinged on the control channel, '
+                             '0 disables the pings')
+    parser.add_argument('-idle-timeout', '--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help='Seconds of silence, pongs included, after which a connection is considered broken '
+                             'and closed, 0 keeps the silent connections')
+    parser.add_argument('-name-timeout', '--name-timeout', type=float, default=DEFAULT_NAME_TIMEOUT,
+                        help='Seconds a new connection has to write its name, 0 disables the deadline')
+    parser.add_argument('-question-timeout', '--question-timeout', type=float, default=DEFAULT_QUESTION_TIMEOUT,
+                        help='Seconds a player has to pick a question, 0 disables the deadline')
+    parser.add_argument('-choice-timeout', '--choice-timeout', type=float, default=DEFAULT_CHOICE_TIMEOUT,
+                        help='Seconds a player has to pick a choice, 0 disables the deadline')
+    parser.add_argument('-event-log', '--event-log', type=str, default=None,
+                        help='Append the joins, answers and quits to this file and restore the rooms it saved on '
+                             'startup, the worker processes use it with their index as suffix')
+    parser.add_argument('-log-commit-interval', '--log-commit-interval', type=float,
+                        default=DEFAULT_COMMIT_INTERVAL,
+                        help='Seconds between two syncs of the event log, the events of an interval are committed '
+                             'together')
+    parser.add_argument('-log-snapshot-every', '--log-snapshot-every', type=int, default=DEFAULT_SNAPSHOT_EVERY,
+                        help='Events written to the event log before it is compacted into a snapshot')
+    parser.add_argument('-fanout-report', '--fanout-report', type=float, default=0,
+                        help='Seconds between two reports of the subscriber queues, 0 disables them')
+    args = parser.parse_args()
+
+    leaderboard_updates = args.leaderboard
+    leaderboard_tick = args.tick
+    answer_time = args.answer_time
+    max_pipeline = args.max_pipeline
+    sessions = SessionTable(args.session_ttl)
+    loading_started = perf_counter()
+    question_bank = QuestionBank.load(args.questions)
+    print(f"Opened {len(question_bank)} questions in {(perf_counter() - loading_started) * 1000:.1f}ms")
+    reaper = ConnectionReaper(ping_connection, connection_expired, args.heartbeat, args.idle_timeout,
+                              {PHASE_NAME: args.name_timeout, PHASE_QUESTION: args.question_timeout,
+                               PHASE_CHOICE: args.choice_timeout})
+    compressor = (FrameCompressor(question_bank.compression_dictionary(), args.compress_threshold)
+                  if args.compress_threshold > 0 else None)
+    if args.mode == 'asyncio':
+        workers = [AsyncWorker(i, AsyncFanoutEngine(args.max_queue, args.slow_policy,
+                                                    on_disconnect=subscriber_disconnected))
+                   for i in range(args.workers)]
+    else:
+        fanout = FanoutEngine(args.max_queue, args.slow_policy, on_disconnect=subscriber_disconnected)
+        workers = [TimerWorker(i, fanout) for i in range(args.workers)]
+    ADDRESS = (args.host, args.port)
+    if not 0 <= args.node_id < args.nodes:
+        parser.error("-node-id must be between 0 and -nodes - 1")
+    if args.processes > 1 and args.process_index is None:
+        run_processes(args.processes, ADDRESS, args.broker)
+        sys.exit()
+    event_log = None
+    saved_state = LogState()
+    if args.event_log:
+        log_path = args.event_log if args.process_index is None else f"{args.event_log}.{args.process_index}"
+        replay_started = perf_counter()
+        saved_state = replay(log_path)
+        print(f"Replayed the event log in {(perf_counter() - replay_started) * 1000:.1f}ms")
+        event_log = EventLog(log_path, args.log_commit_interval, args.log_snapshot_every, saved_state.seq)
+    if args.broker is not None:
+        # Member of a cluster, every worker process of every node is a member: the room ids are interleaved with
+        # the ones of the other members
+        member = args.node_id * args.processes + (args.process_index or 0)
+        cluster_bus = LoopbackBus() if args.broker == LOOPBACK else BrokerBus(parse_bus_address(args.broker))
+        shared_leaderboard = SharedLeaderboard(cluster_bus, member, partial_leaderboard, leaderboard_tick)
+        shared_leaderboard.start()
+        cluster_bus.subscribe(CLUSTER_BROADCAST_TOPIC, relay_cluster_broadcast)
+        scheduler = RoomScheduler(workers, args.room_capacity, args.game_duration, leaderboard_updates,
+                                  publish_room_changes, member + 1, args.nodes * args.processes, event_log,
+                                  args.countdown_tick, args.answer_batch_interval, announce_winner)
+    else:
+        scheduler = RoomScheduler(workers, args.room_capacity, args.game_duration, leaderboard_updates,
+                                  event_log=event_log, countdown_tick=args.countdown_tick,
+                                  answer_batch_interval=args.answer_batch_interval)
+    if event_log is not None:
+        restore_rooms(saved_state)
+        # The restored rooms replace the previous log only once they are on the disk
+        event_log.start()
+    if cluster_bus is not None:
+        # Connected once the restored rooms can be given to the other members
+        cluster_bus.start()
+    if args.metrics_port:
+        metrics.serve_metrics((args.host, args.metrics_port + (args.process_index or 0)))
+    if args.metrics_dump > 0:
+        metrics.dump_periodically(args.metrics_dump)
+    reaper.start()
+    if sessions.ttl > 0:
+        Thread(target=session_reaper, args=(min(sessions.ttl / 4, 1.0),), daemon=True).start()
+    if args.fanout_report > 0:
+        Thread(target=fanout_reporter, args=(args.fanout_report,), daemon=True).start()
+    if args.reload_interval > 0:
+        BankWatcher(args.questions, swap_question_bank, args.reload_interval).start()
+    try:
+        if args.mode == 'asyncio':
+            try:
+                run_asyncio(ADDRESS)
+            except KeyboardInterrupt:
+                pass
+        else:
+            run_threaded(ADDRESS)
+    finally:
+        if event_log is not None:
+            event_log.close()
@@ -1,39 +1,264 @@
-from threading import Thread
-from typing import List, Tuple
+import asyncio
+from asyncio import StreamReader, StreamWriter
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple, Union
 from socket import socket, AF_INET, SOCK_STREAM
+from protocol import AsyncMessageReader, ProtocolError, encode_frame, CHANNELS, CHANNEL_GAME
+from question_bank import QuestionBank
 
 
-def create_socket_thread(address: Tuple[str, int], thread_func):
-    """Create a socket that connects to the `address` and a thread that handles `thread_func`, then connect the socket
+def create_multiplexed_socket(address: Tuple[str, int]):
+    """Create a socket that connects to the `address`, the game, broadcast and leaderboard channels are
+    multiplexed over it
 
     Parameters
     ----------
     address : Tuple[str, int]
         address used for connecting the socket
-    thread_func : Any
-        function used as the target for the thread
 
+    Returns
+    -------
+    socket
+        the connected socket
     """
     sock = socket(AF_INET, SOCK_STREAM)
     sock.connect(address)
-    sock_thread = Thread(target=thread_func, daemon=True)
-    return sock, sock_thread
+    return sock
 
 
-def read_message(sock: socket, buf_size: int = 1024) -> List[str]:
-    """Read a message from the server, then return a list of messages sent by the server
+def send_message(sock: socket, message: str, channel: int = CHANNEL_GAME):
+    """Send a framed message to the server
 
     Parameters
     ----------
     sock : socket
-        socket used to read the message
-    buf_size : int
-        size of the buffer(in bytes) used by the socket to read the message (default is 1024)
+        socket used to send the message
+    message : str
+        message to send
+    channel : int
+        channel the message belongs to (default is the game channel)
+    """
+    sock.sendall(encode_frame(message, channel))
+
+
+async def open_multiplexed_connection(address: Tuple[str, int], dictionary: Optional[bytes] = None):
+    """Open a connection to the `address` and a dispatcher of the channels multiplexed over it, on the
+    running event loop
+
+    Parameters
+    ----------
+    address : Tuple[str, int]
+        address of the server
+    dictionary : bytes, optional
+        preset dictionary of the compressed frames, if the compression is negotiated
+
+    Returns
+    -------
+    tuple[StreamWriter, AsyncChannelDispatcher]
+        the writer of the connection and the dispatcher of the frames it receives, not started yet
+    """
+    reader, writer = await asyncio.open_connection(*address)
+    return writer, AsyncChannelDispatcher(reader, dictionary)
+
+
+def write_message(writer: StreamWriter, message: str, channel: int = CHANNEL_GAME):
+    """Queue a framed message on an asyncio stream, the counterpart of `send_message`
+
+    Parameters
+    ----------
+    writer : StreamWriter
+        stream used to send the message
+    message : str
+        message to send
+    channel : int
+        channel the message belongs to (default is the game channel)
+    """
+    writer.write(encode_frame(message, channel))
+
+
+def load_compression_dictionary(path: str) -> Optional[bytes]:
+    """Preset dictionary of the compressed frames built from the questions file the server loads, None if
+    the file cannot be read
+
+    Parameters
+    ----------
+    path : str
+        path of the questions file
+    """
+    try:
+        return QuestionBank.load(path).compression_dictionary()
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def decode_questions(entries: List, question_texts: Dict[int, str]) -> List[Tuple[int, str]]:
+    """Resolve the questions of a round sent by the server
+
+    Parameters
+    ----------
+    entries : list
+        ids of questions already received and [id, text] pairs of new questions
+    question_texts : dict[int, str]
+        text of the questions received so far, updated with the new ones
+
+    Returns
+    -------
+    list[tuple[int, str]]
+        pairs of question id and question text
+    """
+    questions = []
+    for entry in entries:
+        if isinstance(entry, list):
+            question_texts[entry[0]] = entry[1]
+            entry = entry[0]
+        questions.append((entry, question_texts[entry]))
+    return questions
+
+
+def decode_round(entries: List, known: Dict[int, Tuple[str, List[str]]]) -> List[Tuple[int, str, List[str]]]:
+    """Resolve a round sent ahead by the server to a pipelined client
+
+    Parameters
+    ----------
+    entries : list
+        ids of questions already received and [id, text, choices] lists of new questions
+    known : dict[int, tuple[str, list[str]]]
+        text and choices of the questions received so far, updated with the new ones
 
     Returns
     -------
-    list[str]
-        a list of messages split by the sequence '\\r\\n\\r\\n'
+    list[tuple[int, str, list[str]]]
+        id, text and choices of the questions of the round
     """
-    message = sock.recv(buf_size).decode("utf8")
-    return list(filter(None, message.split('\r\n\r\n')))
+    questions = []
+    for entry in entries:
+        if isinstance(entry, list):
+            known[entry[0]] = (entry[1], entry[2])
+            entry = entry[0]
+        questions.append((entry, *known[entry]))
+    return questions
+
+
+class AsyncChannelDispatcher:
+    """Reads the frames of a multiplexed stream on a task and dispatches them to a queue for each channel"""
+
+    def __init__(self, reader: StreamReader, dictionary: Optional[bytes] = None):
+        self._reader = AsyncMessageReader(reader, dictionary)
+        self._queues: Dict[int, asyncio.Queue] = {channel: asyncio.Queue() for channel in CHANNELS}
+        self._task: Optional[asyncio.Task] = None
+        # Frames received so far
+        self.received = 0
+
+    @property
+    def bytes_received(self) -> int:
+        """Bytes read from the stream so far"""
+        return self._reader.bytes_received
+
+    def start(self):
+        """Start reading from the stream"""
+        self._task = asyncio.ensure_future(self._dispatch())
+
+    def stop(self):
+        """Stop reading from the stream"""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def read_message(self, channel: int) -> Union[str, bytes]:
+        """Wait until a message of `channel` is received, then return it
+
+        Raises
+        ------
+        ConnectionResetError
+            if the connection has been closed
+        """
+        message = await self._queues[channel].get()
+        if message is None:
+            # Leave the marker in the queue for the next readers
+            self._queues[channel].put_nowait(None)
+            raise ConnectionResetError("Connection closed")
+        return message
+
+    async def _dispatch(self):
+        """Body of the dispatcher task"""
+        try:
+            while True:
+                channel, message = await self._reader.read_frame()
+                self.received += 1
+                self._queues[channel].put_nowait(message)
+        except (OSError, ProtocolError):
+            # None marks the end of every channel
+            for queue in self._queues.values():
+                queue.put_nowait(None)
+
+
+class LeaderboardModel:
+    """Client copy of the leaderboard, updated with the deltas sent by the server
+
+    The rows are kept sorted by score descending, then by name, so that every change can be applied
+    to the leaderboard listbox by deleting and inserting single rows.
+    """
+
+    def __init__(self):
+        # Sort keys of the rows in the order they are shown
+        self._keys: List[Tuple[int, str, int]] = []
+        self._entries: Dict[int, Tuple[str, int]] = {}
+
+    def load_snapshot(self, rows: List[List]) -> List[str]:
+        """Replace the leaderboard with the rows of a snapshot
+
+        Parameters
+        ----------
+        rows : list[list]
+            rows of id, name and score
+
+        Returns
+        -------
+        list[str]
+            text of every row, in the order they must be shown
+        """
+        self._entries = {player_id: (name, score) for player_id, name, score in rows}
+        self._keys = sorted(self._sort_key(player_id) for player_id in self._entries)
+        return [self._row_text(key) for key in self._keys]
+
+    def apply_delta(self, updated: List[List], removed: List[int]) -> List[Tuple]:
+        """Apply a delta to the leaderboard
+
+        Parameters
+        ----------
+        updated : list[list]
+            rows of id, name and score of the changed players
+        removed : list[int]
+            ids of the players that left
+
+        Returns
+        -------
+        list[tuple]
+            operations to apply to the listbox in order: ("delete", index) or ("insert", index, text)
+        """
+        operations = []
+        for player_id in removed:
+            operations.extend(self._delete(player_id))
+        for player_id, name, score in updated:
+            operations.extend(self._delete(player_id))
+            self._entries[player_id] = (name, score)
+            key = self._sort_key(player_id)
+            index = bisect_left(self._keys, key)
+            self._keys.insert(index, key)
+            operations.append(("insert", index, self._row_text(key)))
+        return operations
+
+    def _delete(self, player_id: int) -> List[Tuple]:
+        if player_id not in self._entries:
+            return []
+        index = bisect_left(self._keys, self._sort_key(player_id))
+        del self._keys[index]
+        del self._entries[player_id]
+        return [("delete", index)]
+
+    def _sort_key(self, player_id: int) -> Tuple[int, str, int]:
+        name, score = self._entries[player_id]
+        return -score, name, player_id
+
+    @staticmethod
+    def _row_text(key: Tuple[int, str, int]) -> str:
+        return f"{key[1]}:{-key[0]}"
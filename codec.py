@@ -0,0 +1,359 @@
+import json
+import struct
+import zlib
+from time import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import metrics
+from protocol import WINDOW_BITS
+
+# Encodings of the structured messages (roles, questions, choices, scores, leaderboards) a client can ask for
+# by sending "ENCODING <encoding>" on the control channel before subscribing. The text messages are always
+# sent as text
+ENCODING_REQUEST = "ENCODING"
+ENCODING_JSON = "json"
+ENCODING_BINARY = "binary"
+ENCODINGS = (ENCODING_JSON, ENCODING_BINARY)
+
+# Compressions a client can ask for by sending "COMPRESSION zlib <dictionary id>" on the control channel. The
+# id tells the server which preset dictionary the client will inflate the frames with, the server only
+# compresses if it built the same one
+COMPRESSION_REQUEST = "COMPRESSION"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_NONE = "none"
+COMPRESSIONS = (COMPRESSION_NONE, COMPRESSION_ZLIB)
+# Clock of the control channel: "CLOCK <server time> <kind> <value>", the times are seconds of the wall clock of
+# the server. The server sends the end of the round (match) and the deadline of the question being answered
+# (answer); a client sending "CLOCK <its time>" gets its time back as the value of a sync reply, to compute
+# the offset of its clock from the round trip
+CLOCK_COMMAND = "CLOCK"
+DEADLINE_MATCH = "match"
+DEADLINE_ANSWER = "answer"
+CLOCK_SYNC = "sync"
+# Rounds a client asks the server to send ahead with "PIPELINE <depth>", before writing its name. Every round
+# then comes with the choices of its questions, the client answers "<question id> <choice index>" to its oldest
+# round without waiting for the server, and gets a score (or the trick status) and one more round back
+PIPELINE_REQUEST = "PIPELINE"
+
+# Fragments repeated in every structured message, placed at the end of the preset dictionary where deflate
+# references them with the shortest distances
+_MESSAGE_TEMPLATES = ('{"DECLARED_WINNER": {"winner_name": "', '", "winner_score": ', '{"DELTA": {"updated": [[',
+                      '], "removed": []}}', '{"SNAPSHOT": [[', '{"status": "NOT_LOST", "choices": ["', '", "',
+                      '{"score": ', ', "rank": ', ', "players": ', '[[', '", ', ']]', '"], [', ': 0, "', ': 1, "')
+
+# A structured message: json text, or bytes in the binary encoding
+Payload = Union[str, bytes]
+
+json_dumps = metrics.histogram("chat_json_dumps_seconds", "Time spent encoding json messages").wrap(json.dumps)
+BINARY_ENCODE_SECONDS = metrics.histogram("chat_binary_encode_seconds",
+                                          "Time spent encoding leaderboard messages in the binary encoding")
+
+# The first byte of a binary message is its type
+TAG_ROLE = 1
+TAG_QUESTIONS = 2
+TAG_LOST = 3
+TAG_CHOICES = 4
+TAG_SCORE = 5
+TAG_LEADERBOARD = 6
+TAG_SNAPSHOT = 7
+TAG_DELTA = 8
+TAG_WINNER = 9
+TAG_RESUMED = 10
+TAG_ROUND = 11
+
+# Strings are prefixed by their length in bytes
+_STRING_LENGTH = struct.Struct("!H")
+# Counts of names, rows and removed players
+_COUNT = struct.Struct("!I")
+# Entry of a questions message: id and whether its text follows
+_QUESTION_ENTRY = struct.Struct("!IB")
+# Score message: whether the rank follows, score, then optionally rank and players
+_SCORE = struct.Struct("!Bi")
+_RANK = struct.Struct("!II")
+# Winner message: score and number of winners
+_WINNER = struct.Struct("!iH")
+_TAG = struct.Struct("!B")
+
+LOST_PAYLOAD = _TAG.pack(TAG_LOST)
+
+
+def _pack_string(text: str) -> bytes:
+    data = text.encode("utf8")
+    return _STRING_LENGTH.pack(len(data)) + data
+
+
+def _pack_names(names: Dict[int, str]) -> bytes:
+    return _COUNT.pack(len(names)) + b"".join(_COUNT.pack(player_id) + _pack_string(name)
+                                              for player_id, name in names.items())
+
+
+def _pack_ints(values: Sequence[int]) -> bytes:
+    return _COUNT.pack(len(values)) + struct.pack(f"!{len(values)}i", *values)
+
+
+def role_message(role: str, encoding: str) -> Payload:
+    """Message telling a player its role"""
+    if encoding == ENCODING_BINARY:
+        return _TAG.pack(TAG_ROLE) + _pack_string(role)
+    return json_dumps({"role": role})
+
+
+def lost_message(encoding: str) -> Payload:
+    """Response to a player that picked the trick question"""
+    if encoding == ENCODING_BINARY:
+        return LOST_PAYLOAD
+    return json_dumps({"status": "LOST"})
+
+
+def score_message(score: int, encoding: str, rank: Optional[int] = None, players: Optional[int] = None) -> Payload:
+    """Reply to an answer with the new score, and the rank among `players` players if it is known"""
+    if encoding == ENCODING_BINARY:
+        if rank is None:
+            return _TAG.pack(TAG_SCORE) + _SCORE.pack(0, score)
+        return _TAG.pack(TAG_SCORE) + _SCORE.pack(1, score) + _RANK.pack(rank, players)
+    reply = {"score": score}
+    if rank is not None:
+        reply["rank"] = rank
+        reply["players"] = players
+    return json_dumps(reply)
+
+
+def binary_question_entry(question_id: int, text: Optional[str] = None) -> bytes:
+    """Entry of a binary questions message, with the text of the question if the client does not have it"""
+    if text is None:
+        return _QUESTION_ENTRY.pack(question_id, 0)
+    return _QUESTION_ENTRY.pack(question_id, 1) + _pack_string(text)
+
+
+def binary_questions_message(entries: List[bytes]) -> bytes:
+    """Binary questions message made of entries built by `binary_question_entry`"""
+    return _TAG.pack(TAG_QUESTIONS) + _TAG.pack(len(entries)) + b"".join(entries)
+
+
+def binary_round_entry(question_id: int, text: Optional[str] = None, choices: Sequence[str] = ()) -> bytes:
+    """Entry of a binary round message, with the text and the choices of the question if the client does not
+    have them"""
+    if text is None:
+        return _QUESTION_ENTRY.pack(question_id, 0)
+    return (_QUESTION_ENTRY.pack(question_id, 1) + _pack_string(text) + _TAG.pack(len(choices)) +
+            b"".join(map(_pack_string, choices)))
+
+
+def binary_round_message(entries: List[bytes]) -> bytes:
+    """Binary round sent ahead to a pipelined client, made of entries built by `binary_round_entry`"""
+    return _TAG.pack(TAG_ROUND) + _TAG.pack(len(entries)) + b"".join(entries)
+
+
+def binary_choices_message(choices: List[str]) -> bytes:
+    """Binary response to a player that picked a question which is not the trick one"""
+    return _TAG.pack(TAG_CHOICES) + _TAG.pack(len(choices)) + b"".join(map(_pack_string, choices))
+
+
+@BINARY_ENCODE_SECONDS.wrap
+def binary_leaderboard_message(tag: int, names: Dict[int, str], rows: Iterable[Tuple[int, str, int]],
+                               removed: Sequence[int] = ()) -> bytes:
+    """Binary leaderboard, snapshot or delta message
+
+    The players are identified by their id in the room leaderboard, so a name is only sent in the first
+    message that needs it.
+
+    Parameters
+    ----------
+    tag : int
+        TAG_LEADERBOARD, TAG_SNAPSHOT or TAG_DELTA
+    names : dict[int, str]
+        names of the players the clients do not know yet, by id
+    rows : Iterable[tuple[int, str, int]]
+        (id, name, score) rows, the names are not encoded
+    removed : Sequence[int]
+        ids of the removed players, only for the deltas
+    """
+    scores = [value for player_id, _, score in rows for value in (player_id, score)]
+    return _TAG.pack(tag) + _pack_names(names) + _pack_ints(scores) + _pack_ints(removed)
+
+
+def winner_message(winner, encoding: str) -> Payload:
+    """Message declaring the winner, or the list of winners, computed by `Room.declare_winner`"""
+    if encoding == ENCODING_BINARY:
+        winners = winner if isinstance(winner, list) else [winner]
+        return (_TAG.pack(TAG_WINNER) + _WINNER.pack(winners[0]["winner_score"], len(winners)) +
+                b"".join(_pack_string(w["winner_name"]) for w in winners))
+    return json_dumps({"DECLARED_WINNER": winner})
+
+
+def compression_dictionary(texts: Iterable[str], roles: Iterable[str]) -> bytes:
+    """Preset dictionary of the compressed frames
+
+    The same texts must give the same dictionary on the server and on the clients, so the order of the
+    fragments only depends on the order of the texts. Deflate only references the last `2 ** WINDOW_BITS`
+    bytes of a dictionary, the rest is cut.
+
+    Parameters
+    ----------
+    texts : Iterable[str]
+        texts of the questions and of their choices
+    roles : Iterable[str]
+        names of the roles
+    """
+    fragments = list(texts) + list(dict.fromkeys(roles)) + list(_MESSAGE_TEMPLATES)
+    return "".join(fragments).encode("utf8")[-(1 << WINDOW_BITS):]
+
+
+def dictionary_id(dictionary: bytes) -> int:
+    """Checksum identifying a preset dictionary during the negotiation, the one deflate itself uses"""
+    return zlib.adler32(dictionary)
+
+
+def compression_request(dictionary: bytes) -> str:
+    """Request of the control channel asking the server to compress the frames with a preset dictionary"""
+    return f"{COMPRESSION_REQUEST} {COMPRESSION_ZLIB} {dictionary_id(dictionary)}"
+
+
+def clock_message(kind: str, value: float) -> str:
+    """Clock message of the control channel, stamped with the current time of the server"""
+    return f"{CLOCK_COMMAND} {time():.3f} {kind} {value:.3f}"
+
+
+def clock_request() -> str:
+    """Request of the control channel asking the server for its time, stamped with the time of the client"""
+    return f"{CLOCK_COMMAND} {time():.3f}"
+
+
+def parse_clock(argument: str) -> Tuple[float, str, float]:
+    """Server time, kind and value of a clock message, without its command
+
+    Raises
+    ------
+    ValueError
+        if the message is malformed
+    """
+    server_time, kind, value = argument.split(" ")
+    return float(server_time), kind, float(value)
+
+
+def resumed_message(name: str, role: str, score: int, question: Optional[str], encoding: str) -> Payload:
+    """Reply to a resumed session, with the text of the question the player picked if it was choosing its
+    answer, then the server sends the choices of that question or a new round of questions"""
+    if encoding == ENCODING_BINARY:
+        question_part = _TAG.pack(0) if question is None else _TAG.pack(1) + _pack_string(question)
+        return (_TAG.pack(TAG_RESUMED) + _pack_string(name) + _pack_string(role) + _pack_ints([score]) +
+                question_part)
+    return json_dumps({"RESUMED": {"name": name, "role": role, "score": score, "question": question}})
+
+
+class PayloadDecoder:
+    """Decoder of the structured messages received by a client
+
+    A binary message is decoded to the same object as its json counterpart, so the client handles both
+    encodings the same way. The decoder remembers the names of the leaderboard players sent by the server.
+    """
+
+    def __init__(self):
+        # Names of the leaderboard players, by id
+        self.names: Dict[int, str] = {}
+
+    def decode(self, message: Payload) -> Any:
+        """Object sent by the server
+
+        Raises
+        ------
+        ValueError
+            if the message is malformed
+        """
+        if isinstance(message, str):
+            return json.loads(message)
+        try:
+            return self._decode_binary(memoryview(message))
+        except (struct.error, IndexError, KeyError, UnicodeDecodeError) as error:
+            raise ValueError(f"Malformed binary message: {error}") from error
+
+    def _decode_binary(self, data: memoryview) -> Any:
+        tag = data[0]
+        if tag == TAG_ROLE:
+            return {"role": _unpack_string(data, 1)[0]}
+        if tag == TAG_QUESTIONS:
+            entries, offset = [], 2
+            for _ in range(data[1]):
+                question_id, has_text = _QUESTION_ENTRY.unpack_from(data, offset)
+                offset += _QUESTION_ENTRY.size
+                if has_text:
+                    text, offset = _unpack_string(data, offset)
+                    entries.append([question_id, text])
+                else:
+                    entries.append(question_id)
+            return entries
+        if tag == TAG_LOST:
+            return {"status": "LOST"}
+        if tag == TAG_CHOICES:
+            choices, offset = [], 2
+            for _ in range(data[1]):
+                choice, offset = _unpack_string(data, offset)
+                choices.append(choice)
+            return {"status": "NOT_LOST", "choices": choices}
+        if tag == TAG_SCORE:
+            has_rank, score = _SCORE.unpack_from(data, 1)
+            if not has_rank:
+                return {"score": score}
+            rank, players = _RANK.unpack_from(data, 1 + _SCORE.size)
+            return {"score": score, "rank": rank, "players": players}
+        if tag in (TAG_LEADERBOARD, TAG_SNAPSHOT, TAG_DELTA):
+            return self._decode_leaderboard(tag, data)
+        if tag == TAG_WINNER:
+            score, count = _WINNER.unpack_from(data, 1)
+            offset, winners = 1 + _WINNER.size, []
+            for _ in range(count):
+                name, offset = _unpack_string(data, offset)
+                winners.append({"winner_name": name, "winner_score": score})
+            return {"DECLARED_WINNER": winners[0] if len(winners) == 1 else winners}
+        if tag == TAG_RESUMED:
+            name, offset = _unpack_string(data, 1)
+            role, offset = _unpack_string(data, offset)
+            (score,), offset = _unpack_ints(data, offset)
+            question = _unpack_string(data, offset + 1)[0] if data[offset] else None
+            return {"RESUMED": {"name": name, "role": role, "score": score, "question": question}}
+        if tag == TAG_ROUND:
+            entries, offset = [], 2
+            for _ in range(data[1]):
+                question_id, has_text = _QUESTION_ENTRY.unpack_from(data, offset)
+                offset += _QUESTION_ENTRY.size
+                if not has_text:
+                    entries.append(question_id)
+                    continue
+                text, offset = _unpack_string(data, offset)
+                choices, offset = [], offset + 1
+                for _ in range(data[offset - 1]):
+                    choice, offset = _unpack_string(data, offset)
+                    choices.append(choice)
+                entries.append([question_id, text, choices])
+            return {"ROUND": entries}
+        raise ValueError(f"Unknown binary message type {tag}")
+
+    def _decode_leaderboard(self, tag: int, data: memoryview) -> Any:
+        (name_count,), offset = _COUNT.unpack_from(data, 1), 1 + _COUNT.size
+        for _ in range(name_count):
+            (player_id,) = _COUNT.unpack_from(data, offset)
+            self.names[player_id], offset = _unpack_string(data, offset + _COUNT.size)
+        scores, offset = _unpack_ints(data, offset)
+        removed, _ = _unpack_ints(data, offset)
+        rows = [[scores[i], self.names[scores[i]], scores[i + 1]] for i in range(0, len(scores), 2)]
+        if tag == TAG_DELTA:
+            for player_id in removed:
+                self.names.pop(player_id, None)
+            return {"DELTA": {"updated": rows, "removed": list(removed)}}
+        # A leaderboard or a snapshot holds every player of the room, the others have left
+        self.names = {row[0]: row[1] for row in rows}
+        if tag == TAG_SNAPSHOT:
+            return {"SNAPSHOT": rows}
+        return {name: score for _, name, score in rows}
+
+
+def _unpack_string(data: memoryview, offset: int) -> Tuple[str, int]:
+    (length,) = _STRING_LENGTH.unpack_from(data, offset)
+    start = offset + _STRING_LENGTH.size
+    return str(data[start:start + length], "utf8"), start + length
+
+
+def _unpack_ints(data: memoryview, offset: int) -> Tuple[Tuple[int, ...], int]:
+    (count,) = _COUNT.unpack_from(data, offset)
+    start = offset + _COUNT.size
+    return struct.unpack_from(f"!{count}i", data, start), start + 4 * count
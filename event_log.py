@@ -0,0 +1,229 @@
+import json
+import os
+from threading import Condition, Thread
+from time import monotonic, sleep
+from traceback import print_exc
+from typing import Any, Dict, List, Optional
+
+import metrics
+
+# Seconds the writer waits after a commit, the events appended in the meantime are committed together
+DEFAULT_COMMIT_INTERVAL = 0.01
+# Events written to the log before it is compacted into a snapshot
+DEFAULT_SNAPSHOT_EVERY = 10000
+
+# Types of the events
+EVENT_ROOM = "room"
+EVENT_JOIN = "join"
+EVENT_ANSWER = "answer"
+EVENT_QUIT = "quit"
+EVENT_END = "end"
+
+COMMIT_SECONDS = metrics.histogram("chat_log_commit_seconds", "Time spent writing and syncing a batch of events")
+EVENTS_WRITTEN = metrics.counter("chat_log_events_total", "Events written to the event log")
+COMMITS = metrics.counter("chat_log_commits_total", "Batches of events synced to the disk")
+SNAPSHOTS = metrics.counter("chat_log_snapshots_total", "Compactions of the event log into a snapshot")
+
+
+class RoomState:
+    """Deadline and players of a room, as rebuilt from the events"""
+
+    __slots__ = ("deadline", "players")
+
+    def __init__(self, deadline: float, players: Optional[Dict[int, List]] = None):
+        # Wall clock time at which the round of the room ends
+        self.deadline = deadline
+        # [name, score] of the players still in the room, by id in the room leaderboard
+        self.players: Dict[int, List] = players if players is not None else {}
+
+
+class LogState:
+    """State of the rooms that survives a restart: the events applied in order since the first one"""
+
+    def __init__(self, seq: int = 0, rooms: Optional[Dict[int, RoomState]] = None):
+        # Sequence number of the last applied event
+        self.seq = seq
+        self.rooms: Dict[int, RoomState] = rooms if rooms is not None else {}
+
+    def apply(self, event: Dict[str, Any]):
+        """Apply an event, the events of rooms that are not known anymore are ignored"""
+        self.seq = event["seq"]
+        kind = event["type"]
+        if kind == EVENT_ROOM:
+            self.rooms[event["room"]] = RoomState(event["deadline"])
+            return
+        room = self.rooms.get(event["room"])
+        if room is None:
+            return
+        if kind == EVENT_JOIN:
+            room.players[event["player"]] = [event["name"], event["score"]]
+        elif kind == EVENT_ANSWER:
+            player = room.players.get(event["player"])
+            if player is not None:
+                player[1] = event["score"]
+        elif kind == EVENT_QUIT:
+            room.players.pop(event["player"], None)
+        elif kind == EVENT_END:
+            del self.rooms[event["room"]]
+
+    def to_obj(self) -> Dict[str, Any]:
+        """Json serializable copy of the state"""
+        return {"seq": self.seq, "rooms": {room_id: {"deadline": room.deadline, "players": room.players}
+                                           for room_id, room in self.rooms.items()}}
+
+    @classmethod
+    def from_obj(cls, obj: Dict[str, Any]) -> "LogState":
+        """State saved by `to_obj`, json turned the integer keys into strings"""
+        rooms = {int(room_id): RoomState(room["deadline"], {int(player_id): player
+                                                            for player_id, player in room["players"].items()})
+                 for room_id, room in obj["rooms"].items()}
+        return cls(obj["seq"], rooms)
+
+
+def snapshot_path(path: str) -> str:
+    """Path of the snapshot of the log at `path`"""
+    return path + ".snapshot"
+
+
+def replay(path: str) -> LogState:
+    """Rebuild the state saved by the log at `path`: its snapshot, then the events written after it
+
+    A missing log gives an empty state. The last line of the log may have been cut by a crash in the middle
+    of a write, the replay stops at the first line that cannot be decoded.
+    """
+    state = LogState()
+    try:
+        with open(snapshot_path(path), "r") as snapshot_file:
+            state = LogState.from_obj(json.load(snapshot_file))
+    except FileNotFoundError:
+        pass
+    try:
+        with open(path, "r") as log_file:
+            for line in log_file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                # The log is truncated after the snapshot is written, a crash in between leaves older events
+                if event["seq"] > state.seq:
+                    state.apply(event)
+    except FileNotFoundError:
+        pass
+    return state
+
+
+class EventLog:
+    """Append-only log of the game events, committed in groups by a writer thread
+
+    `append` only queues the event, so it never blocks the handlers on the disk. The writer thread writes
+    every queued event and syncs them with a single fsync, then waits `commit_interval` seconds, so there
+    is at most one sync per interval however many answers arrive. It also keeps the state the events
+    build, and every `snapshot_every` events it writes that state to a snapshot and truncates the log,
+    which bounds the time of the replay.
+    """
+
+    def __init__(self, path: str, commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+                 snapshot_every: int = DEFAULT_SNAPSHOT_EVERY, seq: int = 0):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.snapshot_every = snapshot_every
+        self._condition = Condition()
+        self._queue: List[Dict[str, Any]] = []
+        # Sequence number of the last appended event and of the last synced one
+        self._seq = seq
+        self._synced = seq
+        self._state = LogState(seq)
+        self._since_snapshot = 0
+        self._closing = False
+        self._file = None
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def append(self, event_type: str, **fields: Any):
+        """Queue an event for the next commit, it can be called from any thread"""
+        with self._condition:
+            self._seq += 1
+            self._queue.append({"seq": self._seq, "type": event_type, **fields})
+            self._condition.notify()
+
+    def start(self):
+        """Compact the events appended so far into a new snapshot, then start the writer thread
+
+        The server appends the events of the rooms it restores before starting the log, so the snapshot
+        replaces the previous log only once the restored state is on the disk.
+        """
+        with self._condition:
+            batch, self._queue = self._queue, []
+        for event in batch:
+            self._state.apply(event)
+        self._file = open(self.path, "a")
+        self._compact()
+        self._synced = self._state.seq
+        self._thread.start()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every event appended so far is on the disk
+
+        Returns
+        -------
+        bool
+            False if the events are not synced within `timeout` seconds
+        """
+        with self._condition:
+            target = self._seq
+            return self._condition.wait_for(lambda: self._synced >= target, timeout)
+
+    def close(self):
+        """Commit the queued events and stop the writer thread"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        """Target of the writer thread"""
+        while True:
+            with self._condition:
+                while not self._queue and not self._closing:
+                    self._condition.wait()
+                batch, self._queue = self._queue, []
+                closing = self._closing
+            if batch:
+                try:
+                    self._commit(batch)
+                except Exception:
+                    print_exc()
+            if closing:
+                self._file.close()
+                return
+            sleep(self.commit_interval)
+
+    def _commit(self, batch: List[Dict[str, Any]]):
+        """Write and sync a batch of events, then compact the log if it has grown enough"""
+        started = monotonic()
+        self._file.write("".join(json.dumps(event) + "\n" for event in batch))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        COMMIT_SECONDS.observe(monotonic() - started)
+        COMMITS.inc()
+        EVENTS_WRITTEN.inc(len(batch))
+        for event in batch:
+            self._state.apply(event)
+        with self._condition:
+            self._synced = batch[-1]["seq"]
+            self._condition.notify_all()
+        self._since_snapshot += len(batch)
+        if self._since_snapshot >= self.snapshot_every:
+            self._compact()
+
+    def _compact(self):
+        """Write the state to a new snapshot, replacing the previous one atomically, then empty the log"""
+        temporary_path = snapshot_path(self.path) + ".tmp"
+        with open(temporary_path, "w") as snapshot_file:
+            json.dump(self._state.to_obj(), snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, snapshot_path(self.path))
+        self._file.seek(0)
+        self._file.truncate()
+        self._since_snapshot = 0
+        SNAPSHOTS.inc()
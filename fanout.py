@@ -0,0 +1,422 @@
+import asyncio
+import selectors
+from asyncio import StreamWriter
+from collections import deque
+from itertools import islice
+from socket import socket, socketpair, MSG_DONTWAIT, SHUT_RDWR
+from threading import Lock, Thread
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple, Union
+
+from protocol import FrameCompressor, encode_frame
+
+# Policies applied when the queue of a subscriber is full:
+# "drop" discards the new frame, "coalesce" replaces the queued frames of the same channel with the new one,
+# "disconnect" closes the connection of the subscriber
+SLOW_CONSUMER_POLICIES = ("drop", "coalesce", "disconnect")
+DEFAULT_MAX_QUEUE = 256
+# Bytes buffered by an asyncio transport above which the frames are queued by the engine
+ASYNC_HIGH_WATER = 64 * 1024
+# Frames written with a single system call
+MAX_BATCH = 64
+
+
+class _Subscriber:
+    """Outbound queue of a connection"""
+
+    __slots__ = ("connection", "queue", "offset", "closing", "closed", "max_depth", "dropped", "coalesced",
+                 "lock", "flushing", "compressor")
+
+    def __init__(self, connection):
+        self.connection = connection
+        # Set once the connection has negotiated the compression of its frames
+        self.compressor: Optional[FrameCompressor] = None
+        # Queued frames: (channel, data, droppable)
+        self.queue: Deque[Tuple[int, bytes, bool]] = deque()
+        # Bytes of the first queued frame already written
+        self.offset = 0
+        # Close the connection once the queue is empty
+        self.closing = False
+        self.closed = False
+        self.max_depth = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.lock = Lock()
+        self.flushing = False
+
+
+class _FanoutBase:
+    """Shared logic of the fan-out engines: subscribers, bounded queues and slow consumer policies"""
+
+    def __init__(self, max_queue: int = DEFAULT_MAX_QUEUE, policy: str = "drop",
+                 on_disconnect: Optional[Callable[[Any], None]] = None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self._on_disconnect = on_disconnect
+        self._subscribers: Dict[Any, _Subscriber] = {}
+        self.disconnected = 0
+        # Totals since the creation of the engine
+        self.bytes_sent = 0
+        self.frames_dropped = 0
+
+    def register(self, connection):
+        """Start tracking the outbound queue of a connection"""
+        self._subscribers[connection] = _Subscriber(connection)
+
+    def unregister(self, connection):
+        """Forget a connection, its queued frames are discarded unless it is being closed
+
+        Once it returns the engine does not write to the connection anymore, so it can be closed.
+        """
+        subscriber = self._subscribers.pop(connection, None)
+        if subscriber is not None and not subscriber.closing:
+            # Taken to wait for a write in progress
+            with subscriber.lock:
+                subscriber.closed = True
+            self._forget(subscriber)
+
+    def set_compressor(self, connection, compressor: Optional[FrameCompressor]):
+        """Compress the following frames of a connection with `compressor`, None sends them as they are"""
+        subscriber = self._subscribers.get(connection)
+        if subscriber is not None:
+            subscriber.compressor = compressor
+
+    def send(self, connection, message: Union[str, bytes], channel: int) -> bool:
+        """Queue a message for a single connection, it is never dropped by the slow consumer policy
+
+        Returns
+        -------
+        bool
+            False if the connection is not registered anymore
+        """
+        subscriber = self._subscribers.get(connection)
+        if subscriber is None or subscriber.closed:
+            return False
+        compressor = subscriber.compressor
+        data = encode_frame(message, channel) if compressor is None else compressor.encode_frame(message, channel)
+        self._enqueue(subscriber, channel, data, False)
+        return True
+
+    def publish(self, connections: Iterable[Any], message: Union[str, bytes], channel: int, droppable: bool = True):
+        """Encode a message once, and once for every compressor in use, then queue it for every connection
+
+        Parameters
+        ----------
+        connections : Iterable[Any]
+            connections that receive the message
+        message : str | bytes
+            message to send
+        channel : int
+            channel of the message
+        droppable : bool
+            whether the slow consumer policy applies to the message, a message the following ones depend on
+            must always be delivered
+        """
+        # Frames by compressor, None for the uncompressed one, encoded when the first subscriber needs them
+        frames: Dict[Optional[FrameCompressor], bytes] = {}
+        for connection in connections:
+            subscriber = self._subscribers.get(connection)
+            if subscriber is not None and not subscriber.closed:
+                compressor = subscriber.compressor
+                data = frames.get(compressor)
+                if data is None:
+                    data = frames[compressor] = (encode_frame(message, channel) if compressor is None
+                                                 else compressor.encode_frame(message, channel))
+                self._enqueue(subscriber, channel, data, droppable)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Queue metrics of every subscriber
+
+        Returns
+        -------
+        list[dict]
+            for every subscriber its connection, the current and maximum queue depth, the dropped and the
+            coalesced frames
+        """
+        return [{
+            "connection": subscriber.connection,
+            "depth": len(subscriber.queue),
+            "max_depth": subscriber.max_depth,
+            "dropped": subscriber.dropped,
+            "coalesced": subscriber.coalesced
+        } for subscriber in list(self._subscribers.values())]
+
+    def _admit(self, subscriber: _Subscriber, channel: int, data: bytes, droppable: bool) -> bool:
+        """Apply the slow consumer policy, then queue the frame. Must be called holding the subscriber lock
+
+        Returns
+        -------
+        bool
+            True if the frame has been queued
+        """
+        queue = subscriber.queue
+        if droppable and len(queue) >= self.max_queue:
+            if self.policy == "drop":
+                subscriber.dropped += 1
+                self.frames_dropped += 1
+                return False
+            if self.policy == "disconnect":
+                subscriber.closed = True
+                return False
+            # The first frame may be partially written, it cannot be replaced
+            head = [queue.popleft()] if subscriber.offset else []
+            kept = [frame for frame in queue if not (frame[2] and frame[0] == channel)]
+            subscriber.coalesced += len(queue) - len(kept)
+            queue.clear()
+            queue.extend(head + kept)
+            if len(queue) >= self.max_queue:
+                subscriber.dropped += 1
+                self.frames_dropped += 1
+                return False
+        queue.append((channel, data, droppable))
+        subscriber.max_depth = max(subscriber.max_depth, len(queue))
+        return True
+
+    def _disconnect(self, subscriber: _Subscriber):
+        """Forget a subscriber whose connection is broken or too slow, then notify the server"""
+        if self._subscribers.pop(subscriber.connection, None) is None:
+            return
+        subscriber.closed = True
+        self.disconnected += 1
+        if self._on_disconnect is not None:
+            self._on_disconnect(subscriber.connection)
+
+    def _enqueue(self, subscriber: _Subscriber, channel: int, data: bytes, droppable: bool):
+        raise NotImplementedError
+
+    def _forget(self, subscriber: _Subscriber):
+        """Release the resources the engine holds for an unregistered subscriber"""
+
+
+class FanoutEngine(_FanoutBase):
+    """Fan-out engine of the threaded server
+
+    The frames are queued by the handler threads and written by a single writer thread with non-blocking
+    sends, so a stalled subscriber never blocks the thread of the player that produced the message.
+    """
+
+    def __init__(self, max_queue: int = DEFAULT_MAX_QUEUE, policy: str = "drop",
+                 on_disconnect: Optional[Callable[[Any], None]] = None):
+        super().__init__(max_queue, policy, on_disconnect)
+        self._selector = selectors.DefaultSelector()
+        self._ready_lock = Lock()
+        self._ready: Dict[_Subscriber, None] = {}
+        self._wake_reader, self._wake_writer = socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the writer thread"""
+        self._thread.start()
+
+    def close(self, connection: socket):
+        """Close a connection once its queued frames have been written"""
+        subscriber = self._subscribers.get(connection)
+        if subscriber is None:
+            connection.close()
+            return
+        subscriber.closing = True
+        self._mark_ready(subscriber)
+
+    def _enqueue(self, subscriber: _Subscriber, channel: int, data: bytes, droppable: bool):
+        with subscriber.lock:
+            self._admit(subscriber, channel, data, droppable)
+        self._mark_ready(subscriber)
+
+    def _forget(self, subscriber: _Subscriber):
+        # The writer thread owns the selector, let it drop the registration of the socket
+        self._mark_ready(subscriber)
+
+    def _mark_ready(self, subscriber: _Subscriber):
+        """Hand a subscriber to the writer thread"""
+        with self._ready_lock:
+            wake = not self._ready
+            self._ready[subscriber] = None
+        if wake:
+            try:
+                self._wake_writer.send(b"\0")
+            except BlockingIOError:
+                # The writer thread has already been woken up
+                pass
+
+    def _run(self):
+        """Target of the writer thread"""
+        while True:
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wake_reader:
+                    try:
+                        while self._wake_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._mark_ready(key.data)
+
+            with self._ready_lock:
+                ready = list(self._ready)
+                self._ready.clear()
+            for subscriber in ready:
+                self._flush(subscriber)
+
+    def _flush(self, subscriber: _Subscriber):
+        """Write as much of the queue of a subscriber as the socket accepts without blocking"""
+        sock = subscriber.connection
+        with subscriber.lock:
+            if subscriber.closed:
+                self._stop_watching(subscriber)
+                if sock in self._subscribers:
+                    # Still registered, so it has been closed by the disconnect policy
+                    self._shutdown(subscriber)
+                return
+            try:
+                while subscriber.queue:
+                    # Gather the queued frames in a single system call, without copying them
+                    buffers = [memoryview(frame[1]) for frame in islice(subscriber.queue, MAX_BATCH)]
+                    buffers[0] = buffers[0][subscriber.offset:]
+                    sent = sock.sendmsg(buffers, (), MSG_DONTWAIT)
+                    self.bytes_sent += sent
+                    if not self._consume(subscriber, sent):
+                        # The socket buffer is full
+                        break
+            except BlockingIOError:
+                pass
+            except OSError:
+                subscriber.queue.clear()
+                self._stop_watching(subscriber)
+                self._disconnect(subscriber)
+                return
+
+            if subscriber.queue:
+                # Wait until the socket is writable again
+                self._watch(subscriber)
+                return
+            self._stop_watching(subscriber)
+            if subscriber.closing:
+                self._subscribers.pop(sock, None)
+                subscriber.closed = True
+                sock.close()
+
+    @staticmethod
+    def _consume(subscriber: _Subscriber, sent: int) -> bool:
+        """Remove from the queue the frames written by a send of `sent` bytes
+
+        Returns
+        -------
+        bool
+            True if every frame passed to the send has been completely written
+        """
+        queue = subscriber.queue
+        while sent and queue:
+            remaining = len(queue[0][1]) - subscriber.offset
+            if sent < remaining:
+                subscriber.offset += sent
+                return False
+            sent -= remaining
+            queue.popleft()
+            subscriber.offset = 0
+        return True
+
+    def _shutdown(self, subscriber: _Subscriber):
+        """Close the connection of a subscriber dropped by the slow consumer policy"""
+        try:
+            subscriber.connection.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self._disconnect(subscriber)
+
+    def _watch(self, subscriber: _Subscriber):
+        sock = subscriber.connection
+        try:
+            self._selector.register(sock, selectors.EVENT_WRITE, subscriber)
+        except KeyError:
+            # The descriptor is already registered, either for this subscriber or for a closed socket
+            # whose descriptor number has been reused: replace the registration
+            self._selector.unregister(sock.fileno())
+            self._selector.register(sock, selectors.EVENT_WRITE, subscriber)
+
+    def _stop_watching(self, subscriber: _Subscriber):
+        try:
+            self._selector.unregister(subscriber.connection)
+        except (KeyError, ValueError):
+            pass
+
+
+class AsyncFanoutEngine(_FanoutBase):
+    """Fan-out engine of the asyncio server
+
+    The frames queued during an iteration of the event loop are written at its end with a single write
+    for each subscriber. When the buffer of a transport exceeds `ASYNC_HIGH_WATER` the frames wait in the
+    bounded queue of the subscriber until the transport drains.
+    """
+
+    def __init__(self, max_queue: int = DEFAULT_MAX_QUEUE, policy: str = "drop",
+                 on_disconnect: Optional[Callable[[Any], None]] = None):
+        super().__init__(max_queue, policy, on_disconnect)
+        self._dirty: Dict[_Subscriber, None] = {}
+
+    def close(self, writer: StreamWriter):
+        """Close a connection once its queued frames have been written"""
+        subscriber = self._subscribers.pop(writer, None)
+        if subscriber is not None and not subscriber.closed:
+            subscriber.closed = True
+            # The transport writes its buffer before closing the socket
+            self._write(writer, [frame[1] for frame in subscriber.queue])
+            subscriber.queue.clear()
+        writer.close()
+
+    def _enqueue(self, subscriber: _Subscriber, channel: int, data: bytes, droppable: bool):
+        writer: StreamWriter = subscriber.connection
+        if writer.is_closing():
+            self._disconnect(subscriber)
+            return
+        # The frames of a single iteration are written together at its end, so the slow consumer policy
+        # only applies to subscribers whose transport is already congested
+        self._admit(subscriber, channel, data, droppable and subscriber.flushing)
+        if subscriber.closed:
+            # Closed by the disconnect policy
+            writer.close()
+            self._disconnect(subscriber)
+            return
+        if not subscriber.flushing:
+            if not self._dirty:
+                asyncio.get_running_loop().call_soon(self._write_dirty)
+            self._dirty[subscriber] = None
+
+    def _write(self, writer: StreamWriter, frames: List[bytes]):
+        """Hand frames to the transport of a subscriber"""
+        writer.writelines(frames)
+        self.bytes_sent += sum(map(len, frames))
+
+    def _write_dirty(self):
+        """Write the frames queued during the last iteration of the event loop"""
+        dirty = self._dirty
+        self._dirty = {}
+        for subscriber in dirty:
+            if subscriber.closed or subscriber.flushing:
+                continue
+            writer: StreamWriter = subscriber.connection
+            if writer.transport.get_write_buffer_size() < ASYNC_HIGH_WATER:
+                self._write(writer, [frame[1] for frame in subscriber.queue])
+                subscriber.queue.clear()
+            else:
+                subscriber.flushing = True
+                asyncio.ensure_future(self._flush(subscriber))
+
+    async def _flush(self, subscriber: _Subscriber):
+        """Wait for the transport to drain, then write the queued frames"""
+        writer: StreamWriter = subscriber.connection
+        try:
+            while subscriber.queue and not subscriber.closed:
+                await writer.drain()
+                frames = []
+                while subscriber.queue and len(frames) < MAX_BATCH:
+                    frames.append(subscriber.queue.popleft()[1])
+                self._write(writer, frames)
+        except (ConnectionError, OSError):
+            subscriber.queue.clear()
+            self._disconnect(subscriber)
+        finally:
+            subscriber.flushing = False
@@ -0,0 +1,278 @@
+from collections import OrderedDict
+from itertools import count
+from threading import RLock
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Tuple
+
+
+class _FenwickTree:
+    """Binary indexed tree counting the players of each score in a window of scores
+
+    Scores outside the window make it grow, re-centering it around the current range. The size of the window
+    stays a power of two, so the scores can be found by rank with a single descent of the tree.
+    """
+
+    def __init__(self, size: int = 64):
+        self._size = size
+        # Score stored at index 0
+        self._low = -(size // 2)
+        self._tree = [0] * (size + 1)
+
+    def add(self, score: int, count: int):
+        """Add `count` players to `score`"""
+        index = score - self._low + 1
+        while index <= self._size:
+            self._tree[index] += count
+            index += index & -index
+
+    def count_up_to(self, score: int) -> int:
+        """Number of players whose score is lower than or equal to `score`"""
+        index = min(score - self._low + 1, self._size)
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    def find(self, rank: int) -> int:
+        """Score of the player at position `rank` (1 based) in ascending order, `rank` must not exceed the
+        number of players"""
+        index = 0
+        step = self._size
+        while step:
+            upper = index + step
+            if upper <= self._size and self._tree[upper] < rank:
+                index = upper
+                rank -= self._tree[upper]
+            step //= 2
+        return self._low + index
+
+    def covers(self, score: int) -> bool:
+        """Check if `score` lies inside the window"""
+        return self._low <= score < self._low + self._size
+
+    def rebuild(self, counts: Dict[int, int]):
+        """Resize the window so that it covers every score in `counts`, then reload the counts"""
+        low, high = min(counts), max(counts)
+        while self._size < 2 * (high - low + 1):
+            self._size *= 2
+        self._low = (low + high) // 2 - self._size // 2
+        self._tree = [0] * (self._size + 1)
+        for score, count in counts.items():
+            self.add(score, count)
+
+
+class Leaderboard:
+    """Index of the scores of the players, kept ordered while the scores change
+
+    The players are grouped in buckets by score and a Fenwick tree counts the players of each score. It gives
+    the rank of a score, and finds the scores by rank to walk the buckets from the best score down, so no
+    sorted list of scores is kept. A score change or a rank lookup costs O(log r), r being the width of the
+    window of scores covered by the tree. A score outside the window rebuilds the tree over twice the range
+    of scores, so the rebuilds are amortized over the changes that widen or move the range.
+    When `track_changes` is set, the players changed since the last call to `drain_changes` are tracked,
+    so that only the deltas need to be sent to the clients.
+    """
+
+    def __init__(self, track_changes: bool = False):
+        self._lock = RLock()
+        self._track_changes = track_changes
+        # Stable numeric id of each player, used by the clients to apply the deltas
+        self._ids: Dict[Hashable, int] = {}
+        self._next_id = count(1)
+        self._changed: Dict[Hashable, None] = {}
+        self._removed: List[int] = []
+        self._names: Dict[Hashable, str] = {}
+        self._scores: Dict[Hashable, int] = {}
+        # Players having a certain score, in the order they reached it
+        self._buckets: Dict[int, Dict[Hashable, None]] = {}
+        self._counts = _FenwickTree()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, key):
+        return key in self._scores
+
+    def add(self, key: Hashable, name: str, score: int = 0):
+        """Add a player to the leaderboard
+
+        Parameters
+        ----------
+        key : Hashable
+            key identifying the player, for example its connection
+        name : str
+            name shown in the leaderboard
+        score : int
+            initial score (default is 0)
+        """
+        with self._lock:
+            if key in self._scores:
+                self._remove_from_bucket(key, self._scores[key])
+            else:
+                self._ids[key] = next(self._next_id)
+            if self._track_changes:
+                self._changed[key] = None
+            self._names[key] = name
+            self._scores[key] = score
+            self._add_to_bucket(key, score)
+
+    def remove(self, key: Hashable):
+        """Remove a player from the leaderboard, if present"""
+        with self._lock:
+            if key not in self._scores:
+                return
+            self._remove_from_bucket(key, self._scores.pop(key))
+            del self._names[key]
+            removed_id = self._ids.pop(key)
+            if self._track_changes:
+                self._changed.pop(key, None)
+                self._removed.append(removed_id)
+
+    def rekey(self, old_key: Hashable, new_key: Hashable):
+        """Give a player a new key, keeping its id, its name and its score
+
+        The player becomes the last one to have reached its score.
+        """
+        with self._lock:
+            score = self._scores.pop(old_key)
+            self._remove_from_bucket(old_key, score)
+            self._scores[new_key] = score
+            self._add_to_bucket(new_key, score)
+            self._ids[new_key] = self._ids.pop(old_key)
+            self._names[new_key] = self._names.pop(old_key)
+            if old_key in self._changed:
+                del self._changed[old_key]
+                self._changed[new_key] = None
+
+    def update(self, key: Hashable, delta: int) -> int:
+        """Add `delta` to the score of a player
+
+        Returns
+        -------
+        int
+            the updated score
+        """
+        with self._lock:
+            old_score = self._scores[key]
+            new_score = old_score + delta
+            self._remove_from_bucket(key, old_score)
+            self._scores[key] = new_score
+            self._add_to_bucket(key, new_score)
+            if self._track_changes:
+                self._changed[key] = None
+            return new_score
+
+    def score(self, key: Hashable) -> int:
+        """Score of a player"""
+        return self._scores[key]
+
+    def name(self, key: Hashable) -> str:
+        """Name of a player"""
+        return self._names[key]
+
+    def rank(self, key: Hashable) -> int:
+        """Position of a player, players with the same score share the same position
+
+        Returns
+        -------
+        int
+            1 plus the number of players with a higher score
+        """
+        with self._lock:
+            return len(self._scores) - self._counts.count_up_to(self._scores[key]) + 1
+
+    def count_above(self, score: int) -> int:
+        """Number of players whose score is higher than `score`"""
+        with self._lock:
+            return len(self._scores) - self._counts.count_up_to(score)
+
+    def player_id(self, key: Hashable) -> int:
+        """Stable numeric id of a player, the one used in the rows and in the deltas"""
+        return self._ids[key]
+
+    def top(self, k: Optional[int] = None) -> List[Tuple[str, int]]:
+        """Best `k` players (every player if `k` is None) ordered by score descending
+
+        Returns
+        -------
+        list[tuple[str, int]]
+            pairs of name and score
+        """
+        with self._lock:
+            result = []
+            for score in self._descending_scores():
+                for key in self._buckets[score]:
+                    if k is not None and len(result) >= k:
+                        return result
+                    result.append((self._names[key], score))
+            return result
+
+    def ordered(self) -> "OrderedDict[str, int]":
+        """Whole leaderboard as an ordered mapping from name to score, best player first"""
+        return OrderedDict(self.top())
+
+    def winners(self) -> Optional[Tuple[int, List[str]]]:
+        """Best score and the names of the players having it, sorted by name
+
+        Returns
+        -------
+        tuple[int, list[str]] | None
+            the winner score and the winner names, None if the leaderboard is empty
+        """
+        with self._lock:
+            if not self._scores:
+                return None
+            best_score = self._counts.find(len(self._scores))
+            return best_score, sorted(self._names[key] for key in self._buckets[best_score])
+
+    def rows(self) -> List[Tuple[int, str, int]]:
+        """Whole leaderboard as (id, name, score) rows, best player first"""
+        with self._lock:
+            return [(self._ids[key], self._names[key], score)
+                    for score in self._descending_scores() for key in self._buckets[score]]
+
+    def drain_changes(self) -> Tuple[List[Tuple[int, str, int]], List[int]]:
+        """Return the players changed and removed since the previous call, then forget them
+
+        Returns
+        -------
+        tuple[list[tuple[int, str, int]], list[int]]
+            the (id, name, score) rows of the changed players and the ids of the removed ones
+        """
+        with self._lock:
+            updated = [(self._ids[key], self._names[key], self._scores[key]) for key in self._changed]
+            removed = self._removed
+            self._changed = {}
+            self._removed = []
+            return updated, removed
+
+    def snapshot(self) -> Dict[Any, Tuple[str, int]]:
+        """Consistent copy of the leaderboard keyed by player, with its name and score"""
+        with self._lock:
+            return {key: (self._names[key], score) for key, score in self._scores.items()}
+
+    def _descending_scores(self) -> Iterator[int]:
+        """Distinct scores from the best one down, must be iterated holding the lock"""
+        remaining = len(self._scores)
+        while remaining:
+            # The best score among the `remaining` lowest players
+            score = self._counts.find(remaining)
+            yield score
+            remaining -= len(self._buckets[score])
+
+    def _add_to_bucket(self, key: Hashable, score: int):
+        bucket = self._buckets.get(score)
+        if bucket is None:
+            bucket = self._buckets[score] = {}
+        bucket[key] = None
+        if not self._counts.covers(score):
+            self._counts.rebuild({s: len(b) for s, b in self._buckets.items()})
+        else:
+            self._counts.add(score, 1)
+
+    def _remove_from_bucket(self, key: Hashable, score: int):
+        bucket = self._buckets[score]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[score]
+        self._counts.add(score, -1)
@@ -0,0 +1,262 @@
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# Upper bounds in seconds of the buckets of the timing histograms
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """Monotonic counter, or a function returning the current total of a counter kept elsewhere"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help_text = help_text
+        self._function = function
+        self._value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1):
+        """Add `amount` to the counter"""
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._function() if self._function is not None else self._value
+
+    def samples(self) -> List[Tuple[str, float]]:
+        """(name with labels, value) pairs of the exposition format"""
+        return [(self.name, self.value)]
+
+    def summary(self) -> str:
+        return f"{self.name}={_format_value(self.value)}"
+
+
+class Gauge(Counter):
+    """Value that can go up and down, usually read from a function when the metrics are collected"""
+
+    kind = "gauge"
+
+    def set(self, value: float):
+        """Set the current value"""
+        with self._lock:
+            self._value = value
+
+
+class Histogram:
+    """Distribution of durations in fixed buckets
+
+    Recording a value costs a binary search and an increment under a lock, cheap enough for the hot paths.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self._bounds = list(buckets)
+        # The last bucket counts the values above every bound
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        """Record a value"""
+        index = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self) -> "_Timer":
+        """Context manager recording the duration of its block"""
+        return _Timer(self)
+
+    def wrap(self, function: Callable) -> Callable:
+        """Wrap `function` so that the duration of every call is recorded"""
+        @wraps(function)
+        def timed(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(perf_counter() - started)
+        return timed
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the `q` quantile, None if nothing has been recorded
+
+        Parameters
+        ----------
+        q : float
+            quantile between 0 and 1
+        """
+        with self._lock:
+            counts = list(self._counts)
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank, seen = q * total, 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self._bounds[index] if index < len(self._bounds) else float("inf")
+        return float("inf")
+
+    def samples(self) -> List[Tuple[str, float]]:
+        """(name with labels, value) pairs of the exposition format, the buckets are cumulative"""
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+        samples, cumulative = [], 0
+        for bound, count in zip(self._bounds + [float("inf")], counts):
+            cumulative += count
+            label = "+Inf" if bound == float("inf") else f"{bound:g}"
+            samples.append((f'{self.name}_bucket{{le="{label}"}}', cumulative))
+        samples.append((f"{self.name}_sum", total_sum))
+        samples.append((f"{self.name}_count", cumulative))
+        return samples
+
+    def summary(self) -> str:
+        count = self.count
+        if count == 0:
+            return f"{self.name}: no samples"
+        mean = self._sum / count
+        return (f"{self.name}: count={count} mean={mean * 1000:.3f}ms "
+                f"p50<={self.quantile(0.5) * 1000:g}ms p99<={self.quantile(0.99) * 1000:g}ms")
+
+
+class _Timer:
+    """Context manager returned by `Histogram.time`"""
+
+    __slots__ = ("_histogram", "_started")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(perf_counter() - self._started)
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+def _format_value(value: float) -> str:
+    """Value in the exposition format, integers are written without exponent"""
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """Metrics of the process, by name
+
+    Asking twice for the same name returns the same metric, so every module can declare the metrics it
+    records without knowing who else records them.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = Lock()
+
+    def counter(self, name: str, help_text: str, function: Optional[Callable[[], float]] = None) -> Counter:
+        return self._get_or_create(Counter, name, help_text, function)
+
+    def gauge(self, name: str, help_text: str, function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text, function)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, buckets)
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name} {_format_value(value)}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def dump(self) -> str:
+        """Short human readable summary of every metric"""
+        return "\n".join(f"[metrics] {metric.summary()}" for metric in list(self._metrics.values()))
+
+    def _get_or_create(self, kind, name: str, help_text: str, argument):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = kind(name, help_text, argument)
+            elif type(metric) is not kind:
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+
+# Registry of the process
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, help_text: str, function: Optional[Callable[[], float]] = None) -> Counter:
+    """Counter of the process registry"""
+    return REGISTRY.counter(name, help_text, function)
+
+
+def gauge(name: str, help_text: str, function: Optional[Callable[[], float]] = None) -> Gauge:
+    """Gauge of the process registry"""
+    return REGISTRY.gauge(name, help_text, function)
+
+
+def histogram(name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """Histogram of the process registry"""
+    return REGISTRY.histogram(name, help_text, buckets)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the process registry on /metrics"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to be logged
+        pass
+
+
+def serve_metrics(address: Tuple[str, int]) -> ThreadingHTTPServer:
+    """Serve the metrics of the process on http://host:port/metrics from a daemon thread"""
+    server = ThreadingHTTPServer(address, _MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def dump_periodically(interval: float, output: Callable[[str], None] = print):
+    """Write the summary of the metrics every `interval` seconds from a daemon thread"""
+    def dump():
+        while True:
+            sleep(interval)
+            output(REGISTRY.dump())
+    Thread(target=dump, daemon=True).start()
@@ -0,0 +1,286 @@
+import struct
+import zlib
+from asyncio import StreamReader
+from collections import deque
+from socket import socket
+from typing import Deque, List, Optional, Tuple, Union
+
+import metrics
+
+# Version of the frame format, bumped whenever the header layout changes
+PROTOCOL_VERSION = 2
+# Frame header: version (1 byte), flags (1 byte), channel (1 byte), payload length (4 bytes, big endian)
+HEADER = struct.Struct("!BBBI")
+# Upper bound of a single payload, larger frames are considered corrupted
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Size of the chunks read from the sockets
+READ_SIZE = 64 * 1024
+
+# Channels multiplexed over the connection of a player
+CHANNEL_GAME = 0
+CHANNEL_BROADCAST = 1
+CHANNEL_LEADERBOARD = 2
+# Negotiation between a client and the server, for example of the encoding of the structured messages
+CHANNEL_CONTROL = 3
+CHANNELS = (CHANNEL_GAME, CHANNEL_BROADCAST, CHANNEL_LEADERBOARD, CHANNEL_CONTROL)
+# Message sent by a client on the broadcast or leaderboard channel to receive its messages
+SUBSCRIBE_MESSAGE = "SUBSCRIBE"
+
+# Flag of the frames whose payload is binary, the other payloads are utf8 text
+FLAG_BINARY = 0x01
+# Flag of the frames whose payload is compressed with raw deflate and the negotiated preset dictionary
+FLAG_COMPRESSED = 0x02
+# Base two logarithm of the deflate window, which bounds the useful length of a preset dictionary
+WINDOW_BITS = 13
+# Payloads shorter than this are not worth compressing
+DEFAULT_COMPRESSION_THRESHOLD = 256
+# Compression level and memory level of deflate, chosen for a cheap setup of the compressor of every frame
+COMPRESSION_LEVEL = 6
+COMPRESSION_MEMORY_LEVEL = 4
+
+COMPRESS_SECONDS = metrics.histogram("chat_compress_seconds", "Time spent compressing a frame")
+COMPRESSED_BYTES_IN = metrics.counter("chat_compressed_bytes_in_total", "Bytes of the payloads given to deflate")
+COMPRESSED_BYTES_OUT = metrics.counter("chat_compressed_bytes_out_total", "Bytes of the payloads deflate produced")
+
+# A decoded frame: its channel and its message, bytes for the binary frames
+Frame = Tuple[int, Union[str, bytes]]
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a frame that does not respect the protocol"""
+
+
+def encode_frame(message: Union[str, bytes], channel: int = CHANNEL_GAME) -> bytes:
+    """Encode a message into a frame ready to be written on a socket
+
+    Parameters
+    ----------
+    message : str | bytes
+        message to encode, strings are encoded with utf8 and bytes are sent as a binary payload
+    channel : int
+        channel the message belongs to (default is the game channel)
+
+    Returns
+    -------
+    bytes
+        the header followed by the payload
+    """
+    if isinstance(message, str):
+        payload, flags = message.encode("utf8"), 0
+    else:
+        payload, flags = message, FLAG_BINARY
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Message of {len(payload)} bytes exceeds the maximum frame size")
+    return HEADER.pack(PROTOCOL_VERSION, flags, channel, len(payload)) + payload
+
+
+class FrameCompressor:
+    """Encodes frames compressing the payloads of at least `threshold` bytes with a preset dictionary
+
+    A payload that deflate does not make shorter is sent as it is.
+    """
+
+    def __init__(self, dictionary: bytes, threshold: int = DEFAULT_COMPRESSION_THRESHOLD):
+        self.dictionary = dictionary
+        self.threshold = threshold
+
+    def encode_frame(self, message: Union[str, bytes], channel: int = CHANNEL_GAME) -> bytes:
+        """Encode a message into a frame like `encode_frame`, compressing its payload if it is worth it"""
+        if isinstance(message, str):
+            payload, flags = message.encode("utf8"), 0
+        else:
+            payload, flags = message, FLAG_BINARY
+        if len(payload) < self.threshold:
+            return encode_frame(message, channel)
+        with COMPRESS_SECONDS.time():
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -WINDOW_BITS, COMPRESSION_MEMORY_LEVEL,
+                                          zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+            compressed = compressor.compress(payload) + compressor.flush()
+        COMPRESSED_BYTES_IN.inc(len(payload))
+        COMPRESSED_BYTES_OUT.inc(len(compressed))
+        if len(compressed) >= len(payload):
+            return encode_frame(message, channel)
+        return HEADER.pack(PROTOCOL_VERSION, flags | FLAG_COMPRESSED, channel, len(compressed)) + compressed
+
+
+class FrameDecoder:
+    """Incremental decoder of a stream of frames
+
+    The received bytes are stored in a single reusable buffer: the data is read directly into it
+    and the payloads are decoded from a view of it, so no intermediate strings are built.
+    """
+
+    def __init__(self, initial_size: int = READ_SIZE, dictionary: Optional[bytes] = None):
+        self._buffer = bytearray(initial_size)
+        self._view = memoryview(self._buffer)
+        # Unread data lies between _start and _end
+        self._start = 0
+        self._end = 0
+        # Bytes received since the creation of the decoder
+        self.bytes_received = 0
+        # Preset dictionary of the compressed frames, the one offered to the server
+        self.dictionary = dictionary
+
+    def recv_from(self, sock: socket) -> List[Frame]:
+        """Read the available bytes from a blocking socket and return the completed frames
+
+        Parameters
+        ----------
+        sock : socket
+            socket to read from
+
+        Returns
+        -------
+        list[tuple[int, str | bytes]]
+            the (channel, message) frames completed by this read, possibly empty
+
+        Raises
+        ------
+        ConnectionResetError
+            if the peer closed the connection
+        """
+        self._reserve(READ_SIZE)
+        received = sock.recv_into(self._view[self._end:])
+        if received == 0:
+            raise ConnectionResetError("Connection closed by the peer")
+        self._end += received
+        self.bytes_received += received
+        return self._decode()
+
+    def feed(self, data: bytes) -> List[Frame]:
+        """Append `data` to the buffer and return the completed frames
+
+        Parameters
+        ----------
+        data : bytes
+            bytes received from the stream
+
+        Returns
+        -------
+        list[tuple[int, str | bytes]]
+            the (channel, message) frames completed by `data`, possibly empty
+        """
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        self.bytes_received += len(data)
+        return self._decode()
+
+    def _decode(self) -> List[Frame]:
+        """Decode every complete frame in the buffer"""
+        frames = []
+        while self._end - self._start >= HEADER.size:
+            version, flags, channel, length = HEADER.unpack_from(self._buffer, self._start)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Unsupported protocol version {version}")
+            if channel not in CHANNELS:
+                raise ProtocolError(f"Unknown channel {channel}")
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {length} bytes exceeds the maximum frame size")
+            frame_end = self._start + HEADER.size + length
+            if frame_end > self._end:
+                # Make room for the rest of the frame so the next read can complete it
+                self._reserve(frame_end - self._end)
+                break
+            payload = self._view[self._start + HEADER.size:frame_end]
+            if flags & FLAG_COMPRESSED:
+                payload = self._decompress(payload)
+            frames.append((channel, bytes(payload) if flags & FLAG_BINARY else str(payload, "utf8")))
+            self._start = frame_end
+
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frames
+
+    def _decompress(self, payload: memoryview) -> bytes:
+        """Payload of a compressed frame
+
+        Raises
+        ------
+        ProtocolError
+            if the payload is corrupted or expands beyond the maximum frame size
+        """
+        if self.dictionary is None:
+            decompressor = zlib.decompressobj(-WINDOW_BITS)
+        else:
+            decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=self.dictionary)
+        try:
+            data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+        except zlib.error as error:
+            raise ProtocolError(f"Corrupted compressed frame: {error}") from error
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ProtocolError("Compressed frame exceeds the maximum frame size or is truncated")
+        return data
+
+    def _reserve(self, size: int):
+        """Ensure that at least `size` bytes are free at the end of the buffer"""
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size > len(self._buffer):
+            # Grow the buffer, this only happens for frames larger than the current buffer
+            new_buffer = bytearray(max(pending + size, 2 * len(self._buffer)))
+            new_buffer[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._buffer = new_buffer
+            self._view = memoryview(self._buffer)
+        else:
+            # Move the unread data to the beginning of the buffer
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+
+class MessageReader:
+    """Reader of framed messages from a blocking socket"""
+
+    def __init__(self, sock: socket, dictionary: Optional[bytes] = None):
+        self._sock = sock
+        self._decoder = FrameDecoder(dictionary=dictionary)
+        self._pending: Deque[Frame] = deque()
+
+    @property
+    def bytes_received(self) -> int:
+        """Bytes read from the socket so far"""
+        return self._decoder.bytes_received
+
+    def read_frame(self) -> Frame:
+        """Block until a whole frame is received, then return it
+
+        Returns
+        -------
+        tuple[int, str | bytes]
+            the channel and the message of the next frame sent by the peer
+        """
+        while not self._pending:
+            self._pending.extend(self._decoder.recv_from(self._sock))
+        return self._pending.popleft()
+
+
+class AsyncMessageReader:
+    """Reader of framed messages from an asyncio stream"""
+
+    def __init__(self, reader: StreamReader, dictionary: Optional[bytes] = None):
+        self._reader = reader
+        self._decoder = FrameDecoder(dictionary=dictionary)
+        self._pending: Deque[Frame] = deque()
+
+    @property
+    def bytes_received(self) -> int:
+        """Bytes read from the stream so far"""
+        return self._decoder.bytes_received
+
+    async def read_frame(self) -> Frame:
+        """Wait until a whole frame is received, then return it
+
+        Returns
+        -------
+        tuple[int, str | bytes]
+            the channel and the message of the next frame sent by the peer
+        """
+        while not self._pending:
+            data = await self._reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionResetError("Connection closed by the peer")
+            self._pending.extend(self._decoder.feed(data))
+        return self._pending.popleft()
@@ -0,0 +1,387 @@
+import argparse
+import json
+import os
+from socket import (AF_INET, AF_UNIX, IPPROTO_TCP, SHUT_RDWR, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, TCP_NODELAY,
+                    socket)
+from threading import Event, Lock, Thread
+from traceback import print_exc
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import metrics
+from fanout import FanoutEngine
+from protocol import CHANNEL_GAME, MessageReader, ProtocolError, encode_frame
+
+# Commands of the broker protocol, every frame is a json list starting with the command:
+# ["SUB", topic] subscribes the connection to a topic, ["PUB", topic, message] publishes a message on it and is
+# forwarded as it is to the subscribers, ["WILL", topic, message] is published by the broker when the connection
+# breaks, so the other nodes learn that a node has left
+SUBSCRIBE = "SUB"
+PUBLISH = "PUB"
+LAST_WILL = "WILL"
+# Address given on the command line to run a node alone on an in-process bus
+LOOPBACK = "loopback"
+DEFAULT_BROKER_PORT = 53100
+# Frames queued for a node before the broker disconnects it, the node then resynchronizes its state
+DEFAULT_BROKER_QUEUE = 4096
+# Seconds between two attempts to reach the broker
+RECONNECT_DELAY = 1.0
+
+MESSAGES_PUBLISHED = metrics.counter("chat_bus_messages_published_total", "Messages published on the pub/sub bus")
+MESSAGES_RECEIVED = metrics.counter("chat_bus_messages_received_total",
+                                    "Messages of the subscribed topics received from the pub/sub bus")
+MESSAGES_LOST = metrics.counter("chat_bus_messages_lost_total",
+                                "Messages that could not be published because the broker was unreachable")
+BUS_CONNECTIONS = metrics.counter("chat_bus_connections_total", "Connections to the broker, reconnections included")
+
+# Unix socket path, or (host, port) of a TCP socket
+BusAddress = Union[str, Tuple[str, int]]
+# Handler of the messages of a topic, invoked with the message
+MessageHandler = Callable[[str], None]
+
+
+def parse_bus_address(value: str) -> BusAddress:
+    """Address of a broker given on the command line: "host:port", ":port" for this host, or a Unix socket path
+
+    Raises
+    ------
+    ValueError
+        if the port is not a number
+    """
+    if os.sep in value or ":" not in value:
+        return value
+    host, _, port = value.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def bus_socket(address: BusAddress) -> socket:
+    """Unconnected socket of the family of the address"""
+    if isinstance(address, str):
+        return socket(AF_UNIX, SOCK_STREAM)
+    sock = socket(AF_INET, SOCK_STREAM)
+    # The messages are small and latency sensitive, like the frames of the players
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    return sock
+
+
+class Bus:
+    """Publish/subscribe bus connecting the nodes of a cluster
+
+    A message published on a topic is delivered to every handler subscribed to it, on every node, the
+    publishing node included, and the messages of a node are delivered in the order it published them. The
+    handlers must not block: they run on a thread of the bus, or on the publishing thread for the loopback bus.
+    A bus may lose the messages published while a node is disconnected from it, so the callbacks registered with
+    `on_connect` run every time it connects, once its subscriptions are in place, to resynchronize the state.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, List[MessageHandler]] = {}
+        self._connect_listeners: List[Callable[[], None]] = []
+        self._will: Optional[Tuple[str, str]] = None
+
+    def subscribe(self, topic: str, handler: MessageHandler):
+        """Invoke `handler` with every message published on `topic`, it must be called before `start`"""
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def on_connect(self, callback: Callable[[], None]):
+        """Invoke `callback` every time the node connects to the bus, it must be called before `start`"""
+        self._connect_listeners.append(callback)
+
+    def set_last_will(self, topic: str, message: str):
+        """Message published on `topic` on behalf of the node when it leaves the bus, whether it closes the bus or
+        its connection breaks, it replaces the previous one"""
+        self._will = (topic, message)
+
+    def start(self):
+        """Connect to the bus"""
+        raise NotImplementedError
+
+    def publish(self, topic: str, message: str) -> bool:
+        """Publish a message on a topic
+
+        Returns
+        -------
+        bool
+            False if the message has been lost because the bus is unreachable
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Leave the bus"""
+
+    def _deliver(self, topic: str, message: str):
+        """Pass a message to the handlers of its topic, an error is printed without stopping the bus"""
+        MESSAGES_RECEIVED.inc()
+        for handler in self._handlers.get(topic, ()):
+            try:
+                handler(message)
+            except Exception:
+                print_exc()
+
+    def _connected(self):
+        """Run the connection callbacks"""
+        for callback in self._connect_listeners:
+            try:
+                callback()
+            except Exception:
+                print_exc()
+
+
+class LoopbackBus(Bus):
+    """Bus of the nodes of a single process, for the tests and the nodes running alone
+
+    The messages are delivered synchronously on the publishing thread, so every node sharing the bus sees them
+    before `publish` returns.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            self._connected()
+
+    def publish(self, topic: str, message: str) -> bool:
+        MESSAGES_PUBLISHED.inc()
+        self._deliver(topic, message)
+        return True
+
+    def close(self):
+        if self._started and self._will is not None:
+            self._started = False
+            self.publish(*self._will)
+
+
+class BrokerBus(Bus):
+    """Bus reached through a `Broker`, over TCP or a Unix socket
+
+    A background thread receives the messages of the subscribed topics, and connects again, after
+    `RECONNECT_DELAY` seconds, when the connection to the broker breaks. The messages published while it is
+    disconnected are lost.
+    """
+
+    def __init__(self, address: BusAddress):
+        super().__init__()
+        self.address = address
+        self._socket: Optional[socket] = None
+        self._send_lock = Lock()
+        self._closed = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def set_last_will(self, topic: str, message: str):
+        super().set_last_will(topic, message)
+        # Sent again on every connection, the broker keeps the latest one
+        self._send([LAST_WILL, topic, message])
+
+    def publish(self, topic: str, message: str) -> bool:
+        if not self._send([PUBLISH, topic, message]):
+            MESSAGES_LOST.inc()
+            return False
+        MESSAGES_PUBLISHED.inc()
+        return True
+
+    def _send(self, command: list) -> bool:
+        """Send a command to the broker
+
+        Returns
+        -------
+        bool
+            False if the node is not connected to the broker
+        """
+        frame = encode_frame(json.dumps(command))
+        with self._send_lock:
+            if self._socket is None:
+                return False
+            try:
+                self._socket.sendall(frame)
+            except OSError:
+                # The receiving thread notices the broken connection and connects again
+                return False
+        return True
+
+    def close(self):
+        self._closed.set()
+        with self._send_lock:
+            if self._socket is not None:
+                # Closing a socket does not wake up the thread reading it, shutting it down does
+                try:
+                    self._socket.shutdown(SHUT_RDWR)
+                except OSError:
+                    pass
+                self._socket = None
+
+    def _connect(self) -> socket:
+        """Connect to the broker and send the subscriptions and the last will of the node
+
+        Raises
+        ------
+        OSError
+            if the broker is unreachable
+        """
+        sock = bus_socket(self.address)
+        try:
+            sock.connect(self.address)
+            commands = [[SUBSCRIBE, topic] for topic in self._handlers]
+            if self._will is not None:
+                commands.append([LAST_WILL, *self._will])
+            sock.sendall(b"".join(encode_frame(json.dumps(command)) for command in commands))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _run(self):
+        """Target of the thread receiving the messages, connecting again whenever the connection breaks"""
+        reachable = True
+        while not self._closed.is_set():
+            try:
+                sock = self._connect()
+            except OSError as error:
+                if reachable:
+                    print(f"Cannot reach the broker at {self.address}: {error}")
+                    reachable = False
+                self._closed.wait(RECONNECT_DELAY)
+                continue
+            reachable = True
+            BUS_CONNECTIONS.inc()
+            with self._send_lock:
+                self._socket = sock
+            self._connected()
+            self._receive(sock)
+            with self._send_lock:
+                if self._socket is sock:
+                    self._socket = None
+            sock.close()
+            if not self._closed.is_set():
+                print(f"Lost the connection to the broker at {self.address}")
+                self._closed.wait(RECONNECT_DELAY)
+
+    def _receive(self, sock: socket):
+        """Deliver the messages received from the broker, until the connection breaks"""
+        reader = MessageReader(sock)
+        try:
+            while True:
+                _, message = reader.read_frame()
+                _, topic, payload = json.loads(message)
+                self._deliver(topic, payload)
+        except (OSError, ValueError, ProtocolError):
+            pass
+
+
+class Broker:
+    """Pub/sub broker of a cluster, it forwards every message published on a topic to the nodes subscribed to it
+
+    Every node keeps a connection to the broker, read by a thread of its own. The published frames are forwarded
+    unchanged through a fan-out engine, so a slow node never blocks the others: once `max_queue` frames are
+    waiting for it, it is disconnected, and it resynchronizes its state when it connects again. When the
+    connection of a node breaks, its last will is published on its behalf.
+    """
+
+    def __init__(self, address: BusAddress, max_queue: int = DEFAULT_BROKER_QUEUE):
+        self.address = address
+        self._lock = Lock()
+        # Subscribed connections of every topic
+        self._topics: Dict[str, Dict[socket, None]] = {}
+        self._wills: Dict[socket, Tuple[str, str]] = {}
+        self._fanout = FanoutEngine(max_queue, "disconnect", on_disconnect=self._slow_node)
+        self._server = bus_socket(address)
+
+    def __len__(self):
+        return len(self._fanout.stats())
+
+    def start(self):
+        """Listen on the address and start the threads of the broker"""
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+        else:
+            self._server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self._server.bind(self.address)
+        self._server.listen()
+        self._fanout.start()
+        Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        """Stop listening, and remove the Unix socket"""
+        self._server.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _accept(self):
+        """Target of the thread accepting the nodes"""
+        while True:
+            try:
+                node, _ = self._server.accept()
+            except OSError:
+                return
+            if node.family != AF_UNIX:
+                node.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            self._fanout.register(node)
+            Thread(target=self._receive, args=(node,), daemon=True).start()
+
+    def _receive(self, node: socket):
+        """Target of the thread reading the commands of a node"""
+        reader = MessageReader(node)
+        try:
+            while True:
+                _, message = reader.read_frame()
+                command = json.loads(message)
+                if command[0] == PUBLISH:
+                    self._publish(command[1], message)
+                elif command[0] == SUBSCRIBE:
+                    with self._lock:
+                        self._topics.setdefault(command[1], {})[node] = None
+                elif command[0] == LAST_WILL:
+                    self._wills[node] = (command[1], command[2])
+        except (OSError, ValueError, IndexError, ProtocolError):
+            pass
+        with self._lock:
+            for subscribers in self._topics.values():
+                subscribers.pop(node, None)
+        self._fanout.unregister(node)
+        node.close()
+        will = self._wills.pop(node, None)
+        if will is not None:
+            self._publish(will[0], json.dumps([PUBLISH, *will]))
+
+    def _publish(self, topic: str, frame: str):
+        """Forward a published frame to the subscribers of its topic"""
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+        self._fanout.publish(subscribers, frame, CHANNEL_GAME)
+
+    @staticmethod
+    def _slow_node(node: socket):
+        """Invoked by the fan-out engine when it disconnects a node that does not keep up"""
+        print(f"Disconnected the node {node} that does not keep up with the messages")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Pub/sub broker the nodes of a cluster share their broadcasts and '
+                                                 'leaderboards through')
+    parser.add_argument('-host', '--host', type=str, default='', help='Host name the broker listens on')
+    parser.add_argument('-port', '--port', type=int, default=DEFAULT_BROKER_PORT, help='Port of the broker')
+    parser.add_argument('-unix', '--unix', type=str, default=None,
+                        help='Listen on this Unix socket path instead of a TCP port')
+    parser.add_argument('-max-queue', '--max-queue', type=int, default=DEFAULT_BROKER_QUEUE,
+                        help='Frames queued for a node before it is disconnected')
+    parser.add_argument('-metrics-port', '--metrics-port', type=int, default=0,
+                        help='Serve the metrics of the broker in the Prometheus format on this port, 0 disables it')
+    args = parser.parse_args()
+    broker = Broker(args.unix or (args.host, args.port), args.max_queue)
+    metrics.gauge("chat_broker_nodes", "Nodes connected to the broker", lambda: len(broker))
+    if args.metrics_port:
+        metrics.serve_metrics((args.host, args.metrics_port))
+    broker.start()
+    print(f"Broker listening on {broker.address}")
+    try:
+        Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.close()
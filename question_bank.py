@@ -0,0 +1,596 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate, count, islice
+from random import choice, randrange
+from shutil import copyfileobj
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from traceback import print_exc
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+import metrics
+
+from codec import (ENCODING_BINARY, ENCODING_JSON, Payload, binary_choices_message, binary_question_entry,
+                   binary_questions_message, binary_round_entry, binary_round_message, compression_dictionary)
+from protocol import WINDOW_BITS
+
+# Indexed bank file: a header, the offsets of the records, then the records. The header is the magic, the
+# version and the number of questions; the index has one offset more than there are questions, so the
+# length of record i is offset[i + 1] - offset[i]; every record is the json list [text, choices, right index]
+INDEXED_MAGIC = b"QBNK"
+INDEXED_VERSION = 1
+INDEXED_HEADER = struct.Struct("!4sB3xQ")
+INDEXED_OFFSET = struct.Struct("!Q")
+# Questions of an indexed bank kept decoded, the ones of the rounds being played
+DEFAULT_CACHE_SIZE = 4096
+# Questions of a round, a bank needs at least as many
+ROUND_SIZE = 3
+# Seconds between two checks of the files of a watched bank
+DEFAULT_RELOAD_INTERVAL = 2.0
+
+BANK_RELOADS = metrics.counter("chat_question_bank_reloads_total", "New versions of the question bank swapped in")
+BANK_RELOAD_ERRORS = metrics.counter("chat_question_bank_reload_errors_total",
+                                     "New versions of the question bank rejected as malformed")
+BANK_RELOAD_SECONDS = metrics.histogram("chat_question_bank_reload_seconds",
+                                        "Time spent loading and validating a new version of the question bank")
+# Every loaded bank gets the next generation, so a client can tell which version its cached texts come from
+_generations = count(1)
+
+# Roles assigned at random to the players
+ROLES = [
+    'Apprentice',
+    'High',
+    'Sage',
+    'Demonlord',
+    'High',
+    'Magister',
+    'Foreman',
+    'Ranger',
+    'Commander',
+    'Spokesman',
+    'Royal',
+    'Saint',
+    'Royal',
+    'Mentor',
+    'Warmaster'
+]
+
+
+class Question:
+    """A question of the bank with its payloads encoded once at load time"""
+
+    __slots__ = ("id", "text", "choices", "right_answer_index", "entry_payload", "choices_payload",
+                 "binary_entry", "binary_id_entry", "binary_choices_payload")
+
+    def __init__(self, question_id: int, text: str, choices: List[str], right_answer: str):
+        self.id = question_id
+        self.text = text
+        self.choices = choices
+        self.right_answer_index = choices.index(right_answer)
+        # Entry of the questions message for a client that has never seen this question
+        self.entry_payload = json.dumps([question_id, text])
+        # Response to a client that picked this question
+        self.choices_payload = json.dumps({"status": "NOT_LOST", "choices": choices})
+        # The same payloads in the binary encoding
+        self.binary_entry = binary_question_entry(question_id, text)
+        self.binary_id_entry = binary_question_entry(question_id)
+        self.binary_choices_payload = binary_choices_message(choices)
+
+    def choices_message(self, encoding: str = ENCODING_JSON) -> Payload:
+        """Response to a client that picked this question"""
+        return self.binary_choices_payload if encoding == ENCODING_BINARY else self.choices_payload
+
+
+def parse_question(question_id: int, question: Dict[str, Any]) -> Question:
+    """Question of a questions file
+
+    Parameters
+    ----------
+    question_id : int
+        position of the question in the bank
+    question : dict
+        object with the "question", "choices" and "right_answer" keys
+
+    Raises
+    ------
+    ValueError
+        if the right answer is not one of the choices
+    """
+    if question["right_answer"] not in question["choices"]:
+        raise ValueError(f"The right answer of question {question_id} is not one of its choices")
+    return Question(question_id, question["question"], list(question["choices"]), question["right_answer"])
+
+
+class QuestionSource:
+    """Storage of the questions of a bank
+
+    The questions of a source are its positions from 0 to its length, their ids in the bank start at the
+    `first_id` of the source, the position of its first question among the questions of every source.
+    """
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def get(self, position: int) -> Question:
+        """Question at the given position, which the bank has already checked"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources of the source"""
+
+    def validate(self):
+        """Check the storage of the source, the questions in memory have been checked when they were parsed
+
+        Raises
+        ------
+        ValueError
+            if the storage is corrupt
+        """
+
+
+class MemorySource(QuestionSource):
+    """Questions decoded and encoded up front, for the banks that fit in memory"""
+
+    def __init__(self, questions: List[Question]):
+        self._questions = questions
+
+    @classmethod
+    def from_obj(cls, questions_obj: Dict[str, Any], first_id: int = 0) -> "MemorySource":
+        """Source of the parsed content of a questions file, with an object with a "questions" list
+
+        Raises
+        ------
+        ValueError
+            if a question is malformed
+        """
+        return cls([parse_question(first_id + position, question)
+                    for position, question in enumerate(questions_obj["questions"])])
+
+    def __len__(self):
+        return len(self._questions)
+
+    def get(self, position: int) -> Question:
+        return self._questions[position]
+
+
+class IndexedSource(QuestionSource):
+    """Questions of an indexed bank file, read from a memory map when they are needed
+
+    Opening the file only reads its header, so the startup time does not depend on the size of the bank, and
+    only the pages of the questions actually played are loaded by the kernel. A lookup reads two offsets of the
+    index and decodes a single record, the last `cache_size` questions used are kept decoded.
+    """
+
+    def __init__(self, path: str, first_id: int = 0, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.first_id = first_id
+        with open(path, "rb") as bank_file:
+            self._map = mmap.mmap(bank_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self._length = INDEXED_HEADER.unpack_from(self._map)
+        except struct.error:
+            self._map.close()
+            raise ValueError(f"{path} is too short to be an indexed bank")
+        if magic != INDEXED_MAGIC or version != INDEXED_VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not an indexed bank of version {INDEXED_VERSION}")
+        self._records_start = INDEXED_HEADER.size + (self._length + 1) * INDEXED_OFFSET.size
+        if len(self._map) < self._records_start:
+            self._map.close()
+            raise ValueError(f"The index of {path} is truncated")
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[int, Question]" = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return self._length
+
+    def get(self, position: int) -> Question:
+        with self._lock:
+            question = self._cache.get(position)
+            if question is not None:
+                self._cache.move_to_end(position)
+                return question
+        start, end = struct.unpack_from("!QQ", self._map, INDEXED_HEADER.size + position * INDEXED_OFFSET.size)
+        text, choices, right_answer_index = json.loads(
+            self._map[self._records_start + start:self._records_start + end].decode("utf8"))
+        question = Question(self.first_id + position, text, choices, choices[right_answer_index])
+        with self._lock:
+            self._cache[position] = question
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return question
+
+    def close(self):
+        self._map.close()
+
+    def validate(self):
+        """Check that the offsets of the index are ordered and lie within the records, and decode the first
+        and the last record
+
+        Reads the whole index, so it is only done before swapping in a reloaded bank, not when opening one.
+        """
+        offsets = array("Q", self._map[INDEXED_HEADER.size:self._records_start])
+        if sys.byteorder == "little":
+            offsets.byteswap()
+        if offsets[0] != 0 or offsets[-1] != len(self._map) - self._records_start:
+            raise ValueError(f"The records of {self.path} do not match its index")
+        if any(start > end for start, end in zip(offsets, islice(offsets, 1, None))):
+            raise ValueError(f"The index of {self.path} is not ordered")
+        for position in {0, self._length - 1} if self._length else ():
+            try:
+                self.get(position)
+            except (IndexError, TypeError, ValueError) as error:
+                raise ValueError(f"The record {position} of {self.path} is malformed: {error}") from error
+
+
+class ConcatenatedSource(QuestionSource):
+    """Several sources, one per category, seen as a single one: the positions of a source follow the ones of
+    the previous sources, which must be their first ids"""
+
+    def __init__(self, sources: Sequence[QuestionSource]):
+        self._sources = list(sources)
+        # Id of the first question of every source
+        self._starts = [0, *accumulate(len(source) for source in self._sources)][:-1]
+        self._length = sum(len(source) for source in self._sources)
+
+    def __len__(self):
+        return self._length
+
+    def get(self, position: int) -> Question:
+        index = bisect_right(self._starts, position) - 1
+        return self._sources[index].get(position - self._starts[index])
+
+    def close(self):
+        for source in self._sources:
+            source.close()
+
+    def validate(self):
+        for source in self._sources:
+            source.validate()
+
+
+def write_indexed_bank(questions: Iterable[Dict[str, Any]], path: str):
+    """Write questions to an indexed bank file, streaming them so the bank never has to fit in memory
+
+    The records are written to a temporary file while their offsets are collected, 8 bytes per question, then
+    the header, the index and the records are assembled and the file replaces `path` atomically.
+
+    Parameters
+    ----------
+    questions : Iterable[dict]
+        objects with the "question", "choices" and "right_answer" keys
+    path : str
+        path of the indexed bank
+
+    Raises
+    ------
+    ValueError
+        if a question is malformed
+    """
+    offsets = array("Q", [0])
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryFile(dir=directory) as records:
+        for question_id, question in enumerate(questions):
+            choices = list(question["choices"])
+            if question["right_answer"] not in choices:
+                raise ValueError(f"The right answer of question {question_id} is not one of its choices")
+            record = json.dumps([question["question"], choices, choices.index(question["right_answer"])],
+                                separators=(",", ":")).encode("utf8")
+            records.write(record)
+            offsets.append(offsets[-1] + len(record))
+        records.seek(0)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as bank_file:
+            bank_file.write(INDEXED_HEADER.pack(INDEXED_MAGIC, INDEXED_VERSION, len(offsets) - 1))
+            if sys.byteorder == "little":
+                # The index is big endian like the frame headers
+                offsets.byteswap()
+            offsets.tofile(bank_file)
+            copyfileobj(records, bank_file)
+            bank_file.flush()
+            os.fsync(bank_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_questions(path: str) -> Iterator[Dict[str, Any]]:
+    """Questions of a json file with a "questions" list, or of a json lines file with a question per line,
+    which is read line by line"""
+    with open(path, "r") as questions_file:
+        if path.endswith(".jsonl"):
+            for line in questions_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(questions_file)["questions"]
+
+
+def is_indexed_bank(path: str) -> bool:
+    """Whether the file at `path` is an indexed bank"""
+    with open(path, "rb") as bank_file:
+        return bank_file.read(len(INDEXED_MAGIC)) == INDEXED_MAGIC
+
+
+class QuestionBank:
+    """Questions indexed by their integer id
+
+    The ids are the positions of the questions in the source, so a lookup is a list access (or an index read
+    for the indexed banks) and a random selection of k questions costs O(k) regardless of the size of the bank.
+    """
+
+    def __init__(self, source: QuestionSource):
+        self._source = source
+        self.generation = next(_generations)
+
+    @classmethod
+    def from_obj(cls, questions_obj: Dict[str, Any]) -> "QuestionBank":
+        """Build the bank from the parsed content of a questions file
+
+        Parameters
+        ----------
+        questions_obj : dict
+            object with a "questions" list, each question has the "question", "choices" and "right_answer" keys
+
+        Raises
+        ------
+        ValueError
+            if a question is malformed
+        """
+        return cls(MemorySource.from_obj(questions_obj))
+
+    @classmethod
+    def load(cls, path: str) -> "QuestionBank":
+        """Load the bank from a json file or open an indexed bank file
+
+        A comma separated list of files, for instance one per category, makes a single bank whose ids follow
+        the order of the files.
+
+        Raises
+        ------
+        ValueError
+            if a file is malformed
+        """
+        sources: List[QuestionSource] = []
+        first_id = 0
+        for file_path in path.split(","):
+            if is_indexed_bank(file_path):
+                sources.append(IndexedSource(file_path, first_id))
+            else:
+                with open(file_path, "r") as questions_file:
+                    sources.append(MemorySource.from_obj(json.load(questions_file), first_id))
+            first_id += len(sources[-1])
+        return cls(sources[0] if len(sources) == 1 else ConcatenatedSource(sources))
+
+    def __len__(self):
+        return len(self._source)
+
+    def close(self):
+        """Release the files of the bank"""
+        self._source.close()
+
+    def validate(self):
+        """Check the files of the bank beyond their headers, before it replaces a bank in use
+
+        Raises
+        ------
+        ValueError
+            if a file is corrupt
+        """
+        self._source.validate()
+
+    def tail_texts(self, size: int) -> List[str]:
+        """Texts of the last questions of the bank, each followed by its choices, in the order of the bank
+
+        Only the questions needed to reach `size` bytes are read, so a large bank is not read in full.
+        """
+        texts: List[str] = []
+        read = 0
+        for question_id in range(len(self) - 1, -1, -1):
+            question = self._source.get(question_id)
+            fragments = [question.text, *question.choices]
+            texts[:0] = fragments
+            read += sum(len(fragment.encode("utf8")) for fragment in fragments)
+            if read >= size:
+                break
+        return texts
+
+    def compression_dictionary(self) -> bytes:
+        """Preset dictionary of the compressed frames, built from the texts of the bank and the role names
+
+        Deflate only uses the end of the dictionary, which the last questions of the bank fill.
+        """
+        return compression_dictionary(self.tail_texts(1 << WINDOW_BITS), ROLES)
+
+    def get(self, question_id: int) -> Question:
+        """Question with the given id
+
+        Raises
+        ------
+        KeyError
+            if no question has the id
+        """
+        if not 0 <= question_id < len(self._source):
+            raise KeyError(question_id)
+        return self._source.get(question_id)
+
+    def sample(self, k: int) -> List[int]:
+        """Ids of `k` distinct random questions, in O(k)"""
+        length = len(self._source)
+        if k > length:
+            raise ValueError(f"The bank has only {length} questions")
+        chosen: Dict[int, None] = {}
+        while len(chosen) < k:
+            chosen[randrange(length)] = None
+        return list(chosen)
+
+    def new_round(self, k: int = ROUND_SIZE):
+        """Pick the questions of a round and its trick question
+
+        Returns
+        -------
+        tuple[list[int], int]
+            the ids of the questions and the id of the trick one
+        """
+        question_ids = self.sample(k)
+        return question_ids, choice(question_ids)
+
+    def questions_message(self, question_ids: Iterable[int], seen: Set[int], encoding: str = ENCODING_JSON) -> Payload:
+        """Message with the questions of a round
+
+        A question already sent to the client is sent as its id only, otherwise as an [id, text] pair.
+        `seen` is updated with the sent questions.
+
+        Parameters
+        ----------
+        question_ids : Iterable[int]
+            ids of the questions of the round
+        seen : set[int]
+            ids of the questions whose text the client already has
+        encoding : str
+            encoding asked by the client
+
+        Returns
+        -------
+        str | bytes
+            json list of ids and [id, text] pairs, or the binary message with the same entries
+        """
+        binary = encoding == ENCODING_BINARY
+        entries = []
+        for question_id in question_ids:
+            question = self._source.get(question_id)
+            if question_id in seen:
+                entries.append(question.binary_id_entry if binary else str(question_id))
+            else:
+                entries.append(question.binary_entry if binary else question.entry_payload)
+                seen.add(question_id)
+        if binary:
+            return binary_questions_message(entries)
+        return "[" + ",".join(entries) + "]"
+
+    def round_message(self, question_ids: Iterable[int], seen: Set[int], encoding: str = ENCODING_JSON) -> Payload:
+        """Round sent ahead to a pipelined client, every question with its choices
+
+        A question already sent to the client is sent as its id only, otherwise as an [id, text, choices] list.
+        The choices of the trick question are sent like the others, so the round does not tell it apart.
+        `seen` is updated with the sent questions.
+
+        Returns
+        -------
+        str | bytes
+            json object {"ROUND": entries}, or the binary message with the same entries
+        """
+        binary = encoding == ENCODING_BINARY
+        entries = []
+        for question_id in question_ids:
+            if question_id in seen:
+                entries.append(binary_round_entry(question_id) if binary else str(question_id))
+                continue
+            question = self._source.get(question_id)
+            if binary:
+                entries.append(binary_round_entry(question_id, question.text, question.choices))
+            else:
+                entries.append(json.dumps([question_id, question.text, question.choices]))
+            seen.add(question_id)
+        if binary:
+            return binary_round_message(entries)
+        return '{"ROUND": [' + ",".join(entries) + "]}"
+
+
+def files_signature(path: str) -> Tuple[Tuple[int, int], ...]:
+    """Modification time and size of every file of a comma separated list, the files that cannot be read have
+    (0, 0)"""
+    signature = []
+    for file_path in path.split(","):
+        try:
+            stat = os.stat(file_path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((0, 0))
+    return tuple(signature)
+
+
+class BankWatcher:
+    """Reloads a question bank when its files change, without stopping the game
+
+    The files are polled on a daemon thread, which loads and validates a new version entirely before handing
+    it to `on_reload`: the previous version is never modified, so a swap of the reference is atomic and the
+    rounds drawn from the previous version keep reading it. A malformed version is reported and ignored, the
+    current one stays in use until the files change again. Replacing a file with a rename avoids loading a
+    half written one.
+    """
+
+    def __init__(self, path: str, on_reload: Callable[[QuestionBank], None],
+                 interval: float = DEFAULT_RELOAD_INTERVAL):
+        self.path = path
+        self.on_reload = on_reload
+        self.interval = interval
+        self._signature = files_signature(path)
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the watcher thread"""
+        self._thread.start()
+
+    def check(self) -> Optional[QuestionBank]:
+        """Load the bank if its files have changed since the last check
+
+        Returns
+        -------
+        QuestionBank | None
+            the new version, None if the files have not changed or the new version is malformed
+        """
+        signature = files_signature(self.path)
+        if signature == self._signature:
+            return None
+        self._signature = signature
+        started = perf_counter()
+        try:
+            bank = QuestionBank.load(self.path)
+            try:
+                if len(bank) < ROUND_SIZE:
+                    raise ValueError(f"A round needs {ROUND_SIZE} questions, the bank has {len(bank)}")
+                # A truncated or corrupt file would only fail in the middle of a round
+                bank.validate()
+            except ValueError:
+                bank.close()
+                raise
+        except (OSError, ValueError, KeyError, TypeError, struct.error) as error:
+            BANK_RELOAD_ERRORS.inc()
+            print(f"The new version of {self.path} is ignored: {error}")
+            return None
+        BANK_RELOAD_SECONDS.observe(perf_counter() - started)
+        return bank
+
+    def _run(self):
+        """Target of the watcher thread"""
+        while True:
+            sleep(self.interval)
+            try:
+                bank = self.check()
+                if bank is not None:
+                    self.on_reload(bank)
+                    BANK_RELOADS.inc()
+            except Exception:
+                print_exc()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Convert a questions file to an indexed bank, which the server '
+                                                 'opens without loading it')
+    parser.add_argument('source', type=str,
+                        help='Json file with a "questions" list, or json lines file with a question per line')
+    parser.add_argument('target', type=str, help='Indexed bank file to write')
+    args = parser.parse_args()
+    write_indexed_bank(read_questions(args.source), args.target)
+    bank = QuestionBank.load(args.target)
+    print(f"Wrote {len(bank)} questions to {args.target}")
+    bank.close()
@@ -0,0 +1,177 @@
+from threading import Lock, Thread
+from time import monotonic, sleep
+from traceback import print_exc
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+from timer_wheel import TimerWheel
+
+# Heartbeat of the control channel: the server pings a silent connection, the client answers with a pong
+PING = "PING"
+PONG = "PONG"
+# Control message telling a client that it has been disconnected for not answering in time, with the phase
+TIMEOUT_COMMAND = "TIMEOUT"
+
+# Phases of a connection, each one with its own deadline
+PHASE_NAME = "name"
+PHASE_QUESTION = "question"
+PHASE_CHOICE = "choice"
+# Reason of the expiry of a connection that stopped receiving anything, even the pongs
+IDLE = "idle"
+
+# Seconds of silence after which a connection is pinged, and after which it is closed
+DEFAULT_HEARTBEAT_INTERVAL = 10.0
+DEFAULT_IDLE_TIMEOUT = 30.0
+# Seconds a player has to write its name, to pick a question and to pick a choice
+DEFAULT_NAME_TIMEOUT = 60.0
+DEFAULT_QUESTION_TIMEOUT = 60.0
+DEFAULT_CHOICE_TIMEOUT = 60.0
+# Seconds between two advances of the timer wheel, the deadlines expire at most this late
+DEFAULT_REAPER_TICK = 0.5
+
+PINGS_SENT = metrics.counter("chat_heartbeat_pings_total", "Pings sent to silent connections")
+CONNECTIONS_REAPED = metrics.counter("chat_connections_reaped_total",
+                                     "Connections closed for missing a phase deadline or the heartbeat")
+
+
+class _Liveness:
+    """Activity and deadline of the current phase of a watched connection"""
+
+    __slots__ = ("connection", "last_received", "pinged", "phase", "phase_deadline")
+
+    def __init__(self, connection, now: float):
+        self.connection = connection
+        self.last_received = now
+        # Whether the connection has been pinged since it last received something
+        self.pinged = False
+        self.phase: Optional[str] = None
+        self.phase_deadline: Optional[float] = None
+
+
+class ConnectionReaper:
+    """Closes the connections that miss the deadline of their phase or stop answering the heartbeat
+
+    Every watched connection has a single deadline in a timer wheel advanced by the reaper thread, so
+    watching tens of thousands of connections costs a few dictionary operations each. Receiving a frame
+    only records its time: the deadline is checked lazily when it expires, and moved forward if the
+    connection has received something in the meantime.
+
+    `on_ping(connection)` is called when a connection has been silent for `heartbeat_interval` seconds,
+    `on_expire(connection, reason)` when it misses the deadline of its phase (the reason is the phase) or
+    has been silent for `idle_timeout` seconds (the reason is `IDLE`). Both run on the reaper thread.
+    A zero interval, timeout or phase timeout disables it.
+    """
+
+    def __init__(self, on_ping: Callable[[Any], None], on_expire: Callable[[Any, str], None],
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 phase_timeouts: Optional[Dict[str, float]] = None, tick: float = DEFAULT_REAPER_TICK):
+        self.on_ping = on_ping
+        self.on_expire = on_expire
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.phase_timeouts = phase_timeouts if phase_timeouts is not None else {
+            PHASE_NAME: DEFAULT_NAME_TIMEOUT, PHASE_QUESTION: DEFAULT_QUESTION_TIMEOUT,
+            PHASE_CHOICE: DEFAULT_CHOICE_TIMEOUT}
+        self.tick = tick
+        self._wheel = TimerWheel(tick, monotonic())
+        self._lock = Lock()
+        self._watched: Dict[Any, _Liveness] = {}
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def __len__(self):
+        return len(self._watched)
+
+    def start(self):
+        """Start the reaper thread"""
+        self._thread.start()
+
+    def watch(self, connection, phase: Optional[str] = None):
+        """Start watching a connection, in the given phase"""
+        liveness = _Liveness(connection, monotonic())
+        with self._lock:
+            self._watched[connection] = liveness
+        self._set_phase(liveness, phase)
+
+    def forget(self, connection):
+        """Stop watching a connection"""
+        with self._lock:
+            liveness = self._watched.pop(connection, None)
+        if liveness is not None:
+            self._wheel.cancel(liveness)
+
+    def touch(self, connection):
+        """Record that a connection has received a frame, it is called for every frame so it is kept cheap"""
+        liveness = self._watched.get(connection)
+        if liveness is not None:
+            liveness.last_received = monotonic()
+            liveness.pinged = False
+
+    def enter_phase(self, connection, phase: Optional[str]):
+        """Give a connection the deadline of a phase, None leaves it only the heartbeat"""
+        liveness = self._watched.get(connection)
+        if liveness is not None:
+            self._set_phase(liveness, phase)
+
+    def _set_phase(self, liveness: _Liveness, phase: Optional[str]):
+        """Set the phase of a connection and move its deadline to the earliest check"""
+        timeout = self.phase_timeouts.get(phase, 0) if phase is not None else 0
+        liveness.phase = phase
+        liveness.phase_deadline = monotonic() + timeout if timeout > 0 else None
+        self._reschedule(liveness)
+
+    def _next_check(self, liveness: _Liveness) -> Optional[float]:
+        """Time at which the connection has to be checked again, None if it has no deadline at all"""
+        checks = []
+        if liveness.phase_deadline is not None:
+            checks.append(liveness.phase_deadline)
+        if self.idle_timeout > 0 and (liveness.pinged or self.heartbeat_interval <= 0):
+            checks.append(liveness.last_received + self.idle_timeout)
+        elif self.heartbeat_interval > 0:
+            checks.append(liveness.last_received + self.heartbeat_interval)
+        return min(checks) if checks else None
+
+    def _reschedule(self, liveness: _Liveness):
+        """Schedule the next check of a connection, unless it has been forgotten"""
+        when = self._next_check(liveness)
+        with self._lock:
+            if self._watched.get(liveness.connection) is not liveness:
+                return
+            if when is None:
+                self._wheel.cancel(liveness)
+            else:
+                self._wheel.schedule(liveness, when)
+
+    def _check(self, liveness: _Liveness, now: float):
+        """Expire, ping or reschedule a connection whose deadline has been reached"""
+        if liveness.phase_deadline is not None and liveness.phase_deadline <= now:
+            self._expire(liveness, liveness.phase)
+            return
+        silence = now - liveness.last_received
+        if self.idle_timeout > 0 and silence >= self.idle_timeout:
+            self._expire(liveness, IDLE)
+            return
+        if self.heartbeat_interval > 0 and silence >= self.heartbeat_interval and not liveness.pinged:
+            liveness.pinged = True
+            PINGS_SENT.inc()
+            self.on_ping(liveness.connection)
+        self._reschedule(liveness)
+
+    def _expire(self, liveness: _Liveness, reason: str):
+        """Stop watching an expired connection and hand it to the server"""
+        with self._lock:
+            if self._watched.get(liveness.connection) is not liveness:
+                return
+            del self._watched[liveness.connection]
+        CONNECTIONS_REAPED.inc()
+        self.on_expire(liveness.connection, reason)
+
+    def _run(self):
+        """Target of the reaper thread"""
+        while True:
+            sleep(self.tick)
+            now = monotonic()
+            for liveness, _ in self._wheel.advance(now):
+                try:
+                    self._check(liveness, now)
+                except Exception:
+                    print_exc()
@@ -0,0 +1,595 @@
+import asyncio
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import monotonic, time
+from traceback import print_exc
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+from codec import (DEADLINE_MATCH, ENCODING_BINARY, ENCODING_JSON, ENCODINGS, TAG_DELTA, TAG_LEADERBOARD,
+                   TAG_SNAPSHOT, Payload, binary_leaderboard_message, clock_message, json_dumps, winner_message)
+from event_log import EVENT_ANSWER, EVENT_END, EVENT_JOIN, EVENT_QUIT, EVENT_ROOM, EventLog
+from leaderboard import Leaderboard
+from protocol import CHANNEL_BROADCAST, CHANNEL_CONTROL, CHANNEL_LEADERBOARD
+from router import ChannelRouter
+from timer_wheel import Timer, TimerWheel
+
+# Resolution of the timers of the workers, a callback runs at most this late
+TIMER_TICK = 0.01
+# Slots of the timer wheel of a worker, a turn of the wheel covers about 10 seconds
+TIMER_SLOTS = 1024
+# Seconds between two countdown ticks of a room, each one gives its players the server time and the deadline
+DEFAULT_COUNTDOWN_TICK = 10.0
+# Seconds the answer stage of a room waits for more answers before committing a batch, with 0 the batch is made
+# of the answers queued until the worker runs the stage
+DEFAULT_ANSWER_BATCH_INTERVAL = 0.0
+
+BROADCAST_SECONDS = metrics.histogram("chat_broadcast_seconds", "Time spent queueing a broadcast")
+ANSWER_COMMIT_SECONDS = metrics.histogram("chat_answer_commit_seconds",
+                                          "Time spent applying a batch of answers and publishing its broadcasts")
+ANSWERS_COMMITTED = metrics.counter("chat_answers_committed_total", "Answers applied by the answer stages")
+ANSWER_BATCHES = metrics.counter("chat_answer_batches_total", "Batches of answers applied by the answer stages")
+BROADCAST_LEADERBOARD_SECONDS = metrics.histogram("chat_broadcast_leaderboard_seconds",
+                                                  "Time spent encoding and queueing a leaderboard update")
+
+# Callback receiving a room, the (id, name, score) rows of its changed players and the ids of the removed ones
+ChangesListener = Callable[["Room", List[Tuple[int, str, int]], List[int]], None]
+# Invoked by the answer stage with the updated score of the player, None if it has left the room
+ScoreListener = Callable[[Optional[int]], Any]
+# Callback receiving a room whose round has ended and its winner computed by `Room.declare_winner`
+EndListener = Callable[["Room", Any], None]
+
+
+def run_callback(callback: Callable[[], Any]):
+    """Run a callback of a worker, an error is printed without stopping the worker"""
+    try:
+        callback()
+    except Exception:
+        print_exc()
+
+
+def run_expired(wheel: TimerWheel):
+    """Advance a timer wheel to now and run the callbacks of the expired timers"""
+    for timer, _ in wheel.advance(monotonic()):
+        run_callback(timer.callback)
+
+
+class TimerWorker:
+    """Worker thread running the timed callbacks (round timers, countdowns, answer deadlines, leaderboard ticks)
+    of its rooms
+
+    Used by the threaded server, where every connection already has its own thread. The callbacks are kept in
+    a timer wheel, so scheduling or cancelling one costs O(1) however many players have a deadline.
+    """
+
+    def __init__(self, worker_id: int, fanout):
+        self.worker_id = worker_id
+        self.fanout = fanout
+        self.rooms: Dict["Room", None] = {}
+        self._wheel = TimerWheel(TIMER_TICK, monotonic(), TIMER_SLOTS)
+        self._condition = Condition()
+        # Callbacks to run as soon as possible, guarded by the condition
+        self._ready: List[Callable[[], Any]] = []
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the worker thread"""
+        self._thread.start()
+
+    def schedule(self, delay: float, callback: Callable[[], Any]) -> Timer:
+        """Run `callback` on the worker thread after `delay` seconds, it can be called from any thread"""
+        timer = Timer(callback)
+        self._wheel.schedule(timer, monotonic() + delay)
+        with self._condition:
+            self._condition.notify()
+        return timer
+
+    def call_soon(self, callback: Callable[[], Any]):
+        """Run `callback` on the worker thread as soon as possible, without waiting for a tick, it can be called
+        from any thread"""
+        with self._condition:
+            self._ready.append(callback)
+            self._condition.notify()
+
+    def cancel(self, timer: Timer) -> bool:
+        """Cancel a callback, it can be called from any thread
+
+        Returns
+        -------
+        bool
+            False if the callback has already run or is running
+        """
+        return self._wheel.cancel(timer)
+
+    def _run(self):
+        """Target of the worker thread, it advances the wheel every tick while it has timers and runs the ready
+        callbacks as soon as they are queued"""
+        while True:
+            with self._condition:
+                while not self._ready and not len(self._wheel):
+                    self._condition.wait()
+                if not self._ready:
+                    # Woken early by a ready callback or a new timer, the wheel only runs the elapsed ticks
+                    self._condition.wait(TIMER_TICK)
+                ready, self._ready = self._ready, []
+            for callback in ready:
+                run_callback(callback)
+            run_expired(self._wheel)
+
+
+class AsyncWorker:
+    """Worker thread running an event loop that serves the connections of its rooms
+
+    Every room lives on a single event loop, so its state is only touched by the coroutines of that loop.
+    """
+
+    def __init__(self, worker_id: int, fanout):
+        self.worker_id = worker_id
+        self.fanout = fanout
+        self.rooms: Dict["Room", None] = {}
+        self.loop = asyncio.new_event_loop()
+        self._wheel = TimerWheel(TIMER_TICK, monotonic(), TIMER_SLOTS)
+        # Whether the event loop is advancing the wheel, only read and written on the event loop
+        self._ticking = False
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the worker thread and its event loop"""
+        self._thread.start()
+
+    def schedule(self, delay: float, callback: Callable[[], Any]) -> Timer:
+        """Run `callback` on the event loop after `delay` seconds, it can be called from any thread
+
+        The callbacks are kept in a timer wheel that the event loop advances every tick while it has timers,
+        instead of a handle each in the heap of the loop.
+        """
+        timer = Timer(callback)
+        self._wheel.schedule(timer, monotonic() + delay)
+        self.loop.call_soon_threadsafe(self._start_ticking)
+        return timer
+
+    def call_soon(self, callback: Callable[[], Any]):
+        """Run `callback` on the event loop as soon as possible, it can be called from any thread"""
+        self.loop.call_soon_threadsafe(run_callback, callback)
+
+    def cancel(self, timer: Timer) -> bool:
+        """Cancel a callback, it can be called from any thread
+
+        Returns
+        -------
+        bool
+            False if the callback has already run or is running
+        """
+        return self._wheel.cancel(timer)
+
+    def _start_ticking(self):
+        """Start advancing the wheel, unless the event loop already does"""
+        if not self._ticking:
+            self._ticking = True
+            self.loop.call_later(TIMER_TICK, self._tick)
+
+    def _tick(self):
+        """Run the expired callbacks, then keep ticking while the wheel has timers"""
+        run_expired(self._wheel)
+        if len(self._wheel):
+            self.loop.call_later(TIMER_TICK, self._tick)
+        else:
+            self._ticking = False
+
+    def submit(self, coroutine):
+        """Run a coroutine on the event loop of the worker, it can be called from any thread"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def _run(self):
+        """Target of the worker thread"""
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+class RecoveredPlayer:
+    """Leaderboard key of a player restored from the event log, until a player with the same name joins the
+    room again and takes its score"""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self):
+        return f"RecoveredPlayer({self.name})"
+
+
+class Room:
+    """A match with its own players, leaderboard, subscribers and round timer"""
+
+    def __init__(self, room_id: int, capacity: int, worker, leaderboard_updates: str = "full",
+                 on_changes: Optional[ChangesListener] = None, deadline: Optional[float] = None,
+                 event_log: Optional[EventLog] = None, answer_batch_interval: float = DEFAULT_ANSWER_BATCH_INTERVAL):
+        self.room_id = room_id
+        self.capacity = capacity
+        self.worker = worker
+        self.fanout = worker.fanout
+        self.leaderboard_updates = leaderboard_updates
+        # Invoked with the leaderboard changes of the room on every flush
+        self.on_changes = on_changes
+        self.leaderboard = Leaderboard(track_changes=leaderboard_updates == "delta" or on_changes is not None)
+        self.router = ChannelRouter()
+        # Ids of the players whose name every binary leaderboard subscriber already has. The binary messages
+        # are encoded and published holding the lock, so the names are always received before their ids
+        self._binary_lock = Lock()
+        self._named_ids: Set[int] = set()
+        # Connections placed in the room, including the ones that have not written their name yet
+        self.seats = 0
+        # A room stops accepting players when its timer ends
+        self.is_open = True
+        # Wall clock time at which the round ends, it survives a restart of the server
+        self.deadline = deadline
+        # Joins, answers and quits are appended to the log, so the leaderboard can be restored after a crash
+        self.event_log = event_log
+        # Keys of the restored players that have not joined again, by name
+        self._recovered: Dict[str, List[RecoveredPlayer]] = {}
+        # Answers waiting for the answer stage: (player key, question id, won, expired, listener)
+        self.answer_batch_interval = answer_batch_interval
+        self._answers_lock = Lock()
+        self._answers: List[Tuple[Any, Optional[int], bool, bool, Optional[ScoreListener]]] = []
+
+    def __repr__(self):
+        return f"Room({self.room_id}, seats={self.seats}/{self.capacity}, open={self.is_open})"
+
+    def join(self, connection, name: str):
+        """Add a player to the room, a player restored with the same name gives it its score"""
+        score = 0
+        recovered = self._recovered.get(name)
+        if recovered:
+            key = recovered.pop()
+            score = self.leaderboard.score(key)
+            self.leave(key)
+        self.leaderboard.add(connection, name, score)
+        self._log(EVENT_JOIN, player=self.leaderboard.player_id(connection), name=name, score=score)
+
+    def restore_player(self, name: str, score: int):
+        """Add a player restored from the event log, it is kept until the end of the round or until a player
+        with the same name joins"""
+        key = RecoveredPlayer(name)
+        self._recovered.setdefault(name, []).append(key)
+        self.leaderboard.add(key, name, score)
+        self._log(EVENT_JOIN, player=self.leaderboard.player_id(key), name=name, score=score)
+
+    def answer(self, connection, question_id: int, won: bool) -> int:
+        """Apply the answer of a player to its score
+
+        Returns
+        -------
+        int
+            the updated score
+        """
+        new_score = self.leaderboard.update(connection, 1 if won else -1)
+        self._log(EVENT_ANSWER, player=self.leaderboard.player_id(connection), question=question_id, won=won,
+                  score=new_score)
+        return new_score
+
+    def submit_answer(self, key, question_id: Optional[int], won: bool, on_scored: Optional[ScoreListener] = None,
+                      expired: bool = False):
+        """Queue the answer of a player for the answer stage of the room, it can be called from any thread
+
+        Parameters
+        ----------
+        key
+            leaderboard key of the player, its connection or its parked session
+        question_id : int | None
+            question answered, None if it is not known
+        won : bool
+            whether the answer is right
+        on_scored : Callable[[int | None], Any] | None
+            invoked on the worker of the room with the updated score, or None if the player has left the room
+        expired : bool
+            whether the time to answer ran out, which the broadcast tells
+        """
+        with self._answers_lock:
+            self._answers.append((key, question_id, won, expired, on_scored))
+            first = len(self._answers) == 1
+        if not first:
+            # The stage is already due, the answer joins its batch
+            return
+        if self.answer_batch_interval > 0:
+            self.worker.schedule(self.answer_batch_interval, self._commit_answers)
+        else:
+            self.worker.call_soon(self._commit_answers)
+
+    def _commit_answers(self):
+        """Answer stage, run by the worker of the room: apply the queued answers to the leaderboard, then publish
+        a single broadcast and a single leaderboard for the whole batch
+
+        The handlers only queue the answers, so a storm of answers costs one fan-out per batch instead of one per
+        answer, and the time a handler waits does not grow with the number of subscribers.
+        """
+        with self._answers_lock:
+            batch, self._answers = self._answers, []
+        # Updated score of every answer, None for the players that have left the room
+        scores: List[Optional[int]] = [None] * len(batch)
+        try:
+            with ANSWER_COMMIT_SECONDS.time():
+                lines = []
+                for index, (key, question_id, won, expired, _) in enumerate(batch):
+                    try:
+                        new_score = self.answer(key, question_id, won)
+                        name = self.leaderboard.name(key)
+                    except KeyError:
+                        # The player has left the room, or lost its connection, since its answer was queued
+                        continue
+                    scores[index] = new_score
+                    if expired:
+                        lines.append(f"{name} ran out of time, its current score is {new_score}")
+                    else:
+                        lines.append(f"{name} {'got' if won else 'lost'} a point, its current score is {new_score}")
+                if lines:
+                    # One line for each answer, in the order they were applied
+                    self.broadcast("\n".join(lines))
+                    self.broadcast_leaderboard()
+            ANSWERS_COMMITTED.inc(len(lines))
+            ANSWER_BATCHES.inc()
+        finally:
+            # The handlers waiting for their score are always released, even if the batch failed
+            for (*_, on_scored), new_score in zip(batch, scores):
+                if on_scored is not None:
+                    on_scored(new_score)
+
+    def subscribe(self, channel: int, connection, encoding: str = ENCODING_JSON):
+        """Subscribe a connection to a channel of the room, a new leaderboard subscriber receives the whole
+        leaderboard first"""
+        if channel != CHANNEL_LEADERBOARD:
+            self.router.subscribe(channel, connection, encoding)
+            return
+        with self._binary_lock:
+            if self.router.subscribe(channel, connection, encoding):
+                self.fanout.send(connection, self.leaderboard_snapshot_message(encoding), CHANNEL_LEADERBOARD)
+
+    def leave(self, connection):
+        """Remove a connection from the room, whether it joined the game or not"""
+        self.router.unsubscribe(connection)
+        if self.event_log is not None and connection in self.leaderboard:
+            self._log(EVENT_QUIT, player=self.leaderboard.player_id(connection))
+        self.leaderboard.remove(connection)
+
+    def detach(self, connection, key):
+        """Unsubscribe the connection of a player that lost it, the player stays in the leaderboard under `key`"""
+        self.router.unsubscribe(connection)
+        self.leaderboard.rekey(connection, key)
+
+    def attach(self, key, connection):
+        """Give back to a player detached under `key` its new connection"""
+        self.leaderboard.rekey(key, connection)
+
+    def end(self):
+        """Invoked when the round timer of the room expires, returns the winner computed by `declare_winner`"""
+        self.is_open = False
+        self._log(EVENT_END)
+        self.broadcast("TIMER ENDED")
+        # Broadcast to the leaderboard subscribers the winner
+        winner = self.declare_winner()
+        if winner is not None:
+            self.broadcast_leaderboard(winner)
+        return winner
+
+    def publish_clock(self):
+        """Give the players of the room the server time and the end of the round, their countdowns follow the
+        server clock instead of drifting"""
+        if self.deadline is not None:
+            self.fanout.publish(self.router.subscribers(CHANNEL_BROADCAST),
+                                clock_message(DEADLINE_MATCH, self.deadline), CHANNEL_CONTROL)
+
+    def _log(self, event_type: str, **fields):
+        """Append an event of the room to the event log, if there is one"""
+        if self.event_log is not None:
+            self.event_log.append(event_type, room=self.room_id, **fields)
+
+    def broadcast(self, message: str, prefix=""):
+        """Broadcast a message to all the clients of the room"""
+        with BROADCAST_SECONDS.time():
+            # Encoded once, then queued for every subscriber and written by the fan-out engine
+            self.fanout.publish(self.router.subscribers(CHANNEL_BROADCAST), prefix + message, CHANNEL_BROADCAST)
+
+    def declare_winner(self):
+        """Compute the winner (or the list of winners) of the room, None if nobody played"""
+        # The leaderboard already groups the players by score
+        best = self.leaderboard.winners()
+        if best is None:
+            return None
+        winner_score, winner_list = best
+        if len(winner_list) == 1:
+            return {
+                "winner_name": winner_list[0],
+                "winner_score": winner_score
+            }
+        return list(map(lambda elem: {"winner_name": elem, "winner_score": winner_score}, winner_list))
+
+    def broadcast_leaderboard(self, winner=None):
+        """Broadcast the leaderboard of the room, or the winner computed by `declare_winner`"""
+        # Broadcasting the winner
+        if winner is not None:
+            # Flush the pending deltas first, the winner must be shown on an up to date leaderboard.
+            # It is sent once, so it is never dropped by the slow consumer policy
+            self.flush_leaderboard_deltas()
+            for encoding in ENCODINGS:
+                subscribers = self.router.subscribers(CHANNEL_LEADERBOARD, encoding)
+                if subscribers:
+                    message = winner_message(winner, encoding)
+                    self.fanout.publish(subscribers, message, CHANNEL_LEADERBOARD, droppable=False)
+        elif self.leaderboard_updates == "delta":
+            # The changes are coalesced and sent by the leaderboard ticker
+            return
+        else:
+            # Broadcasting the entire leaderboard
+            with BROADCAST_LEADERBOARD_SECONDS.time():
+                # Both encodings are built from the same read of the leaderboard
+                rows = self.leaderboard.rows()
+                subscribers = self.router.subscribers(CHANNEL_LEADERBOARD, ENCODING_JSON)
+                if subscribers:
+                    message = json_dumps({name: score for _, name, score in rows})
+                    self.fanout.publish(subscribers, message, CHANNEL_LEADERBOARD)
+                self._publish_binary(TAG_LEADERBOARD, rows)
+
+    def flush_leaderboard_deltas(self):
+        """Send the leaderboard changes accumulated since the last flush as a single frame"""
+        if self.leaderboard_updates != "delta" and self.on_changes is None:
+            return
+        updated, removed = self.leaderboard.drain_changes()
+        if not updated and not removed:
+            return
+        if self.on_changes is not None:
+            self.on_changes(self, updated, removed)
+        if self.leaderboard_updates == "delta":
+            # The clients apply every delta to their copy of the leaderboard, none of them can be dropped
+            with BROADCAST_LEADERBOARD_SECONDS.time():
+                subscribers = self.router.subscribers(CHANNEL_LEADERBOARD, ENCODING_JSON)
+                if subscribers:
+                    message = self.leaderboard_delta_message(updated, removed)
+                    self.fanout.publish(subscribers, message, CHANNEL_LEADERBOARD, droppable=False)
+                self._publish_binary(TAG_DELTA, updated, removed)
+
+    def _publish_binary(self, tag: int, rows: List[Tuple[int, str, int]], removed: List[int] = ()):
+        """Publish a binary leaderboard or delta to the binary subscribers
+
+        The names of the players the subscribers have not received yet are sent along. Only the whole
+        leaderboards without new names can be dropped by the slow consumer policy, the next one replaces them.
+        The deltas, and the messages the following ones take the names from, cannot.
+        """
+        with self._binary_lock:
+            subscribers = self.router.subscribers(CHANNEL_LEADERBOARD, ENCODING_BINARY)
+            if not subscribers:
+                return
+            names = {player_id: name for player_id, name, _ in rows if player_id not in self._named_ids}
+            if tag == TAG_LEADERBOARD:
+                # The whole leaderboard lists every player still in the room
+                self._named_ids = {row[0] for row in rows}
+            else:
+                self._named_ids.update(names)
+                self._named_ids.difference_update(removed)
+            message = binary_leaderboard_message(tag, names, rows, removed)
+            droppable = tag == TAG_LEADERBOARD and not names
+            self.fanout.publish(subscribers, message, CHANNEL_LEADERBOARD, droppable=droppable)
+
+    def leaderboard_snapshot_message(self, encoding: str = ENCODING_JSON) -> Payload:
+        """Message with the whole leaderboard, sent to the new subscribers"""
+        if encoding == ENCODING_BINARY:
+            rows = self.leaderboard.rows()
+            tag = TAG_SNAPSHOT if self.leaderboard_updates == "delta" else TAG_LEADERBOARD
+            return binary_leaderboard_message(tag, {player_id: name for player_id, name, _ in rows}, rows)
+        if self.leaderboard_updates == "delta":
+            # Rows of id, name and score, the ids are used to apply the following deltas
+            return json_dumps({"SNAPSHOT": self.leaderboard.rows()})
+        return json_dumps(self.leaderboard.ordered())
+
+    @staticmethod
+    def leaderboard_delta_message(updated: List[Tuple[int, str, int]], removed: List[int]) -> str:
+        """Message with the leaderboard changes since the previous one"""
+        return json_dumps({"DELTA": {"updated": updated, "removed": removed}})
+
+
+class RoomScheduler:
+    """Places the incoming connections in rooms
+
+    The open rooms are filled up to their capacity before a new one is created, and every new room is
+    assigned to the worker with the fewest rooms. When several processes or cluster nodes host rooms, each one
+    numbers its rooms with a different `first_room_id` and the same `room_id_step`, so the ids never collide.
+    """
+
+    def __init__(self, workers: List, capacity: int, game_duration: float, leaderboard_updates: str = "full",
+                 on_changes: Optional[ChangesListener] = None, first_room_id: int = 1, room_id_step: int = 1,
+                 event_log: Optional[EventLog] = None, countdown_tick: float = DEFAULT_COUNTDOWN_TICK,
+                 answer_batch_interval: float = DEFAULT_ANSWER_BATCH_INTERVAL,
+                 on_end: Optional[EndListener] = None):
+        self.workers = workers
+        self.capacity = capacity
+        self.game_duration = game_duration
+        self.leaderboard_updates = leaderboard_updates
+        self.on_changes = on_changes
+        self.event_log = event_log
+        # Seconds between two countdown ticks of a room, 0 disables them
+        self.countdown_tick = countdown_tick
+        self.answer_batch_interval = answer_batch_interval
+        # Invoked on the worker of a room when its round ends
+        self.on_end = on_end
+        self._lock = Lock()
+        self._first_room_id = first_room_id
+        self._room_id_step = room_id_step
+        self._room_ids = count(first_room_id, room_id_step)
+        self._rooms: Dict[int, Room] = {}
+
+    def rooms(self) -> List[Room]:
+        """Every room currently hosted"""
+        return list(self._rooms.values())
+
+    def reserve(self) -> Room:
+        """Reserve a seat for a new connection, creating a room if every open room is full"""
+        with self._lock:
+            room = next((room for room in self._rooms.values()
+                         if room.is_open and room.seats < room.capacity), None)
+            if room is None:
+                room = self._create(next(self._room_ids), time() + self.game_duration)
+            room.seats += 1
+            return room
+
+    def restore(self, room_id: int, deadline: float, players: List[Tuple[str, int]]) -> Optional[Room]:
+        """Host again a room rebuilt from the event log with its restored players, until its deadline
+
+        The rooms created afterwards get ids greater than `room_id`. Returns None if the round of the room
+        has already ended.
+        """
+        if deadline <= time():
+            return None
+        with self._lock:
+            room = self._create(room_id, deadline)
+            for name, score in players:
+                room.restore_player(name, score)
+            # Skip the ids up to the restored one
+            step = self._room_id_step
+            next_id = self._first_room_id + ((room_id - self._first_room_id) // step + 1) * step
+            self._first_room_id = max(self._first_room_id, next_id)
+            self._room_ids = count(self._first_room_id, step)
+            return room
+
+    def _create(self, room_id: int, deadline: float) -> Room:
+        """Create a room on the worker with the fewest rooms. Must be called holding the lock"""
+        worker = min(self.workers, key=lambda w: len(w.rooms))
+        room = Room(room_id, self.capacity, worker, self.leaderboard_updates, self.on_changes, deadline,
+                    self.event_log, self.answer_batch_interval)
+        if self.event_log is not None:
+            self.event_log.append(EVENT_ROOM, room=room_id, deadline=deadline)
+        self._rooms[room_id] = room
+        worker.rooms[room] = None
+        # The round timer and the countdown of the room run on its worker
+        worker.schedule(deadline - time(), lambda: self._end(room))
+        if self.countdown_tick > 0:
+            worker.schedule(self.countdown_tick, lambda: self._countdown(room))
+        return room
+
+    def release(self, room: Room):
+        """Free the seat of a connection that left `room`, a finished room is dropped once empty"""
+        with self._lock:
+            room.seats -= 1
+            if room.seats <= 0 and not room.is_open:
+                self._drop(room)
+
+    def _countdown(self, room: Room):
+        """Countdown tick of a room, until the end of its round"""
+        if not room.is_open:
+            return
+        room.publish_clock()
+        if room.deadline - time() > self.countdown_tick:
+            room.worker.schedule(self.countdown_tick, lambda: self._countdown(room))
+
+    def _end(self, room: Room):
+        winner = room.end()
+        if self.on_end is not None:
+            self.on_end(room, winner)
+        # A finished room is dropped as soon as nobody is left in it
+        with self._lock:
+            if room.seats <= 0:
+                self._drop(room)
+
+    def _drop(self, room: Room):
+        # Report the players that left before the room stops being ticked
+        room.flush_leaderboard_deltas()
+        self._rooms.pop(room.room_id, None)
+        room.worker.rooms.pop(room, None)
@@ -0,0 +1,80 @@
+from threading import Lock
+from typing import Any, Dict, List
+
+from codec import ENCODING_JSON, ENCODINGS
+from protocol import CHANNEL_BROADCAST, CHANNEL_LEADERBOARD
+
+
+class ChannelRouter:
+    """Keeps track of the connections subscribed to the broadcast and the leaderboard channels
+
+    A connection is a socket in the threaded server and a stream writer in the asyncio server. The subscribers
+    are also grouped by the encoding they asked for, so a message is encoded once for each encoding in use.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._subscribers: Dict[int, List[Any]] = {
+            CHANNEL_BROADCAST: [],
+            CHANNEL_LEADERBOARD: []
+        }
+        self._by_encoding: Dict[int, Dict[str, List[Any]]] = {
+            channel: {encoding: [] for encoding in ENCODINGS} for channel in self._subscribers
+        }
+
+    def subscribe(self, channel: int, connection, encoding: str = ENCODING_JSON) -> bool:
+        """Subscribe `connection` to `channel`
+
+        Parameters
+        ----------
+        channel : int
+            channel the connection wants to receive
+        connection : Any
+            connection to subscribe
+        encoding : str
+            encoding of the structured messages sent to the connection
+
+        Returns
+        -------
+        bool
+            True if the connection was not already subscribed to the channel
+        """
+        with self._lock:
+            subscribers = self._subscribers[channel]
+            if connection in subscribers:
+                return False
+            # Copy on write, so the lists returned by `subscribers` are never modified
+            self._subscribers[channel] = subscribers + [connection]
+            group = self._by_encoding[channel]
+            group[encoding] = group[encoding] + [connection]
+            return True
+
+    def unsubscribe(self, connection, channel: int = None) -> List[int]:
+        """Remove `connection` from `channel`, or from every channel if `channel` is None
+
+        Returns
+        -------
+        list[int]
+            the channels the connection was subscribed to
+        """
+        removed = []
+        with self._lock:
+            channels = self._subscribers.keys() if channel is None else [channel]
+            for key in channels:
+                if connection in self._subscribers[key]:
+                    removed.append(key)
+                    self._subscribers[key] = [sub for sub in self._subscribers[key] if sub is not connection]
+                    group = self._by_encoding[key]
+                    for encoding, subscribers in group.items():
+                        if connection in subscribers:
+                            group[encoding] = [sub for sub in subscribers if sub is not connection]
+        return removed
+
+    def subscribers(self, channel: int, encoding: str = None) -> List[Any]:
+        """Return the connections subscribed to `channel`, only the ones using `encoding` if it is given
+
+        The returned list is a snapshot: it can be iterated while other threads subscribe or unsubscribe.
+        """
+        if encoding is None:
+            return self._subscribers[channel]
+        return self._by_encoding[channel][encoding]
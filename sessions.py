@@ -0,0 +1,141 @@
+import secrets
+from collections import OrderedDict, deque
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+# First game message of a connection resuming a session, followed by the token
+RESUME_COMMAND = "{resume}"
+# Reply to a resumption whose session has expired or cannot be resumed on this connection
+RESUME_FAILED = "RESUME FAILED"
+# Control message giving the token of its session to a player that has joined
+SESSION_COMMAND = "SESSION"
+# Seconds a disconnected player keeps its score, its role and its seat
+DEFAULT_SESSION_TTL = 60.0
+
+
+class Session:
+    """A player that joined a room, and the round it is playing, from its join to its quit"""
+
+    __slots__ = ("token", "name", "role", "room", "connection", "question_ids", "trick_question", "picked",
+                 "answer_deadline", "answer_timer", "rounds_ahead", "bank")
+
+    def __init__(self, token: str, name: str, role: str, room):
+        self.token = token
+        self.name = name
+        self.role = role
+        self.room = room
+        # Connection of the player, None while the session is parked
+        self.connection = None
+        # Questions of the current round and its trick question, None between two rounds
+        self.question_ids: Optional[List[int]] = None
+        self.trick_question: Optional[int] = None
+        # Version of the question bank the round was drawn from, kept by the round when the bank is reloaded
+        self.bank = None
+        # Question picked by the player, None until it picks one
+        self.picked: Optional[int] = None
+        # Wall clock time by which the picked question must be answered, and the timer scoring it as lost then
+        self.answer_deadline: Optional[float] = None
+        self.answer_timer = None
+        # (question ids, trick question, bank) of the rounds sent to a pipelined client after the current one
+        self.rounds_ahead: Deque[Tuple[List[int], int, Any]] = deque()
+
+    def __repr__(self):
+        return f"Session({self.name}, room={self.room.room_id})"
+
+    def new_round(self, question_ids: List[int], trick_question: int, bank):
+        """Start a round with the given questions of `bank`"""
+        self.question_ids = question_ids
+        self.trick_question = trick_question
+        self.bank = bank
+        self.picked = None
+
+    def next_round(self) -> bool:
+        """Make the oldest round sent ahead the current one
+
+        Returns
+        -------
+        bool
+            False if no round was sent ahead
+        """
+        if not self.rounds_ahead:
+            return False
+        self.new_round(*self.rounds_ahead.popleft())
+        return True
+
+    def end_round(self) -> bool:
+        """Forget the current round, the next one gets new questions
+
+        Returns
+        -------
+        bool
+            False if the answer deadline of the picked question has expired, its timer already scored it
+        """
+        in_time = self.answer_timer is None or self.room.worker.cancel(self.answer_timer)
+        self.question_ids = None
+        self.picked = None
+        self.answer_deadline = None
+        self.answer_timer = None
+        return in_time
+
+
+class SessionTable:
+    """Sessions of the disconnected players, each one kept for `ttl` seconds
+
+    Every session is parked with the same time to live, so the order of parking is the order of expiry: the
+    expired sessions are always at the front of the table, and evicting them costs O(1) each.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_SESSION_TTL):
+        self.ttl = ttl
+        self._lock = Lock()
+        # (expiry, session) by token, oldest first
+        self._parked: "OrderedDict[str, Tuple[float, Session]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._parked)
+
+    @staticmethod
+    def create(name: str, role: str, room) -> Session:
+        """New session of a player that joined `room`, with a token that cannot be guessed"""
+        return Session(secrets.token_urlsafe(16), name, role, room)
+
+    def park(self, session: Session):
+        """Keep the session of a disconnected player until it is resumed or it expires"""
+        with self._lock:
+            self._parked[session.token] = (monotonic() + self.ttl, session)
+
+    def resume(self, token: str, accept: Callable[[Session], bool] = lambda session: True) -> Optional[Session]:
+        """Remove and return the parked session with the given token
+
+        Parameters
+        ----------
+        token : str
+            token given to the player
+        accept : Callable[[Session], bool]
+            whether the session can be resumed, a refused session stays parked
+
+        Returns
+        -------
+        Session | None
+            the session, None if it does not exist, has expired or has been refused
+        """
+        with self._lock:
+            entry = self._parked.get(token)
+            if entry is None or entry[0] <= monotonic() or not accept(entry[1]):
+                return None
+            del self._parked[token]
+            return entry[1]
+
+    def expired(self) -> List[Session]:
+        """Remove and return the sessions whose time to live has elapsed"""
+        now = monotonic()
+        expired = []
+        with self._lock:
+            while self._parked:
+                token, (expiry, session) = next(iter(self._parked.items()))
+                if expiry > now:
+                    break
+                del self._parked[token]
+                expired.append(session)
+        return expired
@@ -0,0 +1,163 @@
+import json
+from threading import Event, Lock, Thread
+from time import time_ns
+from traceback import print_exc
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from leaderboard import Leaderboard
+from pubsub import Bus
+
+# A player of the whole cluster is identified by the id of its room and its id in the room leaderboard,
+# the room ids are unique across the nodes
+GlobalKey = str
+# (id, name, score) rows of the leaderboard of a room, the ids are the ones of the room leaderboard
+RoomRows = Iterable[Tuple[int, str, int]]
+
+# Topic of the leaderboard changes of the nodes, and of the requests for their whole partial leaderboard
+LEADERBOARD_TOPIC = "leaderboard"
+SYNC_TOPIC = "leaderboard.sync"
+
+
+def global_key(room_id: int, player_id: int) -> GlobalKey:
+    """Key of a player in the merged leaderboard"""
+    return f"{room_id}/{player_id}"
+
+
+class SharedLeaderboard:
+    """Leaderboard of the whole cluster, merged in every node from the partial leaderboards of all the nodes
+
+    `node` is the id of the node, unique in the cluster, and `partial()` gives the (room id, rows) of every room
+    it hosts. The changes of the rooms of the node are sent with `publish`, coalesced and published on the bus
+    every `tick` seconds as a json object with the "updated" [key, name, score] rows and the "removed" keys. Every node
+    applies the changes of every node, its own included, to `replica`.
+
+    A node that connects to the bus asks the others for their whole partial leaderboard, a "rows" object that
+    replaces the previous rows of its node, and publishes its own. Its last will is an empty partial leaderboard,
+    so its players leave the other replicas when it leaves the bus. Every message carries the epoch of the
+    connection of its node, the messages of a previous connection, like a last will published late, are ignored.
+    """
+
+    def __init__(self, bus: Bus, node: int, partial: Callable[[], Iterable[Tuple[int, RoomRows]]],
+                 tick: float = 0.1):
+        self.bus = bus
+        self.node = node
+        self.tick = tick
+        self.replica = Leaderboard()
+        self._partial = partial
+        self._lock = Lock()
+        # Rows changed since the last tick, None for the removed players
+        self._pending: Dict[GlobalKey, Optional[Tuple[str, int]]] = {}
+        # Whether the whole partial leaderboard has to be published at the next tick
+        self._resync = False
+        self._epoch = time_ns()
+        # Latest epoch and keys of every node, guarded by the lock
+        self._epochs: Dict[int, int] = {}
+        self._keys: Dict[int, Set[GlobalKey]] = {}
+        self._stopped = Event()
+
+    def __len__(self):
+        return len(self.replica)
+
+    def start(self):
+        """Subscribe to the changes of the other nodes and start publishing the changes of this one, the bus is
+        started afterwards"""
+        self.bus.subscribe(LEADERBOARD_TOPIC, self._apply)
+        self.bus.subscribe(SYNC_TOPIC, self._sync_requested)
+        self.bus.on_connect(self._connected)
+        Thread(target=self._ticker, daemon=True).start()
+
+    def stop(self):
+        """Stop publishing the changes"""
+        self._stopped.set()
+
+    def publish(self, room_id: int, updated: RoomRows, removed: Iterable[int]):
+        """Queue the changes of the leaderboard of a room, they are published with the next tick
+
+        Parameters
+        ----------
+        room_id : int
+            id of the room
+        updated : Iterable[tuple[int, str, int]]
+            (id, name, score) rows of the changed players, the ids are the ones of the room leaderboard
+        removed : Iterable[int]
+            ids of the players removed from the room leaderboard
+        """
+        with self._lock:
+            for player_id, name, score in updated:
+                self._pending[global_key(room_id, player_id)] = (name, score)
+            for player_id in removed:
+                self._pending[global_key(room_id, player_id)] = None
+
+    def rank(self, room_id: int, player_id: int, score: int) -> int:
+        """Position of a player among the players of every node
+
+        The replica can still hold the previous score of the player, so it is left out of the count.
+        """
+        key = global_key(room_id, player_id)
+        above = self.replica.count_above(score)
+        if key in self.replica and self.replica.score(key) > score:
+            above -= 1
+        return above + 1
+
+    def _connected(self):
+        """Invoked by the bus when the node connects: a new epoch starts, and every node, this one included,
+        publishes its whole partial leaderboard"""
+        with self._lock:
+            self._epoch = time_ns()
+            epoch = self._epoch
+        self.bus.set_last_will(LEADERBOARD_TOPIC, json.dumps({"node": self.node, "epoch": epoch, "rows": []}))
+        self.bus.publish(SYNC_TOPIC, json.dumps({"node": self.node}))
+
+    def _sync_requested(self, message: str):
+        """A node has connected, it needs the partial leaderboard of this one"""
+        with self._lock:
+            self._resync = True
+
+    def _ticker(self):
+        """Target of the thread publishing the changes of the node"""
+        while not self._stopped.wait(self.tick):
+            try:
+                self._publish_changes()
+            except Exception:
+                print_exc()
+
+    def _publish_changes(self):
+        """Publish the changes queued since the last tick, or the whole partial leaderboard if a node asked it"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            resync, self._resync = self._resync, False
+            epoch = self._epoch
+        if resync:
+            # The rows are read after the pending changes are taken, so they are at least as recent
+            rows = [[global_key(room_id, player_id), name, score]
+                    for room_id, room_rows in self._partial() for player_id, name, score in room_rows]
+            self.bus.publish(LEADERBOARD_TOPIC, json.dumps({"node": self.node, "epoch": epoch, "rows": rows}))
+        elif pending:
+            self.bus.publish(LEADERBOARD_TOPIC, json.dumps({
+                "node": self.node,
+                "epoch": epoch,
+                "updated": [[key, row[0], row[1]] for key, row in pending.items() if row is not None],
+                "removed": [key for key, row in pending.items() if row is None]
+            }))
+
+    def _apply(self, message: str):
+        """Merge the changes, or the whole partial leaderboard, of a node into the replica"""
+        changes = json.loads(message)
+        node, epoch = changes["node"], changes["epoch"]
+        with self._lock:
+            if epoch < self._epochs.get(node, epoch):
+                # Sent on a previous connection of the node
+                return
+            self._epochs[node] = epoch
+            keys = self._keys.setdefault(node, set())
+            if "rows" in changes:
+                updated: List[list] = changes["rows"]
+                removed = keys - {key for key, _, _ in updated}
+            else:
+                updated, removed = changes["updated"], changes["removed"]
+            for key, name, score in updated:
+                self.replica.add(key, name, score)
+                keys.add(key)
+            for key in removed:
+                self.replica.remove(key)
+                keys.discard(key)
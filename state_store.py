@@ -0,0 +1,110 @@
+from threading import Lock
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Set, Tuple
+
+from codec import ENCODING_JSON
+
+# Stripes of a store, a power of two so that the stripe of a key is a mask of its hash
+DEFAULT_STRIPES = 16
+
+
+class PlayerRecord:
+    """State of a connection, from its acceptance to its release"""
+
+    __slots__ = ("connection", "address", "room", "name", "role", "seen_questions", "encoding", "compressor",
+                 "pipeline", "seen_generation")
+
+    def __init__(self, connection, address: Tuple[str, int], room=None):
+        self.connection = connection
+        self.address = address
+        self.room = room
+        # Set when the player writes its name
+        self.name: Optional[str] = None
+        self.role: Optional[str] = None
+        # Ids of the questions whose text has already been sent to the player, and the generation of the question
+        # bank they belong to
+        self.seen_questions: Set[int] = set()
+        self.seen_generation = 0
+        # Encoding of the structured messages, negotiated by the client on the control channel
+        self.encoding = ENCODING_JSON
+        # Compressor of the frames, set if the client negotiated the compression
+        self.compressor = None
+        # Rounds sent ahead of the answers, negotiated by the client before joining, 0 for a round trip each step
+        self.pipeline = 0
+
+    def __repr__(self):
+        return f"PlayerRecord({self.name or self.address})"
+
+    @property
+    def label(self) -> str:
+        """Name of the player, or its address if it has not joined yet"""
+        return self.name or str(self.address)
+
+
+class StateStore:
+    """Records of the connected players, split in stripes each guarded by its own lock
+
+    A thread only locks the stripe of the connection it works on, so the handlers of different connections
+    rarely contend. `snapshot` locks every stripe, always in the same order, to read a consistent copy.
+    """
+
+    def __init__(self, stripes: int = DEFAULT_STRIPES):
+        if stripes <= 0 or stripes & (stripes - 1):
+            raise ValueError("The number of stripes must be a power of two")
+        self._mask = stripes - 1
+        self._locks = [Lock() for _ in range(stripes)]
+        self._records: List[Dict[Hashable, PlayerRecord]] = [{} for _ in range(stripes)]
+
+    def __len__(self):
+        return sum(len(records) for records in self._records)
+
+    def __contains__(self, connection):
+        return connection in self._records[hash(connection) & self._mask]
+
+    def __iter__(self) -> Iterator[PlayerRecord]:
+        return iter(self.snapshot())
+
+    def add(self, record: PlayerRecord):
+        """Store the record of a new connection"""
+        stripe = hash(record.connection) & self._mask
+        with self._locks[stripe]:
+            self._records[stripe][record.connection] = record
+
+    def get(self, connection) -> Optional[PlayerRecord]:
+        """Record of a connection, None if it has been released"""
+        stripe = hash(connection) & self._mask
+        with self._locks[stripe]:
+            return self._records[stripe].get(connection)
+
+    def pop(self, connection) -> Optional[PlayerRecord]:
+        """Remove and return the record of a connection, None if it has already been released
+
+        Only one of the threads releasing the same connection gets the record.
+        """
+        stripe = hash(connection) & self._mask
+        with self._locks[stripe]:
+            return self._records[stripe].pop(connection, None)
+
+    def update(self, connection, **fields: Any) -> PlayerRecord:
+        """Set some fields of the record of a connection under the lock of its stripe
+
+        Raises
+        ------
+        KeyError
+            if the connection has been released
+        """
+        stripe = hash(connection) & self._mask
+        with self._locks[stripe]:
+            record = self._records[stripe][connection]
+            for field, value in fields.items():
+                setattr(record, field, value)
+            return record
+
+    def snapshot(self) -> List[PlayerRecord]:
+        """Consistent list of the records, taken while holding every stripe"""
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            return [record for records in self._records for record in records.values()]
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
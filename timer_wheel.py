@@ -0,0 +1,101 @@
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+# Slots of a wheel, a deadline further than a turn of the wheel waits in its slot for the following turns
+DEFAULT_SLOTS = 512
+
+
+class Timer:
+    """Handle of a callback scheduled on a wheel, used to cancel it"""
+
+    __slots__ = ("callback",)
+
+    def __init__(self, callback: Callable[[], Any]):
+        self.callback = callback
+
+
+class TimerWheel:
+    """Hashed timing wheel: the deadlines are placed in the slot of their tick, modulo the number of slots
+
+    Scheduling, rescheduling and cancelling a deadline cost O(1) whatever the number of deadlines, and
+    advancing the wheel only visits the slots of the elapsed ticks, so it suits tens of thousands of
+    deadlines that are rescheduled far more often than they expire. A deadline expires at most one tick late.
+    Every item has at most one deadline, scheduling it again replaces the previous one.
+    """
+
+    def __init__(self, tick: float, now: float, slots: int = DEFAULT_SLOTS):
+        if tick <= 0 or slots <= 0:
+            raise ValueError("The tick and the number of slots must be positive")
+        self.tick = tick
+        self._lock = Lock()
+        self._slots: List[Dict[Hashable, float]] = [{} for _ in range(slots)]
+        # Slot index of every scheduled item
+        self._slot_of: Dict[Hashable, int] = {}
+        # Last tick whose slot has been visited, a slot is visited once its tick has fully elapsed
+        self._current = self._tick_of(now) - 1
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, item: Hashable):
+        return item in self._slot_of
+
+    def _tick_of(self, when: float) -> int:
+        """Index of the tick containing the time `when`"""
+        return int(when // self.tick)
+
+    def schedule(self, item: Hashable, when: float):
+        """Expire `item` at the monotonic time `when`, replacing its previous deadline"""
+        with self._lock:
+            # A deadline in the past expires with the tick in progress
+            index = max(self._tick_of(when), self._current + 1) % len(self._slots)
+            previous = self._slot_of.get(item)
+            if previous is not None and previous != index:
+                del self._slots[previous][item]
+            self._slots[index][item] = when
+            self._slot_of[item] = index
+
+    def cancel(self, item: Hashable) -> bool:
+        """Remove the deadline of `item`
+
+        Returns
+        -------
+        bool
+            False if the item had no deadline
+        """
+        with self._lock:
+            index = self._slot_of.pop(item, None)
+            if index is None:
+                return False
+            del self._slots[index][item]
+            return True
+
+    def deadline(self, item: Hashable) -> Optional[float]:
+        """Deadline of `item`, None if it has none"""
+        with self._lock:
+            index = self._slot_of.get(item)
+            return self._slots[index][item] if index is not None else None
+
+    def advance(self, now: float) -> List[Tuple[Hashable, float]]:
+        """Remove and return the items whose deadline is in a tick that has fully elapsed at `now`
+
+        Returns
+        -------
+        list[tuple[Hashable, float]]
+            expired items with their deadline, in the order of their ticks
+        """
+        target = self._tick_of(now) - 1
+        expired = []
+        with self._lock:
+            # After a long pause every slot is visited once
+            last = min(target, self._current + len(self._slots))
+            while self._current < last:
+                self._current += 1
+                slot = self._slots[self._current % len(self._slots)]
+                due = [(item, when) for item, when in slot.items() if when <= now]
+                for item, when in due:
+                    del slot[item]
+                    del self._slot_of[item]
+                expired.extend(due)
+            self._current = max(self._current, target)
+        return expired
@@ -1,4 +1,16 @@
+import select
 import tkinter as tkt
+import tkinter.font as tkfont
+from collections import deque
+from itertools import islice
+from socket import socket
+from typing import Callable, Deque, Dict, Optional, Union
+from protocol import Frame, FrameDecoder, ProtocolError
+
+# Milliseconds between two polls of the socket where Tk has no file handlers
+POLL_INTERVAL = 10
+# Milliseconds between two renderings of a list, about one frame at 60 frames per second
+FRAME_INTERVAL = 16
 
 
 def configure_grid(node: tkt.Misc, colnum: int, rownum: int):
@@ -21,19 +33,186 @@ def configure_grid(node: tkt.Misc, colnum: int, rownum: int):
 
 
 class ListBoxPane(tkt.Frame):
-    """Pane that contains a listbox with a vertical and horizontal scrollbar"""
+    """Pane that contains a listbox with a vertical and horizontal scrollbar
+
+    The rows are kept in a history bounded to `max_rows` rows, the oldest rows are dropped when it is full.
+    The listbox only holds the rows that fit in it: the changes are applied to the history and the visible
+    rows are rendered again at most once per frame, so the cost of an update does not depend on the length
+    of the list. With `follow` the view sticks to the last row while it is visible.
+    """
 
-    def __init__(self, parent):
+    def __init__(self, parent, max_rows: Optional[int] = None, follow: bool = False):
         super().__init__(parent)
         configure_grid(self, 1, 1)
         self.listbox = tkt.Listbox(self)
         self.listbox.grid(row=0, column=0, sticky="nsew")
         self.grid_propagate(False)
-        vertical_scrollbar = tkt.Scrollbar(self, orient=tkt.HORIZONTAL)
-        vertical_scrollbar.config(command=self.listbox.xview)
-        vertical_scrollbar.grid(row=1, column=0, sticky="ew")
-        self.listbox.config(xscrollcommand=vertical_scrollbar.set)
-        horizontal_scrollbar = tkt.Scrollbar(self, orient=tkt.VERTICAL)
-        horizontal_scrollbar.config(command=self.listbox.yview)
-        horizontal_scrollbar.grid(row=0, column=1, sticky="ns")
-        self.listbox.config(yscrollcommand=horizontal_scrollbar.set)
+        horizontal_scrollbar = tkt.Scrollbar(self, orient=tkt.HORIZONTAL)
+        horizontal_scrollbar.config(command=self.listbox.xview)
+        horizontal_scrollbar.grid(row=1, column=0, sticky="ew")
+        self.listbox.config(xscrollcommand=horizontal_scrollbar.set)
+        # The vertical scrollbar moves through the history, not through the rows of the listbox
+        self.__vertical_scrollbar = tkt.Scrollbar(self, orient=tkt.VERTICAL)
+        self.__vertical_scrollbar.config(command=self.__yview)
+        self.__vertical_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.listbox.bind("<Configure>", self.__on_resize)
+        self.listbox.bind("<MouseWheel>", self.__on_mouse_wheel)
+        self.listbox.bind("<Button-4>", self.__on_mouse_wheel)
+        self.listbox.bind("<Button-5>", self.__on_mouse_wheel)
+        self.__rows: Deque[str] = deque(maxlen=max_rows)
+        self.__follow = follow
+        # Index of the first visible row and number of rows that fit in the listbox
+        self.__offset = 0
+        self.__visible = 1
+        self.__render_scheduled = False
+
+    def push(self, row: str):
+        """Append a row, dropping the oldest one if the history is full"""
+        following = self.__follow and self.__offset + self.__visible >= len(self.__rows)
+        if len(self.__rows) == self.__rows.maxlen:
+            self.__offset = max(0, self.__offset - 1)
+        self.__rows.append(row)
+        if following:
+            self.__offset = max(0, len(self.__rows) - self.__visible)
+        self.__schedule_render()
+
+    def insert(self, index: int, row: str):
+        """Insert a row at a given position, dropping the oldest one if the history is full"""
+        if len(self.__rows) == self.__rows.maxlen:
+            self.__rows.popleft()
+            self.__offset = max(0, self.__offset - 1)
+            index = max(0, index - 1)
+        self.__rows.insert(index, row)
+        if index < self.__offset:
+            self.__offset += 1
+        self.__schedule_render()
+
+    def delete(self, index: int):
+        """Delete the row at a given position"""
+        del self.__rows[index]
+        if index < self.__offset:
+            self.__offset -= 1
+        self.__schedule_render()
+
+    def clear(self):
+        """Delete every row"""
+        self.__rows.clear()
+        self.__offset = 0
+        self.__schedule_render()
+
+    def __schedule_render(self):
+        """Render the visible rows at the next frame, the changes until then are rendered together"""
+        if not self.__render_scheduled:
+            self.__render_scheduled = True
+            self.after(FRAME_INTERVAL, self.__render)
+
+    def __render(self):
+        """Replace the rows of the listbox with the visible rows of the history"""
+        self.__render_scheduled = False
+        self.__offset = max(0, min(self.__offset, len(self.__rows) - self.__visible))
+        self.listbox.delete(0, tkt.END)
+        # One more row than fits, so that a partially visible last row is not left blank
+        rows = list(islice(self.__rows, self.__offset, self.__offset + self.__visible + 1))
+        if rows:
+            self.listbox.insert(0, *rows)
+        total = max(len(self.__rows), 1)
+        self.__vertical_scrollbar.set(self.__offset / total, min(1.0, (self.__offset + self.__visible) / total))
+
+    def __yview(self, action: str, amount: str, unit: Optional[str] = None):
+        """Command of the vertical scrollbar"""
+        if action == tkt.MOVETO:
+            self.__offset = int(float(amount) * len(self.__rows))
+        elif unit == tkt.PAGES:
+            self.__offset += int(float(amount)) * self.__visible
+        else:
+            self.__offset += int(float(amount))
+        self.__schedule_render()
+
+    def __on_mouse_wheel(self, event: tkt.Event):
+        """Scroll the history, the listbox must not scroll its own rows"""
+        if event.num == 4 or event.delta > 0:
+            self.__yview(tkt.SCROLL, "-3", tkt.UNITS)
+        else:
+            self.__yview(tkt.SCROLL, "3", tkt.UNITS)
+        return "break"
+
+    def __on_resize(self, event: tkt.Event):
+        """Recompute how many rows fit in the listbox"""
+        line_height = tkfont.Font(font=self.listbox.cget("font")).metrics("linespace") + 1
+        visible = max(1, event.height // line_height)
+        if visible != self.__visible:
+            self.__visible = visible
+            self.__schedule_render()
+
+
+class TkChannelReader:
+    """Reads the frames of a socket from the Tk event loop and passes each message to the handler of its channel
+
+    On Unix the socket is registered with `createfilehandler`, so Tk calls back as soon as data arrives;
+    Tk on Windows has no file handlers, there the socket is polled with `after` every `POLL_INTERVAL` ms.
+    The handlers run on the thread of the main loop, so they can update the widgets directly. The compressed
+    frames are inflated with `dictionary`, the preset dictionary offered to the server.
+    """
+
+    def __init__(self, widget: tkt.Misc, sock: socket, handlers: Dict[int, Callable[[Union[str, bytes]], None]],
+                 on_close: Callable[[], None], dictionary: Optional[bytes] = None):
+        self._widget = widget
+        self._socket = sock
+        self._handlers = handlers
+        self._on_close = on_close
+        self._decoder = FrameDecoder(dictionary=dictionary)
+        # Frames received but not handled yet
+        self._frames: Deque[Frame] = deque()
+        self._dispatching = False
+        self._running = False
+        self._use_file_handler = hasattr(widget.tk, "createfilehandler")
+
+    def start(self):
+        """Start reading from the socket"""
+        self._running = True
+        if self._use_file_handler:
+            self._widget.tk.createfilehandler(self._socket, tkt.READABLE, self._on_readable)
+        else:
+            self._widget.after(POLL_INTERVAL, self._poll)
+
+    def stop(self):
+        """Stop reading from the socket, the frames already received are dropped"""
+        if self._running and self._use_file_handler:
+            self._widget.tk.deletefilehandler(self._socket)
+        self._running = False
+        self._frames.clear()
+
+    def _on_readable(self, *_):
+        """Called by Tk when the socket has data to read"""
+        if not self._running:
+            return
+        try:
+            self._frames.extend(self._decoder.recv_from(self._socket))
+        except (OSError, ProtocolError):
+            self.stop()
+            self._on_close()
+            return
+        self._dispatch()
+
+    def _poll(self):
+        """Read the socket while it has data, then schedule the next poll"""
+        while self._running and select.select([self._socket], [], [], 0)[0]:
+            self._on_readable()
+        if self._running:
+            self._widget.after(POLL_INTERVAL, self._poll)
+
+    def _dispatch(self):
+        """Pass the received frames to their handlers, in order
+
+        A handler that opens a dialog runs a nested event loop which can receive more frames: they are queued
+        and handled by the outer call once the handler returns.
+        """
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while self._frames:
+                channel, message = self._frames.popleft()
+                self._handlers[channel](message)
+        finally:
+            self._dispatching = False